@@ -95,6 +95,9 @@ def setup_database():
         
         db_path = Path(__file__).parent / 'repoinsight.db'
         state_manager = StateManager(str(db_path))
+        # 构造时不建表，显式打开后端完成建表与迁移
+        state_manager.backend.open()
+        state_manager.close()
         
         print(f"✅ 数据库初始化成功: {db_path}")
         return True
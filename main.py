@@ -2,32 +2,219 @@ from pkg.plugin.context import register, handler, BasePlugin, APIHost, EventCont
 from pkg.plugin.events import *
 from pkg.platform.types import *
 
+import abc
 import asyncio
-import aiohttp
 import sqlite3
+import threading
+import time
+import heapq
+import bisect
+import math
+import itertools
+import contextlib
+import random
+import hashlib
+import hmac
+import zlib
+import struct
+import unicodedata
 import json
 import re
 import logging
-import yaml
+import importlib
 import os
+import sys
+import socket
+import uuid
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Any, List
+from typing import TYPE_CHECKING, Dict, Optional, Any, List, AsyncIterator
 from urllib.parse import urlparse
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-# 先设置基础日志配置
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+if TYPE_CHECKING:
+    # aiohttp 导入耗时较长，只在首次发起请求或启动内嵌服务时才导入，插件加载时不付出这部分开销
+    import aiohttp
+    from aiohttp import web
+
+# 日志格式与级别由宿主（LangBot）统一配置，插件不在导入时修改全局日志
 logger = logging.getLogger(__name__)
 
+async def import_off_loop(name: str):
+    """在线程池中导入模块并返回，首次导入重依赖时不阻塞事件循环"""
+    module = sys.modules.get(name)
+    if module is None:
+        module = await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, name)
+    return module
+
+# 运行指标
+class Metrics:
+    """进程内指标注册表：计数器、直方图与按需读取的瞬时值，导出为 Prometheus 文本格式"""
+    # 直方图桶上界（秒）
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self):
+        # (name, labels) -> 值；直方图值为 [各桶计数..., +Inf 计数, 总和]
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, list] = {}
+        self._gauges: Dict[str, tuple] = {}
+        self._help: Dict[str, str] = {}
+        # 数据库线程也会写入指标
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> tuple:
+        return name, tuple(sorted(labels.items()))
+    
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            values[index] += 1
+            values[-1] += seconds
+    
+    def gauge(self, name: str, read, help_text: str = "", kind: str = "gauge"):
+        """注册按需读取的值，导出时调用 read()；组件自带的累计计数以 kind="counter" 导出"""
+        self._gauges[name] = (read, help_text, kind)
+    
+    def total(self, name: str) -> float:
+        """计数器的累计值，或直方图的观测次数（跨所有标签）"""
+        with self._lock:
+            counted = sum(value for (key, _), value in self._counters.items() if key == name)
+            observed = sum(sum(values[:-1]) for (key, _), values in self._histograms.items() if key == name)
+        return counted + observed
+    
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+    
+    def render(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+        lines, typed = [], set()
+        
+        def header(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), values in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, values):
+                cumulative += count
+                bucket_label = 'le="%g"' % bound
+                lines.append(f"{name}_bucket{self._labels(labels, bucket_label)} {cumulative}")
+            cumulative += values[len(self.BUCKETS)]
+            inf_label = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._labels(labels, inf_label)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values[-1]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, (read, help_text, kind) in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+    
+    def _quantile(self, values: list, q: float) -> float:
+        """按桶估算分位数（取所在桶的上界）"""
+        total = sum(values[:-1])
+        rank, cumulative = q * total, 0
+        for bound, count in zip(self.BUCKETS, values):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+    
+    def summary(self) -> str:
+        """聊天指令用的简要文本"""
+        with self._lock:
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+            counters = sorted(self._counters.items())
+        lines = ["📊 运行指标"]
+        for (name, labels), values in histograms:
+            count = sum(values[:-1])
+            if not count:
+                continue
+            label = ",".join(str(value) for _, value in labels)
+            lines.append(
+                f"{name.replace('repoinsight_', '')}[{label}] n={count} avg={values[-1] / count * 1000:.1f}ms "
+                f"p95≤{self._quantile(values, 0.95) * 1000:g}ms"
+            )
+        for (name, labels), value in counters:
+            label = ",".join(str(value) for _, value in labels)
+            lines.append(f"{name.replace('repoinsight_', '')}[{label}] {value:g}")
+        for name, (read, _, _) in sorted(self._gauges.items()):
+            try:
+                lines.append(f"{name.replace('repoinsight_', '')} {read():g}")
+            except Exception:
+                continue
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+class MetricsExporter:
+    """可选的本地 HTTP 端口，GET /metrics 返回 Prometheus 文本"""
+    
+    def __init__(self, registry: Metrics, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional["web.AppRunner"] = None
+    
+    async def start(self):
+        web = await import_off_loop('aiohttp.web')
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics exporter listening on {self.host}:{self.port}/metrics")
+    
+    async def _handle(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
 # 枚举定义
 class UserState(Enum):
     IDLE = "idle"
     WAITING_FOR_REPO = "waiting_for_repo"
     ANALYZING = "analyzing"
     READY_FOR_QUERY = "ready_for_query"
+    # 旧版本的单问题等待状态，启动时迁移到待回答问题队列
     WAITING_FOR_ANSWER = "waiting_for_answer"
 
 class TaskStatus(Enum):
@@ -40,7 +227,8 @@ class TaskStatus(Enum):
 class UserSession:
     def __init__(self, user_id: str, state: UserState = UserState.IDLE, 
                  repo_url: str = None, analysis_task_id: str = None,
-                 question: str = None, query_task_id: str = None, session_id: str = None):
+                 question: str = None, query_task_id: str = None, session_id: str = None,
+                 adapter_key: str = None, target_type: str = None, target_id: str = None):
         self.user_id = user_id
         self.state = state
         self.repo_url = repo_url
@@ -48,7 +236,35 @@ class UserSession:
         self.question = question
         self.query_task_id = query_task_id
         self.session_id = session_id  # 新增session_id字段
+        # 主动通知的回复路由：消息来源的适配器、目标类型（person/group）与目标 ID
+        self.adapter_key = adapter_key
+        self.target_type = target_type
+        self.target_id = target_id
         self.last_activity = datetime.now()
+        # 最近一次落盘时的字段快照，None 表示从未落盘
+        self._persisted_fields = None
+        self._persisted_activity = None
+    
+    def _fields(self) -> tuple:
+        """参与脏检查的持久化字段（不含 last_activity）"""
+        return (self.state, self.repo_url, self.analysis_task_id,
+                self.question, self.query_task_id, self.session_id,
+                self.adapter_key, self.target_type, self.target_id)
+    
+    def mark_clean(self):
+        """记录当前字段为已落盘状态"""
+        self._persisted_fields = self._fields()
+        self._persisted_activity = self.last_activity
+    
+    def is_dirty(self, touch_interval: float = 0) -> bool:
+        """判断是否需要写回：字段有变化，或 last_activity 前进超过 touch_interval 秒"""
+        if self._persisted_fields is None or self._persisted_fields != self._fields():
+            return True
+        return (self.last_activity - self._persisted_activity).total_seconds() >= touch_interval
+    
+    def reply_route(self) -> tuple:
+        """主动通知的投递目标 (adapter_key, target_type, target_id)，旧会话默认私聊本人"""
+        return (self.adapter_key, self.target_type or "person", self.target_id or self.user_id)
     
     def to_dict(self):
         return {
@@ -59,6 +275,9 @@ class UserSession:
             'question': self.question,
             'query_task_id': self.query_task_id,
             'session_id': self.session_id,
+            'adapter_key': self.adapter_key,
+            'target_type': self.target_type,
+            'target_id': self.target_id,
             'last_activity': self.last_activity.isoformat()
         }
     
@@ -71,69 +290,1498 @@ class UserSession:
             analysis_task_id=data.get('analysis_task_id'),
             question=data.get('question'),
             query_task_id=data.get('query_task_id'),
-            session_id=data.get('session_id')
+            session_id=data.get('session_id'),
+            adapter_key=data.get('adapter_key'),
+            target_type=data.get('target_type'),
+            target_id=data.get('target_id')
         )
         if data.get('last_activity'):
             session.last_activity = datetime.fromisoformat(data['last_activity'])
         return session
 
-# 状态管理器
-class StateManager:
-    def __init__(self, db_path: str = "repo_insight.db"):
+# 会话缓存
+class SessionCache:
+    """进程内 UserSession 的 LRU/TTL 缓存"""
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (session, 过期时间)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, user_id: str) -> Optional[UserSession]:
+        """命中则刷新 LRU 位置与过期时间"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._entries[user_id] = (entry[0], now + self.ttl)
+            self.hits += 1
+            return entry[0]
+    
+    def peek(self, user_id: str) -> Optional[UserSession]:
+        """读取但不计数、不刷新 LRU"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+    
+    def put(self, session: UserSession):
+        """写入缓存，超出容量时淘汰最久未使用的会话"""
+        with self._lock:
+            self._entries[session.user_id] = (session, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+    
+    def evict_inactive(self, cutoff: datetime):
+        """移除 last_activity 早于 cutoff 的会话"""
+        with self._lock:
+            stale = [uid for uid, (session, _) in self._entries.items() if session.last_activity < cutoff]
+            for uid in stale:
+                del self._entries[uid]
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# 空闲用户集合
+class IdleUserSet:
+    """进程内记录最近确认处于空闲状态（没有进行中会话）的用户，群聊预过滤据此不读写存储直接答复
+    条目与会话缓存同样按 TTL 过期，其他进程推进的会话最多在这段时间后重新以数据库为准"""
+    
+    def __init__(self, max_size: int = 100000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> 过期时间
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            expires = self._entries.get(user_id)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return False
+            return True
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def track(self, session: UserSession):
+        """按会话当前状态加入或移出集合"""
+        with self._lock:
+            if session.state != UserState.IDLE:
+                self._entries.pop(session.user_id, None)
+                return
+            self._entries[session.user_id] = time.monotonic() + self.ttl
+            self._entries.move_to_end(session.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+# 状态存储后端
+class StateBackend(abc.ABC):
+    """状态存储接口：会话的读写、按状态分页、按任务查找与过期清理，以及问题队列、任务租约、仓库分析登记与答案缓存
+    会话以 SESSION_COLUMNS 顺序的元组传递（last_activity 为 Unix 时间戳）；方法均为同步调用，由 StateManager 放到数据库线程执行"""
+    SESSION_COLUMNS = (
+        "user_id, state, repo_url, analysis_task_id, question, query_task_id, session_id, last_activity, "
+        "adapter_key, target_type, target_id"
+    )
+    # 提交中的问题超过该时长仍未得到查询任务，视为提交进程已退出，重新排队
+    SUBMIT_STALE_SECONDS = 120
+    
+    def open(self):
+        """建立连接并完成建表与迁移；插件在 initialize() 中于数据库线程调用，未调用时首次访问也会自动执行"""
+        pass
+    
+    # ---- 会话 ----
+    
+    @abc.abstractmethod
+    def load_session(self, user_id: str) -> Optional[tuple]:
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def write_sessions(self, rows: List[tuple]):
+        """写入（覆盖）一批会话，要么全部成功，要么抛出异常"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def sessions_page(self, state: str, after_user_id: str, batch_size: int) -> List[tuple]:
+        """按 user_id 升序返回 user_id 大于 after_user_id 的一页指定状态会话"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def sessions_by_task(self, state: str, column: str, task_key: str) -> List[tuple]:
+        """查找指定状态下 column（session_id 或 query_task_id）等于 task_key 的会话"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def expire_sessions(self, cutoff: int, batch_size: int) -> int:
+        """删除至多 batch_size 个 last_activity 早于 cutoff 的会话及其未答复的问题，返回删除的会话数"""
+        raise NotImplementedError
+    
+    # ---- 仓库分析登记 ----
+    
+    @abc.abstractmethod
+    def get_repo_analysis(self, repo_key: str, ttl_seconds: float) -> Optional[Dict]:
+        """读取仓库分析登记，过期记录视为不存在"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def put_repo_analysis(self, repo_key: str, repo_url: str, session_id: str, task_id: Optional[str],
+                          status: str, ttl_seconds: float, max_entries: int):
+        """登记仓库分析，并按 TTL 与 LRU 淘汰旧记录"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def update_repo_analysis_status(self, session_id: str, status: Optional[str]):
+        """更新分析登记状态，status 为 None 时删除登记"""
+        raise NotImplementedError
+    
+    # ---- 问题队列 ----
+    
+    @abc.abstractmethod
+    def enqueue_question(self, user_id: str, analysis_session_id: str, question: str,
+                         max_pending: int) -> Optional[tuple]:
+        """把问题加入用户的待回答队列，返回 (问题ID, 前面未答复的问题数)；队列已满时返回 None"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def claim_questions(self, per_user_limit: int, global_limit: int,
+                        user_id: Optional[str] = None) -> List[tuple]:
+        """按提问顺序领取可以提交的问题（不超过每用户与全局并发上限），返回 [(问题ID, user_id, 分析会话ID, 问题)]；
+        给出 user_id 时只领取该用户的问题"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def mark_question_running(self, question_id: int, query_task_id: str) -> bool:
+        """记录问题的查询任务；问题已被撤回时返回 False"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def drop_question(self, question_id: int):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_question_by_task(self, query_task_id: str) -> Optional[tuple]:
+        """按查询任务查找问题，返回 (问题ID, user_id, 分析会话ID, 问题)"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def take_question(self, query_task_id: str) -> Optional[tuple]:
+        """取出并删除已结束的问题；轮询、推送与流式收尾并发（包括多个进程）时只有删除成功的一方能取到"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def running_questions(self) -> List[tuple]:
+        """所有已提交、等待答案的问题，返回 [(user_id, query_task_id)]"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def count_questions(self, user_id: str) -> tuple:
+        """返回用户 (处理中, 排队中) 的问题数"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def clear_questions(self, user_id: str) -> int:
+        """撤回用户所有未答复的问题，已提交的查询结果到达后直接丢弃"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def count_active_questions(self) -> int:
+        """已领取（提交中或已提交）的问题数，分片存储据此分配全局并发名额"""
+        raise NotImplementedError
+    
+    # ---- 任务租约 ----
+    
+    @abc.abstractmethod
+    def claim_leases(self, tasks: List[tuple], owner: str, ttl_seconds: float) -> List[tuple]:
+        """为 [(kind, task_key, user_id)] 申请租约：无人持有、已过期或本进程持有时成功，返回成功的任务"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def take_over_expired_leases(self, owner: str, ttl_seconds: float, limit: int = 200) -> List[tuple]:
+        """接管持有者已失联（租约过期）的任务，返回 [(kind, task_key, user_id)]"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def renew_leases(self, owner: str, ttl_seconds: float) -> set:
+        """续期本进程持有的全部租约，返回仍持有的 {(kind, task_key)}"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def release_leases(self, owner: str, keys: Optional[List[tuple]] = None):
+        """释放本进程持有的租约，keys 为 None 时释放全部"""
+        raise NotImplementedError
+    
+    # ---- 答案缓存 ----
+    
+    @abc.abstractmethod
+    def get_cached_answer(self, analysis_session_id: str, generation_mode: str,
+                          normalized_question: str, max_age_seconds: float) -> Optional[tuple]:
+        """精确查找缓存答案，返回 (id, answer)"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def find_answer_candidates(self, band_keys: List[int], max_age_seconds: float) -> List[tuple]:
+        """按 LSH 分桶召回候选答案，返回 [(id, normalized_question, signature, answer)]"""
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def record_answer_hit(self, entry_id: int):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def put_cached_answer(self, analysis_session_id: str, generation_mode: str, normalized_question: str,
+                          signature: bytes, band_keys: List[int], answer: str,
+                          max_entries: int, max_bytes: int, max_age_seconds: float):
+        """写入缓存答案，并按年龄、条数与总字节数淘汰最久未命中的条目"""
+        raise NotImplementedError
+    
+    # ---- 维护 ----
+    
+    def reclaim_space(self, max_pages: int = 1000) -> int:
+        """归还一部分已删除数据占用的空间，返回尚待回收的量（0 表示已回收完）"""
+        return 0
+    
+    def checkpoint(self) -> tuple:
+        """把日志写回主存储，返回 (busy, 日志页数, 已检查点页数)"""
+        return (0, 0, 0)
+    
+    def close(self):
+        pass
+
+class SQLiteBackend(StateBackend):
+    """单文件 SQLite 存储：一个调优过的长连接，语句在锁内串行执行"""
+    # SQLite 连接调优参数（WAL + NORMAL 同步在崩溃时最多丢失最后一个事务，不会损坏数据库）
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+    )
+    # 预编译语句缓存容量（sqlite3 按 SQL 文本缓存，所以语句写成固定常量）
+    STATEMENT_CACHE_SIZE = 64
+    # user_sessions 表结构，last_activity 为 Unix 时间戳（秒）
+    SESSIONS_TABLE_SQL = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            user_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            repo_url TEXT,
+            analysis_task_id TEXT,
+            question TEXT,
+            query_task_id TEXT,
+            session_id TEXT,
+            last_activity INTEGER NOT NULL,
+            adapter_key TEXT,
+            target_type TEXT,
+            target_id TEXT
+        )
+    """
+    # 在 user_sessions 建表之后新增的列，旧数据库启动时补齐
+    SESSION_MIGRATIONS = (
+        ("adapter_key", "TEXT"),
+        ("target_type", "TEXT"),
+        ("target_id", "TEXT"),
+    )
+    
+    def __init__(self, db_path: str = "repo_insight.db", cache_size_kb: int = 16384,
+                 mmap_size: int = 128 * 1024 * 1024, busy_timeout_ms: int = 5000):
         self.db_path = db_path
-        self.init_database()
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._conn: Optional[sqlite3.Connection] = None
+        # 长连接在线程间共享，所有语句在锁内串行执行
+        self._lock = threading.RLock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """打开并调优长连接"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=self.STATEMENT_CACHE_SIZE
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+    
+    def open(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+                try:
+                    self.init_database()
+                except Exception:
+                    # 初始化失败时不保留半初始化的连接，下次访问重新初始化
+                    self._conn.close()
+                    self._conn = None
+                    raise
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """获取长连接（首次使用时建立并初始化数据库）"""
+        if self._conn is None:
+            self.open()
+        return self._conn
     
     def init_database(self):
         """初始化数据库"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id TEXT PRIMARY KEY,
-                state TEXT NOT NULL,
-                repo_url TEXT,
-                analysis_task_id TEXT,
-                question TEXT,
-                query_task_id TEXT,
-                session_id TEXT,
-                last_activity TEXT NOT NULL
-            )
-        """)
-        conn.commit()
-        conn.close()
-    
-    def get_session(self, user_id: str) -> UserSession:
-        """获取用户会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_sessions WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # 清理后按需增量回收空闲页需要 auto_vacuum=INCREMENTAL，文件头已写入时须整体 VACUUM 一次才生效
+                logger.info("Enabling incremental auto-vacuum, rebuilding database file once")
+                self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self.conn.execute("VACUUM")
+            self.conn.execute(self.SESSIONS_TABLE_SQL.format(table="user_sessions"))
+            columns = {row[1]: row[2].upper() for row in self.conn.execute("PRAGMA table_info(user_sessions)")}
+            for column, column_type in self.SESSION_MIGRATIONS:
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE user_sessions ADD COLUMN {column} {column_type}")
+            if columns["last_activity"] != "INTEGER":
+                self._migrate_activity_to_epoch()
+            # 轮询按状态批量取会话，需要 state 上的索引避免全表扫描
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_sessions_state ON user_sessions (state, user_id)"
+            )
+            # 不活跃会话按 last_activity 范围分批清理
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_sessions_last_activity ON user_sessions (last_activity)"
+            )
+            # 已分析仓库登记表，按规范化仓库键跨用户复用分析结果
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS repo_analyses (
+                    repo_key TEXT PRIMARY KEY,
+                    repo_url TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    task_id TEXT,
+                    status TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    last_used_at INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_repo_analyses_session ON repo_analyses (session_id)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_repo_analyses_last_used ON repo_analyses (last_used_at)"
+            )
+            # 待回答问题队列：status 为 queued（排队）、submitting（提交中）或 running（已提交，有 query_task_id）
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    analysis_session_id TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    query_task_id TEXT,
+                    created_at INTEGER NOT NULL,
+                    claimed_at INTEGER
+                )
+            """)
+            if "claimed_at" not in {row[1] for row in self.conn.execute("PRAGMA table_info(pending_questions)")}:
+                self.conn.execute("ALTER TABLE pending_questions ADD COLUMN claimed_at INTEGER")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_questions_user ON pending_questions (user_id, status)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_questions_task ON pending_questions (query_task_id)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_questions_status ON pending_questions (status, id)"
+            )
+            # 在途任务租约：多个插件进程共享数据库时，每个任务只由持有未过期租约的进程轮询
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS task_leases (
+                    kind TEXT NOT NULL,
+                    task_key TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    PRIMARY KEY (kind, task_key)
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_task_leases_owner ON task_leases (owner)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_task_leases_expires ON task_leases (expires_at)"
+            )
+            # 旧版本每个用户只有一个在途问题、记录在会话上，迁移到问题队列
+            legacy = self.conn.execute(
+                "SELECT user_id, session_id, question, query_task_id FROM user_sessions "
+                "WHERE state = ? AND query_task_id IS NOT NULL",
+                (UserState.WAITING_FOR_ANSWER.value,)
+            ).fetchall()
+            self.conn.executemany(
+                "INSERT INTO pending_questions (user_id, analysis_session_id, question, status, query_task_id, created_at) "
+                "VALUES (?, ?, ?, 'running', ?, ?)",
+                [(user_id, session_id or '', question or '', task_id, int(time.time()))
+                 for user_id, session_id, question, task_id in legacy]
+            )
+            self.conn.execute(
+                "UPDATE user_sessions SET state = ?, question = NULL, query_task_id = NULL WHERE state = ?",
+                (UserState.READY_FOR_QUERY.value, UserState.WAITING_FOR_ANSWER.value)
+            )
+            # 答案缓存：按 (分析会话, 生成模式, 规范化问题) 精确命中，LSH 分桶表用于近似问题召回
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    analysis_session_id TEXT NOT NULL,
+                    generation_mode TEXT NOT NULL,
+                    normalized_question TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    last_hit_at INTEGER NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    UNIQUE (analysis_session_id, generation_mode, normalized_question)
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_answer_cache_last_hit ON answer_cache (last_hit_at)"
+            )
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_cache_bands (
+                    band_key INTEGER NOT NULL,
+                    entry_id INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_answer_cache_bands_key ON answer_cache_bands (band_key)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_answer_cache_bands_entry ON answer_cache_bands (entry_id)"
+            )
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_answer_cache_delete AFTER DELETE ON answer_cache
+                BEGIN
+                    DELETE FROM answer_cache_bands WHERE entry_id = OLD.id;
+                END
+            """)
+            self.conn.commit()
+    
+    def _migrate_activity_to_epoch(self):
+        """把 ISO-8601 文本的 last_activity 迁移为整数时间戳：SQLite 不能修改列类型，在一个事务内重建表"""
+        logger.info("Migrating user_sessions.last_activity to epoch seconds")
+        self.conn.commit()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("DROP TABLE IF EXISTS user_sessions_migrating")
+            self.conn.execute(self.SESSIONS_TABLE_SQL.format(table="user_sessions_migrating"))
+            # 旧值是本地时间；无法解析的值按当前时间处理
+            self.conn.execute(f"""
+                INSERT INTO user_sessions_migrating ({self.SESSION_COLUMNS})
+                SELECT user_id, state, repo_url, analysis_task_id, question, query_task_id, session_id,
+                       COALESCE(CAST(strftime('%s', last_activity, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+                       adapter_key, target_type, target_id
+                FROM user_sessions
+            """)
+            self.conn.execute("DROP TABLE user_sessions")
+            self.conn.execute("ALTER TABLE user_sessions_migrating RENAME TO user_sessions")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+    
+    def load_session(self, user_id: str) -> Optional[tuple]:
+        with self._lock:
+            return self.conn.execute(
+                f"SELECT {self.SESSION_COLUMNS} FROM user_sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+    
+    def write_sessions(self, rows: List[tuple]):
+        with self._lock:
+            try:
+                self.conn.executemany("""
+                    INSERT OR REPLACE INTO user_sessions
+                    (user_id, state, repo_url, analysis_task_id, question, query_task_id, session_id, last_activity,
+                     adapter_key, target_type, target_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+    
+    def sessions_page(self, state: str, after_user_id: str, batch_size: int) -> List[tuple]:
+        # 基于 (state, user_id) 索引的键集分页
+        with self._lock:
+            return self.conn.execute(
+                f"SELECT {self.SESSION_COLUMNS} FROM user_sessions "
+                "WHERE state = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                (state, after_user_id, batch_size)
+            ).fetchall()
+    
+    def sessions_by_task(self, state: str, column: str, task_key: str) -> List[tuple]:
+        if column not in ("session_id", "query_task_id"):
+            raise ValueError(f"Unsupported task column: {column}")
+        with self._lock:
+            return self.conn.execute(
+                f"SELECT {self.SESSION_COLUMNS} FROM user_sessions WHERE state = ? AND {column} = ?",
+                (state, task_key)
+            ).fetchall()
+    
+    def expire_sessions(self, cutoff: int, batch_size: int) -> int:
+        # 走 last_activity 索引，每批一个短事务
+        with self._lock:
+            user_ids = self.conn.execute(
+                "SELECT user_id FROM user_sessions WHERE last_activity < ? LIMIT ?", (cutoff, batch_size)
+            ).fetchall()
+            if not user_ids:
+                return 0
+            self.conn.executemany("DELETE FROM user_sessions WHERE user_id = ?", user_ids)
+            self.conn.executemany("DELETE FROM pending_questions WHERE user_id = ?", user_ids)
+            self.conn.commit()
+        return len(user_ids)
+    
+    def get_repo_analysis(self, repo_key: str, ttl_seconds: float) -> Optional[Dict]:
+        """读取仓库分析登记，过期记录视为不存在"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT repo_key, repo_url, session_id, task_id, status, created_at "
+                "FROM repo_analyses WHERE repo_key = ? AND created_at >= ?",
+                (repo_key, int(time.time() - ttl_seconds))
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE repo_analyses SET last_used_at = ? WHERE repo_key = ?", (int(time.time()), repo_key)
+            )
+            self.conn.commit()
+        return {
+            'repo_key': row[0], 'repo_url': row[1], 'session_id': row[2],
+            'task_id': row[3], 'status': row[4], 'created_at': row[5]
+        }
+    
+    def put_repo_analysis(self, repo_key: str, repo_url: str, session_id: str, task_id: Optional[str],
+                          status: str, ttl_seconds: float, max_entries: int):
+        """登记仓库分析，并按 TTL 与 LRU 淘汰旧记录"""
+        now = int(time.time())
+        with self._lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO repo_analyses
+                (repo_key, repo_url, session_id, task_id, status, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (repo_key, repo_url, session_id, task_id, status, now, now))
+            self.conn.execute("DELETE FROM repo_analyses WHERE created_at < ?", (int(now - ttl_seconds),))
+            self.conn.execute("""
+                DELETE FROM repo_analyses WHERE repo_key IN (
+                    SELECT repo_key FROM repo_analyses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
+            self.conn.commit()
+    
+    def update_repo_analysis_status(self, session_id: str, status: Optional[str]):
+        """更新分析登记状态，status 为 None 时删除登记"""
+        with self._lock:
+            if status is None:
+                self.conn.execute("DELETE FROM repo_analyses WHERE session_id = ?", (session_id,))
+            else:
+                self.conn.execute(
+                    "UPDATE repo_analyses SET status = ?, last_used_at = ? WHERE session_id = ?",
+                    (status, int(time.time()), session_id)
+                )
+            self.conn.commit()
+    
+    def enqueue_question(self, user_id: str, analysis_session_id: str, question: str,
+                         max_pending: int) -> Optional[tuple]:
+        """把问题加入用户的待回答队列，返回 (问题ID, 前面未答复的问题数)；队列已满时返回 None"""
+        with self._lock:
+            ahead = self.conn.execute(
+                "SELECT COUNT(*) FROM pending_questions WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+            if ahead >= max_pending:
+                return None
+            cursor = self.conn.execute(
+                "INSERT INTO pending_questions (user_id, analysis_session_id, question, status, created_at) "
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (user_id, analysis_session_id, question, int(time.time()))
+            )
+            self.conn.commit()
+        return cursor.lastrowid, ahead
+    
+    def claim_questions(self, per_user_limit: int, global_limit: int,
+                        user_id: Optional[str] = None) -> List[tuple]:
+        """按提问顺序领取可以提交的问题（不超过每用户与全局并发上限），返回 [(问题ID, user_id, 分析会话ID, 问题)]；
+        给出 user_id 时只领取该用户的问题"""
+        with self._lock:
+            # 立即获取写锁，多个进程同时领取时不会重复提交同一个问题
+            self.conn.commit()
+            self.conn.execute("BEGIN IMMEDIATE")
+            now = int(time.time())
+            self.conn.execute(
+                "UPDATE pending_questions SET status = 'queued' "
+                "WHERE status = 'submitting' AND COALESCE(claimed_at, 0) < ?",
+                (now - self.SUBMIT_STALE_SECONDS,)
+            )
+            active = dict(self.conn.execute(
+                "SELECT user_id, COUNT(*) FROM pending_questions WHERE status != 'queued' GROUP BY user_id"
+            ).fetchall())
+            slots = global_limit - sum(active.values())
+            claimed = []
+            if slots <= 0:
+                self.conn.commit()
+                return claimed
+            if user_id is None:
+                rows = self.conn.execute(
+                    "SELECT id, user_id, analysis_session_id, question FROM pending_questions "
+                    "WHERE status = 'queued' ORDER BY id"
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT id, user_id, analysis_session_id, question FROM pending_questions "
+                    "WHERE status = 'queued' AND user_id = ? ORDER BY id", (user_id,)
+                ).fetchall()
+            for row in rows:
+                if active.get(row[1], 0) >= per_user_limit:
+                    continue
+                active[row[1]] = active.get(row[1], 0) + 1
+                claimed.append(row)
+                if len(claimed) >= slots:
+                    break
+            if claimed:
+                self.conn.executemany(
+                    "UPDATE pending_questions SET status = 'submitting', claimed_at = ? WHERE id = ?",
+                    [(now, row[0]) for row in claimed]
+                )
+            self.conn.commit()
+        return claimed
+    
+    def mark_question_running(self, question_id: int, query_task_id: str) -> bool:
+        """记录问题的查询任务；问题已被撤回时返回 False"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE pending_questions SET status = 'running', query_task_id = ? WHERE id = ?",
+                (query_task_id, question_id)
+            )
+            self.conn.commit()
+        return cursor.rowcount > 0
+    
+    def drop_question(self, question_id: int):
+        with self._lock:
+            self.conn.execute("DELETE FROM pending_questions WHERE id = ?", (question_id,))
+            self.conn.commit()
+    
+    def get_question_by_task(self, query_task_id: str) -> Optional[tuple]:
+        """按查询任务查找问题，返回 (问题ID, user_id, 分析会话ID, 问题)"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, user_id, analysis_session_id, question FROM pending_questions WHERE query_task_id = ?",
+                (query_task_id,)
+            ).fetchone()
+    
+    def take_question(self, query_task_id: str) -> Optional[tuple]:
+        """取出并删除已结束的问题；轮询、推送与流式收尾并发（包括多个进程）时只有删除成功的一方能取到"""
+        with self._lock:
+            row = self.get_question_by_task(query_task_id)
+            if row is None:
+                return None
+            cursor = self.conn.execute("DELETE FROM pending_questions WHERE id = ?", (row[0],))
+            self.conn.commit()
+        return row if cursor.rowcount else None
+    
+    def running_questions(self) -> List[tuple]:
+        """所有已提交、等待答案的问题，返回 [(user_id, query_task_id)]"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT user_id, query_task_id FROM pending_questions WHERE status = 'running'"
+            ).fetchall()
+    
+    def count_questions(self, user_id: str) -> tuple:
+        """返回用户 (处理中, 排队中) 的问题数"""
+        with self._lock:
+            queued, total = self.conn.execute(
+                "SELECT COALESCE(SUM(status = 'queued'), 0), COUNT(*) FROM pending_questions WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+        return total - queued, queued
+    
+    def clear_questions(self, user_id: str) -> int:
+        """撤回用户所有未答复的问题，已提交的查询结果到达后直接丢弃"""
+        with self._lock:
+            cursor = self.conn.execute("DELETE FROM pending_questions WHERE user_id = ?", (user_id,))
+            self.conn.commit()
+        return cursor.rowcount
+    
+    def claim_leases(self, tasks: List[tuple], owner: str, ttl_seconds: float) -> List[tuple]:
+        """为 [(kind, task_key, user_id)] 申请租约：无人持有、已过期或本进程持有时成功，返回成功的任务"""
+        now = int(time.time())
+        claimed = []
+        with self._lock:
+            for kind, task_key, user_id in tasks:
+                cursor = self.conn.execute("""
+                    INSERT INTO task_leases (kind, task_key, user_id, owner, expires_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (kind, task_key) DO UPDATE
+                    SET owner = excluded.owner, user_id = excluded.user_id, expires_at = excluded.expires_at
+                    WHERE task_leases.owner = excluded.owner OR task_leases.expires_at < ?
+                """, (kind, task_key, user_id, owner, int(now + ttl_seconds), now))
+                if cursor.rowcount:
+                    claimed.append((kind, task_key, user_id))
+            self.conn.commit()
+        return claimed
+    
+    def take_over_expired_leases(self, owner: str, ttl_seconds: float, limit: int = 200) -> List[tuple]:
+        """接管持有者已失联（租约过期）的任务，返回 [(kind, task_key, user_id)]"""
+        now = int(time.time())
+        with self._lock:
+            self.conn.commit()
+            self.conn.execute("BEGIN IMMEDIATE")
+            rows = self.conn.execute(
+                "SELECT kind, task_key, user_id FROM task_leases WHERE expires_at < ? LIMIT ?", (now, limit)
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE task_leases SET owner = ?, expires_at = ? WHERE kind = ? AND task_key = ?",
+                [(owner, int(now + ttl_seconds), kind, task_key) for kind, task_key, _ in rows]
+            )
+            self.conn.commit()
+        return rows
+    
+    def renew_leases(self, owner: str, ttl_seconds: float) -> set:
+        """续期本进程持有的全部租约，返回仍持有的 {(kind, task_key)}"""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE task_leases SET expires_at = ? WHERE owner = ?", (int(time.time() + ttl_seconds), owner)
+            )
+            self.conn.commit()
+            return set(self.conn.execute(
+                "SELECT kind, task_key FROM task_leases WHERE owner = ?", (owner,)
+            ).fetchall())
+    
+    def release_leases(self, owner: str, keys: Optional[List[tuple]] = None):
+        """释放本进程持有的租约，keys 为 None 时释放全部"""
+        with self._lock:
+            if keys is None:
+                self.conn.execute("DELETE FROM task_leases WHERE owner = ?", (owner,))
+            else:
+                self.conn.executemany(
+                    "DELETE FROM task_leases WHERE kind = ? AND task_key = ? AND owner = ?",
+                    [(kind, task_key, owner) for kind, task_key in keys]
+                )
+            self.conn.commit()
+    
+    def get_cached_answer(self, analysis_session_id: str, generation_mode: str,
+                          normalized_question: str, max_age_seconds: float) -> Optional[tuple]:
+        """精确查找缓存答案，返回 (id, answer)"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, answer FROM answer_cache WHERE analysis_session_id = ? AND generation_mode = ? "
+                "AND normalized_question = ? AND created_at >= ?",
+                (analysis_session_id, generation_mode, normalized_question, int(time.time() - max_age_seconds))
+            ).fetchone()
+    
+    def find_answer_candidates(self, band_keys: List[int], max_age_seconds: float) -> List[tuple]:
+        """按 LSH 分桶召回候选答案，返回 [(id, normalized_question, signature, answer)]"""
+        placeholders = ",".join("?" * len(band_keys))
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, normalized_question, signature, answer FROM answer_cache "
+                "WHERE created_at >= ? AND id IN ("
+                f"SELECT DISTINCT entry_id FROM answer_cache_bands WHERE band_key IN ({placeholders}))",
+                (int(time.time() - max_age_seconds), *band_keys)
+            ).fetchall()
+    
+    def record_answer_hit(self, entry_id: int):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE answer_cache SET hits = hits + 1, last_hit_at = ? WHERE id = ?",
+                (int(time.time()), entry_id)
+            )
+            self.conn.commit()
+    
+    def put_cached_answer(self, analysis_session_id: str, generation_mode: str, normalized_question: str,
+                          signature: bytes, band_keys: List[int], answer: str,
+                          max_entries: int, max_bytes: int, max_age_seconds: float):
+        """写入缓存答案，并按年龄、条数与总字节数淘汰最久未命中的条目"""
+        now = int(time.time())
+        size = len(answer.encode('utf-8'))
+        with self._lock:
+            self.conn.execute("""
+                INSERT INTO answer_cache
+                (analysis_session_id, generation_mode, normalized_question, signature, answer, size, created_at, last_hit_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (analysis_session_id, generation_mode, normalized_question)
+                DO UPDATE SET answer = excluded.answer, size = excluded.size, created_at = excluded.created_at
+            """, (analysis_session_id, generation_mode, normalized_question, signature, answer, size, now, now))
+            entry_id = self.conn.execute(
+                "SELECT id FROM answer_cache WHERE analysis_session_id = ? AND generation_mode = ? "
+                "AND normalized_question = ?",
+                (analysis_session_id, generation_mode, normalized_question)
+            ).fetchone()[0]
+            self.conn.execute("DELETE FROM answer_cache_bands WHERE entry_id = ?", (entry_id,))
+            self.conn.executemany(
+                "INSERT INTO answer_cache_bands (band_key, entry_id) VALUES (?, ?)",
+                [(band_key, entry_id) for band_key in band_keys]
+            )
+            self.conn.execute("DELETE FROM answer_cache WHERE created_at < ?", (int(now - max_age_seconds),))
+            count, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answer_cache").fetchone()
+            while count > max_entries or total > max_bytes:
+                # 每次淘汰一小批最久未命中的条目，直到满足上限
+                batch = max(1, min(count - max_entries, 100)) if count > max_entries else 20
+                self.conn.execute(
+                    "DELETE FROM answer_cache WHERE id IN "
+                    "(SELECT id FROM answer_cache ORDER BY last_hit_at LIMIT ?)", (batch,)
+                )
+                count, total = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answer_cache"
+                ).fetchone()
+            self.conn.commit()
+    
+    def count_active_questions(self) -> int:
+        """已领取（提交中或已提交）的问题数，分片存储据此分配全局并发名额"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM pending_questions WHERE status != 'queued'"
+            ).fetchone()[0]
+    
+    def reclaim_space(self, max_pages: int = 1000) -> int:
+        """归还至多 max_pages 个空闲页给文件系统（需要 auto_vacuum=INCREMENTAL），返回剩余的空闲页数"""
+        with self._lock:
+            self.conn.commit()
+            self.conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+            return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
+    def checkpoint(self) -> tuple:
+        """把 WAL 写回主库并截断 WAL 文件"""
+        with self._lock:
+            self.conn.commit()
+            return tuple(self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone())
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+class MemoryBackend(StateBackend):
+    """进程内存储：不落盘、无文件锁，适合临时部署与离线测试，进程退出后状态全部丢失"""
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sessions: Dict[str, tuple] = {}
+        # 问题 ID -> [ID, user_id, 分析会话ID, 问题, status, query_task_id, created_at, claimed_at]，按 ID 递增有序
+        self._questions: "OrderedDict[int, list]" = OrderedDict()
+        self._question_ids = itertools.count(1)
+        # (kind, task_key) -> [user_id, owner, expires_at]
+        self._leases: Dict[tuple, list] = {}
+        self._repo_analyses: Dict[str, Dict] = {}
+        # 答案条目 ID -> 条目；(分析会话, 生成模式, 规范化问题) -> 条目 ID；分桶键 -> 条目 ID 集合
+        self._answers: Dict[int, Dict] = {}
+        self._answer_keys: Dict[tuple, int] = {}
+        self._bands: Dict[int, set] = {}
+        self._answer_ids = itertools.count(1)
+    
+    # ---- 会话 ----
+    
+    def load_session(self, user_id: str) -> Optional[tuple]:
+        return self._sessions.get(user_id)
+    
+    def write_sessions(self, rows: List[tuple]):
+        with self._lock:
+            for row in rows:
+                self._sessions[row[0]] = row
+    
+    def sessions_page(self, state: str, after_user_id: str, batch_size: int) -> List[tuple]:
+        with self._lock:
+            return heapq.nsmallest(
+                batch_size,
+                (row for row in self._sessions.values() if row[1] == state and row[0] > after_user_id)
+            )
+    
+    def sessions_by_task(self, state: str, column: str, task_key: str) -> List[tuple]:
+        index = 6 if column == "session_id" else 5
+        with self._lock:
+            return [row for row in self._sessions.values() if row[1] == state and row[index] == task_key]
+    
+    def expire_sessions(self, cutoff: int, batch_size: int) -> int:
+        with self._lock:
+            user_ids = set(itertools.islice(
+                (user_id for user_id, row in self._sessions.items() if row[7] < cutoff), batch_size
+            ))
+            for user_id in user_ids:
+                del self._sessions[user_id]
+            for question_id in [qid for qid, q in self._questions.items() if q[1] in user_ids]:
+                del self._questions[question_id]
+        return len(user_ids)
+    
+    # ---- 仓库分析登记 ----
+    
+    def get_repo_analysis(self, repo_key: str, ttl_seconds: float) -> Optional[Dict]:
+        with self._lock:
+            record = self._repo_analyses.get(repo_key)
+            if record is None or record['created_at'] < int(time.time() - ttl_seconds):
+                return None
+            record['last_used_at'] = int(time.time())
+            return {key: value for key, value in record.items() if key != 'last_used_at'}
+    
+    def put_repo_analysis(self, repo_key: str, repo_url: str, session_id: str, task_id: Optional[str],
+                          status: str, ttl_seconds: float, max_entries: int):
+        now = int(time.time())
+        with self._lock:
+            self._repo_analyses[repo_key] = {
+                'repo_key': repo_key, 'repo_url': repo_url, 'session_id': session_id, 'task_id': task_id,
+                'status': status, 'created_at': now, 'last_used_at': now
+            }
+            records = sorted(self._repo_analyses.values(), key=lambda record: record['last_used_at'], reverse=True)
+            for index, record in enumerate(records):
+                if index >= max_entries or record['created_at'] < int(now - ttl_seconds):
+                    del self._repo_analyses[record['repo_key']]
+    
+    def update_repo_analysis_status(self, session_id: str, status: Optional[str]):
+        with self._lock:
+            for record in [record for record in self._repo_analyses.values() if record['session_id'] == session_id]:
+                if status is None:
+                    del self._repo_analyses[record['repo_key']]
+                else:
+                    record['status'] = status
+                    record['last_used_at'] = int(time.time())
+    
+    # ---- 问题队列 ----
+    
+    def enqueue_question(self, user_id: str, analysis_session_id: str, question: str,
+                         max_pending: int) -> Optional[tuple]:
+        with self._lock:
+            ahead = sum(1 for q in self._questions.values() if q[1] == user_id)
+            if ahead >= max_pending:
+                return None
+            question_id = next(self._question_ids)
+            self._questions[question_id] = [
+                question_id, user_id, analysis_session_id, question, 'queued', None, int(time.time()), None
+            ]
+        return question_id, ahead
+    
+    def claim_questions(self, per_user_limit: int, global_limit: int,
+                        user_id: Optional[str] = None) -> List[tuple]:
+        now = int(time.time())
+        with self._lock:
+            active = {}
+            for q in self._questions.values():
+                if q[4] == 'submitting' and (q[7] or 0) < now - self.SUBMIT_STALE_SECONDS:
+                    q[4] = 'queued'
+                elif q[4] != 'queued':
+                    active[q[1]] = active.get(q[1], 0) + 1
+            slots = global_limit - sum(active.values())
+            claimed = []
+            for q in self._questions.values():
+                if len(claimed) >= slots:
+                    break
+                if q[4] != 'queued' or active.get(q[1], 0) >= per_user_limit or user_id not in (None, q[1]):
+                    continue
+                active[q[1]] = active.get(q[1], 0) + 1
+                q[4], q[7] = 'submitting', now
+                claimed.append(tuple(q[:4]))
+        return claimed
+    
+    def mark_question_running(self, question_id: int, query_task_id: str) -> bool:
+        with self._lock:
+            q = self._questions.get(question_id)
+            if q is None:
+                return False
+            q[4], q[5] = 'running', query_task_id
+            return True
+    
+    def drop_question(self, question_id: int):
+        with self._lock:
+            self._questions.pop(question_id, None)
+    
+    def get_question_by_task(self, query_task_id: str) -> Optional[tuple]:
+        with self._lock:
+            for q in self._questions.values():
+                if q[5] == query_task_id:
+                    return tuple(q[:4])
+        return None
+    
+    def take_question(self, query_task_id: str) -> Optional[tuple]:
+        with self._lock:
+            row = self.get_question_by_task(query_task_id)
+            if row is not None:
+                del self._questions[row[0]]
+        return row
+    
+    def running_questions(self) -> List[tuple]:
+        with self._lock:
+            return [(q[1], q[5]) for q in self._questions.values() if q[4] == 'running']
+    
+    def count_questions(self, user_id: str) -> tuple:
+        with self._lock:
+            statuses = [q[4] for q in self._questions.values() if q[1] == user_id]
+        queued = statuses.count('queued')
+        return len(statuses) - queued, queued
+    
+    def clear_questions(self, user_id: str) -> int:
+        with self._lock:
+            question_ids = [qid for qid, q in self._questions.items() if q[1] == user_id]
+            for question_id in question_ids:
+                del self._questions[question_id]
+        return len(question_ids)
+    
+    def count_active_questions(self) -> int:
+        with self._lock:
+            return sum(1 for q in self._questions.values() if q[4] != 'queued')
+    
+    # ---- 任务租约（单进程内只有一个持有者，保留语义以便与调度器对接） ----
+    
+    def claim_leases(self, tasks: List[tuple], owner: str, ttl_seconds: float) -> List[tuple]:
+        now = int(time.time())
+        claimed = []
+        with self._lock:
+            for kind, task_key, user_id in tasks:
+                lease = self._leases.get((kind, task_key))
+                if lease is None or lease[1] == owner or lease[2] < now:
+                    self._leases[(kind, task_key)] = [user_id, owner, int(now + ttl_seconds)]
+                    claimed.append((kind, task_key, user_id))
+        return claimed
+    
+    def take_over_expired_leases(self, owner: str, ttl_seconds: float, limit: int = 200) -> List[tuple]:
+        now = int(time.time())
+        with self._lock:
+            expired = [key for key, lease in self._leases.items() if lease[2] < now][:limit]
+            for key in expired:
+                self._leases[key][1:] = [owner, int(now + ttl_seconds)]
+            return [(kind, task_key, self._leases[(kind, task_key)][0]) for kind, task_key in expired]
+    
+    def renew_leases(self, owner: str, ttl_seconds: float) -> set:
+        expires_at = int(time.time() + ttl_seconds)
+        with self._lock:
+            held = {key for key, lease in self._leases.items() if lease[1] == owner}
+            for key in held:
+                self._leases[key][2] = expires_at
+        return held
+    
+    def release_leases(self, owner: str, keys: Optional[List[tuple]] = None):
+        with self._lock:
+            for key in list(self._leases) if keys is None else keys:
+                lease = self._leases.get(tuple(key))
+                if lease is not None and lease[1] == owner:
+                    del self._leases[tuple(key)]
+    
+    # ---- 答案缓存 ----
+    
+    def get_cached_answer(self, analysis_session_id: str, generation_mode: str,
+                          normalized_question: str, max_age_seconds: float) -> Optional[tuple]:
+        with self._lock:
+            entry_id = self._answer_keys.get((analysis_session_id, generation_mode, normalized_question))
+            entry = self._answers.get(entry_id)
+            if entry is None or entry['created_at'] < int(time.time() - max_age_seconds):
+                return None
+            return entry_id, entry['answer']
+    
+    def find_answer_candidates(self, band_keys: List[int], max_age_seconds: float) -> List[tuple]:
+        oldest = int(time.time() - max_age_seconds)
+        with self._lock:
+            entry_ids = set().union(*(self._bands.get(band_key, ()) for band_key in band_keys))
+            entries = ((entry_id, self._answers[entry_id]) for entry_id in entry_ids)
+            return [(entry_id, entry['key'][2], entry['signature'], entry['answer'])
+                    for entry_id, entry in entries if entry['created_at'] >= oldest]
+    
+    def record_answer_hit(self, entry_id: int):
+        with self._lock:
+            entry = self._answers.get(entry_id)
+            if entry is not None:
+                entry['hits'] += 1
+                entry['last_hit_at'] = int(time.time())
+    
+    def put_cached_answer(self, analysis_session_id: str, generation_mode: str, normalized_question: str,
+                          signature: bytes, band_keys: List[int], answer: str,
+                          max_entries: int, max_bytes: int, max_age_seconds: float):
+        now = int(time.time())
+        key = (analysis_session_id, generation_mode, normalized_question)
+        with self._lock:
+            entry_id = self._answer_keys.get(key)
+            if entry_id is None:
+                entry_id = next(self._answer_ids)
+                self._answer_keys[key] = entry_id
+                self._answers[entry_id] = {'key': key, 'last_hit_at': now, 'hits': 0, 'band_keys': []}
+            else:
+                self._unlink_bands(entry_id)
+            entry = self._answers[entry_id]
+            entry.update(signature=signature, answer=answer, size=len(answer.encode('utf-8')),
+                         created_at=now, band_keys=list(band_keys))
+            for band_key in band_keys:
+                self._bands.setdefault(band_key, set()).add(entry_id)
+            for stale_id in [eid for eid, e in self._answers.items() if e['created_at'] < int(now - max_age_seconds)]:
+                self._drop_answer(stale_id)
+            total = sum(e['size'] for e in self._answers.values())
+            if len(self._answers) > max_entries or total > max_bytes:
+                # 按最久未命中的顺序淘汰，直到满足上限
+                for victim_id in sorted(self._answers, key=lambda eid: self._answers[eid]['last_hit_at']):
+                    if len(self._answers) <= max_entries and total <= max_bytes:
+                        break
+                    total -= self._answers[victim_id]['size']
+                    self._drop_answer(victim_id)
+    
+    def _unlink_bands(self, entry_id: int):
+        for band_key in self._answers[entry_id]['band_keys']:
+            members = self._bands.get(band_key)
+            if members is not None:
+                members.discard(entry_id)
+                if not members:
+                    del self._bands[band_key]
+    
+    def _drop_answer(self, entry_id: int):
+        self._unlink_bands(entry_id)
+        entry = self._answers.pop(entry_id)
+        del self._answer_keys[entry['key']]
+
+class ShardedSQLiteBackend(StateBackend):
+    """按 user_id 哈希分片到多个 SQLite 文件：会话与问题队列分散到各分片，写锁与 fsync 互不阻塞；
+    仓库登记、答案缓存与任务租约不属于单个用户，放在 0 号分片"""
+    
+    def __init__(self, db_path: str = "repo_insight.db", shards: int = 4, **sqlite_options):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        root, ext = os.path.splitext(db_path)
+        self.paths = [f"{root}.shard{index}{ext or '.db'}" for index in range(shards)]
+        self._shards = [SQLiteBackend(path, **sqlite_options) for path in self.paths]
+        # 跨分片的批量写入与清理并行执行，各分片在自己的锁内提交
+        self._pool = ThreadPoolExecutor(max_workers=shards, thread_name_prefix="repoinsight-shard")
+        # 领取问题时轮换起始分片，全局名额紧张时各分片的用户轮流获得
+        self._claim_start = 0
+    
+    def _index(self, user_id: str) -> int:
+        # crc32 在不同进程间稳定（内置 hash 按进程随机化）
+        return zlib.crc32(user_id.encode('utf-8')) % len(self._shards)
+    
+    def _shard(self, user_id: str) -> SQLiteBackend:
+        return self._shards[self._index(user_id)]
+    
+    @property
+    def _global(self) -> SQLiteBackend:
+        return self._shards[0]
+    
+    def _fan_out(self, fn, items: Dict[int, Any]) -> list:
+        """对每个 {分片序号: 参数} 并行调用 fn(分片, 参数)，只有一个分片时直接调用"""
+        if len(items) == 1:
+            (index, arg), = items.items()
+            return [fn(self._shards[index], arg)]
+        return list(self._pool.map(lambda item: fn(self._shards[item[0]], item[1]), items.items()))
+    
+    # 各分片的问题 ID 独立自增，对外编码为 本地ID × 分片数 + 分片序号
+    def _encode(self, index: int, row: Optional[tuple]) -> Optional[tuple]:
+        return None if row is None else (row[0] * len(self._shards) + index, *row[1:])
+    
+    def _decode(self, question_id: int) -> tuple:
+        return self._shards[question_id % len(self._shards)], question_id // len(self._shards)
+    
+    def open(self):
+        self._fan_out(lambda shard, _: shard.open(), dict.fromkeys(range(len(self._shards))))
+    
+    # ---- 会话 ----
+    
+    def load_session(self, user_id: str) -> Optional[tuple]:
+        return self._shard(user_id).load_session(user_id)
+    
+    def write_sessions(self, rows: List[tuple]):
+        groups: Dict[int, list] = {}
+        for row in rows:
+            groups.setdefault(self._index(row[0]), []).append(row)
+        if groups:
+            self._fan_out(lambda shard, group: shard.write_sessions(group), groups)
+    
+    def sessions_page(self, state: str, after_user_id: str, batch_size: int) -> List[tuple]:
+        # 每个分片各取一页后归并，保持全局 user_id 顺序，键集分页在分片间依然成立
+        pages = [shard.sessions_page(state, after_user_id, batch_size) for shard in self._shards]
+        return list(itertools.islice(heapq.merge(*pages), batch_size))
+    
+    def sessions_by_task(self, state: str, column: str, task_key: str) -> List[tuple]:
+        return [row for shard in self._shards for row in shard.sessions_by_task(state, column, task_key)]
+    
+    def expire_sessions(self, cutoff: int, batch_size: int) -> int:
+        return sum(self._fan_out(
+            lambda shard, _: shard.expire_sessions(cutoff, batch_size), dict.fromkeys(range(len(self._shards)))
+        ))
+    
+    # ---- 仓库分析登记 ----
+    
+    def get_repo_analysis(self, repo_key: str, ttl_seconds: float) -> Optional[Dict]:
+        return self._global.get_repo_analysis(repo_key, ttl_seconds)
+    
+    def put_repo_analysis(self, repo_key: str, repo_url: str, session_id: str, task_id: Optional[str],
+                          status: str, ttl_seconds: float, max_entries: int):
+        self._global.put_repo_analysis(repo_key, repo_url, session_id, task_id, status, ttl_seconds, max_entries)
+    
+    def update_repo_analysis_status(self, session_id: str, status: Optional[str]):
+        self._global.update_repo_analysis_status(session_id, status)
+    
+    # ---- 问题队列 ----
+    
+    def enqueue_question(self, user_id: str, analysis_session_id: str, question: str,
+                         max_pending: int) -> Optional[tuple]:
+        index = self._index(user_id)
+        result = self._shards[index].enqueue_question(user_id, analysis_session_id, question, max_pending)
+        return None if result is None else (result[0] * len(self._shards) + index, result[1])
+    
+    def claim_questions(self, per_user_limit: int, global_limit: int,
+                        user_id: Optional[str] = None) -> List[tuple]:
+        # 同一用户的问题都在一个分片内，每用户上限由分片保证；全局上限按各分片已领取数分配剩余名额
+        active = [shard.count_active_questions() for shard in self._shards]
+        slots = global_limit - sum(active)
+        claimed = []
+        count = len(self._shards)
+        if user_id is not None:
+            indexes = [self._index(user_id)]
+        else:
+            self._claim_start = (self._claim_start + 1) % count
+            indexes = [(self._claim_start + offset) % count for offset in range(count)]
+        for index in indexes:
+            if slots <= 0:
+                break
+            rows = self._shards[index].claim_questions(per_user_limit, active[index] + slots, user_id)
+            slots -= len(rows)
+            claimed.extend(self._encode(index, row) for row in rows)
+        return claimed
+    
+    def mark_question_running(self, question_id: int, query_task_id: str) -> bool:
+        shard, local_id = self._decode(question_id)
+        return shard.mark_question_running(local_id, query_task_id)
+    
+    def drop_question(self, question_id: int):
+        shard, local_id = self._decode(question_id)
+        shard.drop_question(local_id)
+    
+    def get_question_by_task(self, query_task_id: str) -> Optional[tuple]:
+        for index, shard in enumerate(self._shards):
+            row = shard.get_question_by_task(query_task_id)
+            if row is not None:
+                return self._encode(index, row)
+        return None
+    
+    def take_question(self, query_task_id: str) -> Optional[tuple]:
+        for index, shard in enumerate(self._shards):
+            row = shard.take_question(query_task_id)
+            if row is not None:
+                return self._encode(index, row)
+        return None
+    
+    def running_questions(self) -> List[tuple]:
+        return [row for shard in self._shards for row in shard.running_questions()]
+    
+    def count_questions(self, user_id: str) -> tuple:
+        return self._shard(user_id).count_questions(user_id)
+    
+    def clear_questions(self, user_id: str) -> int:
+        return self._shard(user_id).clear_questions(user_id)
+    
+    def count_active_questions(self) -> int:
+        return sum(shard.count_active_questions() for shard in self._shards)
+    
+    # ---- 任务租约 ----
+    
+    def claim_leases(self, tasks: List[tuple], owner: str, ttl_seconds: float) -> List[tuple]:
+        return self._global.claim_leases(tasks, owner, ttl_seconds)
+    
+    def take_over_expired_leases(self, owner: str, ttl_seconds: float, limit: int = 200) -> List[tuple]:
+        return self._global.take_over_expired_leases(owner, ttl_seconds, limit)
+    
+    def renew_leases(self, owner: str, ttl_seconds: float) -> set:
+        return self._global.renew_leases(owner, ttl_seconds)
+    
+    def release_leases(self, owner: str, keys: Optional[List[tuple]] = None):
+        self._global.release_leases(owner, keys)
+    
+    # ---- 答案缓存 ----
+    
+    def get_cached_answer(self, analysis_session_id: str, generation_mode: str,
+                          normalized_question: str, max_age_seconds: float) -> Optional[tuple]:
+        return self._global.get_cached_answer(analysis_session_id, generation_mode, normalized_question,
+                                              max_age_seconds)
+    
+    def find_answer_candidates(self, band_keys: List[int], max_age_seconds: float) -> List[tuple]:
+        return self._global.find_answer_candidates(band_keys, max_age_seconds)
+    
+    def record_answer_hit(self, entry_id: int):
+        self._global.record_answer_hit(entry_id)
+    
+    def put_cached_answer(self, analysis_session_id: str, generation_mode: str, normalized_question: str,
+                          signature: bytes, band_keys: List[int], answer: str,
+                          max_entries: int, max_bytes: int, max_age_seconds: float):
+        self._global.put_cached_answer(analysis_session_id, generation_mode, normalized_question, signature,
+                                       band_keys, answer, max_entries, max_bytes, max_age_seconds)
+    
+    # ---- 维护 ----
+    
+    def reclaim_space(self, max_pages: int = 1000) -> int:
+        return sum(shard.reclaim_space(max_pages) for shard in self._shards)
+    
+    def checkpoint(self) -> tuple:
+        results = [shard.checkpoint() for shard in self._shards]
+        return tuple(sum(values) for values in zip(*results))
+    
+    def close(self):
+        for shard in self._shards:
+            shard.close()
+        self._pool.shutdown(wait=False)
+
+def create_state_backend(kind: str, db_path: str, shards: int = 4) -> StateBackend:
+    """按配置创建状态存储后端：sqlite（默认，单文件）、memory（不落盘）或 sharded_sqlite（按用户分片的多文件）"""
+    kind = (kind or "sqlite").lower()
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sharded_sqlite":
+        return ShardedSQLiteBackend(db_path, shards=shards)
+    if kind != "sqlite":
+        logger.warning(f"Unknown state backend '{kind}', falling back to sqlite")
+    return SQLiteBackend(db_path)
+
+# 状态管理器
+class StateManager:
+    """会话缓存、写后缓冲、用户锁与专用数据库线程；持久化交给可替换的 StateBackend"""
+    
+    def __init__(self, db_path: str = "repo_insight.db", cache_size_kb: int = 16384,
+                 mmap_size: int = 128 * 1024 * 1024, busy_timeout_ms: int = 5000,
+                 session_cache_size: int = 10000, session_cache_ttl: float = 300,
+                 touch_interval: float = 60, flush_interval_ms: float = 200, flush_batch_size: int = 500,
+                 backend: Optional[StateBackend] = None):
+        self.db_path = db_path
+        # 未指定后端时使用单文件 SQLite
+        self.backend = backend or SQLiteBackend(db_path, cache_size_kb, mmap_size, busy_timeout_ms)
+        # 字段未变化时，last_activity 至少前进这么多秒才写回（清理阈值以小时计，无需逐条落盘）
+        self.touch_interval = touch_interval
+        self.cache = SessionCache(session_cache_size, session_cache_ttl)
+        self.idle_users = IdleUserSet(ttl=session_cache_ttl)
+        self.skipped_writes = 0
+        # 写后缓冲：同一用户的多次更新合并为一行，每 flush_interval_ms 或攒够 flush_batch_size 行时一个事务写入
+        # flush_interval_ms 即持久化窗口，崩溃时最多丢失这段时间内的非关键更新；设为 0 时逐条落盘
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_batch_size = flush_batch_size
+        self._pending: Dict[str, tuple] = {}
+        self._pending_lock = threading.Lock()
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+        self.coalesced_writes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        # 读会话、落盘与按状态查询在锁内串行，避免读到已移出缓冲但尚未写入后端的会话
+        self._lock = threading.RLock()
+        # 异步接口的数据库调用统一交给单个专用线程，事件循环不等待 fsync 和锁
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="repoinsight-db")
+        # user_id -> [asyncio.Lock, 持有或等待的协程数]，没有协程使用时移除
+        self._user_locks: Dict[str, list] = {}
+    
+    async def open_async(self):
+        """在数据库线程中打开后端（建表与迁移），不阻塞事件循环"""
+        await self.run(self.backend.open)
+    
+    async def run(self, fn, *args, **kwargs):
+        """在专用数据库线程中执行同步调用，并按操作名记录执行耗时"""
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe('repoinsight_db_op_seconds', time.perf_counter() - started, op=fn.__name__)
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, timed)
+    
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id: str):
+        """同一用户的读-改-写在锁内线性执行；每个用户一把锁，锁内的网络请求不会阻塞其他用户"""
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+    
+    async def reload_session_async(self, user_id: str) -> UserSession:
+        """绕过缓存从数据库重新读取会话（其他进程可能已推进该会话）"""
+        self.cache.invalidate(user_id)
+        return await self.run(self._load_session, user_id)
+    
+    async def get_session_async(self, user_id: str) -> UserSession:
+        """异步获取用户会话，缓存命中时不切换线程"""
+        session = self.cache.get(user_id)
+        if session is not None:
+            return session
+        return await self.run(self._load_session, user_id)
+    
+    def _load_session(self, user_id: str) -> UserSession:
+        """从数据库读取会话并放入缓存（尚未落盘的更新优先）"""
+        with self._lock:
+            with self._pending_lock:
+                row = self._pending.get(user_id)
+            if row is None:
+                row = self.backend.load_session(user_id)
         
         if row:
-            data = {
-                'user_id': row[0],
-                'state': row[1],
-                'repo_url': row[2],
-                'analysis_task_id': row[3],
-                'question': row[4],
-                'query_task_id': row[5],
-                'session_id': row[6],
-                'last_activity': row[7]
-            }
-            return UserSession.from_dict(data)
+            session = self._row_to_session(row)
         else:
-            return UserSession(user_id)
-    
-    def save_session(self, session: UserSession):
-        """保存用户会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_sessions 
-            (user_id, state, repo_url, analysis_task_id, question, query_task_id, session_id, last_activity)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+            session = UserSession(user_id)
+        self.cache.put(session)
+        self.idle_users.track(session)
+        return session
+    
+    @staticmethod
+    def _row_to_session(row) -> UserSession:
+        """将数据库行转换为会话对象"""
+        data = {
+            'user_id': row[0],
+            'state': row[1],
+            'repo_url': row[2],
+            'analysis_task_id': row[3],
+            'question': row[4],
+            'query_task_id': row[5],
+            'session_id': row[6],
+            'adapter_key': row[8],
+            'target_type': row[9],
+            'target_id': row[10]
+        }
+        session = UserSession.from_dict(data)
+        session.last_activity = datetime.fromtimestamp(row[7])
+        session.mark_clean()
+        return session
+    
+    async def save_session_async(self, session: UserSession, durable: bool = False):
+        """异步保存用户会话：写入写后缓冲，durable=True 时等待落盘后返回"""
+        if not self._enqueue(session) and not durable:
+            return
+        if durable or self.flush_interval <= 0 or len(self._pending) >= self.flush_batch_size:
+            await self.flush_async()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush_later)
+    
+    def _enqueue(self, session: UserSession) -> bool:
+        """把会话快照放入写后缓冲，同一用户只保留最新一份；未变化时返回 False"""
+        self.cache.put(session)
+        self.idle_users.track(session)
+        if not session.is_dirty(self.touch_interval):
+            self.skipped_writes += 1
+            return False
+        row = (
             session.user_id,
             session.state.value,
             session.repo_url,
@@ -141,244 +1789,1346 @@ class StateManager:
             session.question,
             session.query_task_id,
             session.session_id,
-            session.last_activity.isoformat()
-        ))
-        conn.commit()
-        conn.close()
+            int(session.last_activity.timestamp()),
+            session.adapter_key,
+            session.target_type,
+            session.target_id
+        )
+        with self._pending_lock:
+            if session.user_id in self._pending:
+                self.coalesced_writes += 1
+            self._pending[session.user_id] = row
+        session.mark_clean()
+        return True
+    
+    def _flush_later(self):
+        self._flush_timer = None
+        task = asyncio.ensure_future(self._flush_quietly())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _flush_quietly(self):
+        try:
+            await self.flush_async()
+        except Exception as e:
+            logger.error(f"Flush session writes failed: {e}")
+    
+    async def flush_async(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        await self.run(self.flush)
+    
+    def flush(self):
+        """把缓冲中的全部会话一次写入后端（SQLite 后端为一个事务）"""
+        with self._lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                rows, self._pending = self._pending, {}
+            try:
+                self.backend.write_sessions(list(rows.values()))
+            except Exception:
+                # 写入失败时放回缓冲，不覆盖期间产生的更新
+                with self._pending_lock:
+                    for user_id, row in rows.items():
+                        self._pending.setdefault(user_id, row)
+                raise
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+    
+    async def iter_sessions_by_state_async(self, state: UserState,
+                                           batch_size: int = 200) -> AsyncIterator[UserSession]:
+        """按状态分批流式读取完整会话：按 user_id 键集分页，不长期占用游标，每批查询在数据库线程中执行"""
+        last_user_id = ""
+        while True:
+            sessions = await self.run(self._sessions_page, state, last_user_id, batch_size)
+            for session in sessions:
+                yield session
+            if len(sessions) < batch_size:
+                return
+            last_user_id = sessions[-1].user_id
     
-    def cleanup_inactive_sessions(self, hours: int = 24):
-        """清理不活跃的会话"""
+    def _sessions_page(self, state: UserState, after_user_id: str, batch_size: int) -> List[UserSession]:
+        with self._lock:
+            # 按状态查询前先落盘缓冲中的更新，避免漏掉刚变更状态的会话
+            self.flush()
+            rows = self.backend.sessions_page(state.value, after_user_id, batch_size)
+        # 单进程内缓存与数据库一致，优先复用缓存中的同一对象
+        return [self._cached_or_row(row, state) for row in rows]
+    
+    def _cached_or_row(self, row, state: UserState) -> UserSession:
+        cached = self.cache.peek(row[0])
+        return cached if cached is not None and cached.state == state else self._row_to_session(row)
+    
+    def find_sessions_by_task(self, state: UserState, task_key: str) -> List[UserSession]:
+        """按在途任务标识查找会话：分析任务匹配 session_id（可能有多个用户共享），查询任务匹配 query_task_id"""
+        column = "session_id" if state == UserState.ANALYZING else "query_task_id"
+        with self._lock:
+            self.flush()
+            rows = self.backend.sessions_by_task(state.value, column, task_key)
+        return [self._cached_or_row(row, state) for row in rows]
+    
+    async def find_sessions_by_task_async(self, state: UserState, task_key: str) -> List[UserSession]:
+        return await self.run(self.find_sessions_by_task, state, task_key)
+    
+    async def cleanup_inactive_sessions_async(self, hours: int = 24, batch_size: int = 500) -> int:
+        """分批清理不活跃会话，返回删除的会话数：每批一个短事务，批次之间让出数据库线程与事件循环"""
         cutoff_time = datetime.now() - timedelta(hours=hours)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM user_sessions WHERE last_activity < ?",
-            (cutoff_time.isoformat(),)
+        removed = 0
+        while True:
+            deleted = await self.run(self._delete_inactive_batch, int(cutoff_time.timestamp()), batch_size)
+            removed += deleted
+            if deleted < batch_size:
+                break
+            await asyncio.sleep(0)
+        self.cache.evict_inactive(cutoff_time)
+        return removed
+    
+    def _delete_inactive_batch(self, cutoff: int, batch_size: int) -> int:
+        """删除一批 last_activity 早于 cutoff 的会话及其未答复的问题"""
+        with self._lock:
+            self.flush()
+            return self.backend.expire_sessions(cutoff, batch_size)
+    
+    def checkpoint(self) -> tuple:
+        """落盘缓冲后做一次后端检查点，返回 (busy, 日志页数, 已检查点页数)"""
+        with self._lock:
+            self.flush()
+            return self.backend.checkpoint()
+    
+    async def reclaim_space_async(self, pages_per_step: int = 1000) -> tuple:
+        """分步回收已删除数据的空间（步骤之间让出数据库线程），最后做一次检查点"""
+        while await self.run(self.backend.reclaim_space, pages_per_step):
+            await asyncio.sleep(0)
+        return await self.run(self.checkpoint)
+    
+    def close(self):
+        """落盘缓冲中的更新并关闭后端"""
+        with self._lock:
+            self.flush()
+            self.backend.close()
+    
+    async def close_async(self):
+        """等数据库线程中已排队的操作执行完后关闭后端"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        await self.run(self.close)
+        self._executor.shutdown(wait=False)
+
+# 仓库分析登记
+def canonical_repo_key(repo_url: str, embedding_config: Optional[Dict] = None) -> str:
+    """规范化仓库键：忽略大小写、.git 后缀与末尾斜杠，并区分 embedding 提供商与模型（不含 API 密钥）"""
+    parsed = urlparse(repo_url.strip())
+    path = parsed.path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-4]
+    key = f"{parsed.netloc.lower()}/{path.lower()}"
+    if embedding_config:
+        key += f"|{str(embedding_config.get('provider', '')).lower()}|{str(embedding_config.get('model_name', '')).lower()}"
+    return key
+
+class AnalysisRegistry:
+    """合并相同仓库的分析请求：进行中的请求单飞共享，已完成的分析在 TTL 内跨用户复用"""
+    
+    def __init__(self, state_manager: StateManager, ttl_hours: float = 24, max_entries: int = 1000):
+        self.state_manager = state_manager
+        self.backend = state_manager.backend
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        # repo_key -> 正在调用 start_analysis 的 Future
+        self._starting: Dict[str, asyncio.Future] = {}
+    
+    async def lookup(self, repo_key: str) -> Optional[Dict]:
+        """查找已登记的分析（进行中或已完成）"""
+        return await self.state_manager.run(self.backend.get_repo_analysis, repo_key, self.ttl_seconds)
+    
+    async def start_or_join(self, repo_key: str, repo_url: str, start) -> Optional[Dict]:
+        """同一仓库并发提交时只调用一次 start()，其余请求等待并共享其结果"""
+        pending = self._starting.get(repo_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._starting[repo_key] = future
+        result = None
+        try:
+            result = await start()
+            if result and result.get("session_id"):
+                await self.state_manager.run(
+                    self.backend.put_repo_analysis, repo_key, repo_url, result["session_id"], result.get("task_id"),
+                    "analyzing", self.ttl_seconds, self.max_entries
+                )
+        finally:
+            self._starting.pop(repo_key, None)
+            future.set_result(result)
+        return result
+    
+    async def mark_ready(self, session_id: str):
+        await self.state_manager.run(self.backend.update_repo_analysis_status, session_id, "ready")
+    
+    async def forget(self, session_id: str):
+        await self.state_manager.run(self.backend.update_repo_analysis_status, session_id, None)
+
+# 答案缓存
+class AnswerCache:
+    """按 (分析会话, 生成模式, 规范化问题) 缓存答案，并用词级 MinHash + LSH 召回近似问题；
+    近似问题只有实词集合完全相同时才复用答案，改动一个实词（如 incoming/outgoing）即视为不同问题"""
+    NUM_PERM = 32
+    BANDS = 8  # 8 个分桶 × 每桶 4 行
+    _PRIME = (1 << 61) - 1
+    # 固定种子保证签名在进程重启后保持一致
+    _PERMUTATIONS = (lambda rng, prime, count: [
+        (rng.randrange(1, prime), rng.randrange(0, prime)) for _ in range(count)
+    ])(random.Random(0x5EED), _PRIME, NUM_PERM)
+    # 英文单词与数字按词切分，汉字逐字切分
+    _TOKEN = re.compile(r'[\u3400-\u9fff]|[^\W_\u3400-\u9fff]+')
+    # 不影响问题含义的虚词，比较实词集合时忽略
+    STOPWORDS = frozenset(
+        "a an the is are was were be been do does did can could would should will shall may might must "
+        "i me my we our you your it its this that these those there here of in on at to for from by with "
+        "about into as and or so if then than please what which who whom whose how why when where "
+        "的 了 吗 呢 吧 啊 呀 么 是 在 请 问 一 下 个 和 与 及 之 中 里 我 你 它 这 那".split()
+    )
+    
+    def __init__(self, state_manager: StateManager, similarity: float = 0.85, max_entries: int = 5000,
+                 max_bytes: int = 50 * 1024 * 1024, ttl_hours: float = 72):
+        self.state_manager = state_manager
+        self.backend = state_manager.backend
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = ttl_hours * 3600
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def normalize(question: str) -> str:
+        """全角转半角、小写，标点和空白折叠为单个空格"""
+        text = unicodedata.normalize('NFKC', question).lower()
+        return re.sub(r'[\W_]+', ' ', text).strip()
+    
+    @staticmethod
+    def _hash64(data: str) -> int:
+        return int.from_bytes(hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    @classmethod
+    def tokens(cls, normalized: str) -> List[str]:
+        return cls._TOKEN.findall(normalized)
+    
+    @classmethod
+    def content_words(cls, normalized: str) -> frozenset:
+        """去掉虚词后的词集合；全是虚词时退回全部词"""
+        tokens = set(cls.tokens(normalized))
+        return frozenset(tokens - cls.STOPWORDS) or frozenset(tokens)
+    
+    def signature(self, normalized: str) -> List[int]:
+        """计算词集合的 MinHash 签名"""
+        shingles = set(self.tokens(normalized)) or {normalized}
+        hashes = [self._hash64(shingle) for shingle in shingles]
+        prime = self._PRIME
+        return [min((a * h + b) % prime for h in hashes) for a, b in self._PERMUTATIONS]
+    
+    def band_keys(self, analysis_session_id: str, generation_mode: str, signature: List[int]) -> List[int]:
+        """LSH 分桶键，包含会话与模式，保证只在同一仓库同一模式内召回"""
+        rows = self.NUM_PERM // self.BANDS
+        keys = []
+        for band in range(self.BANDS):
+            chunk = ",".join(map(str, signature[band * rows:(band + 1) * rows]))
+            # SQLite INTEGER 为有符号 64 位
+            keys.append(self._hash64(f"{analysis_session_id}|{generation_mode}|{band}|{chunk}") - (1 << 63))
+        return keys
+    
+    async def lookup(self, analysis_session_id: str, generation_mode: str, question: str) -> Optional[str]:
+        """查找缓存答案：先精确匹配，再在实词集合相同的候选中按估计 Jaccard 相似度匹配近似问题"""
+        return await self.state_manager.run(self._lookup, analysis_session_id, generation_mode, question)
+    
+    def _lookup(self, analysis_session_id: str, generation_mode: str, question: str) -> Optional[str]:
+        normalized = self.normalize(question)
+        if not normalized:
+            return None
+        row = self.backend.get_cached_answer(
+            analysis_session_id, generation_mode, normalized, self.max_age_seconds
+        )
+        if row is None:
+            signature = self.signature(normalized)
+            content = self.content_words(normalized)
+            best, best_score = None, self.similarity
+            candidates = self.backend.find_answer_candidates(
+                self.band_keys(analysis_session_id, generation_mode, signature), self.max_age_seconds
+            )
+            for entry_id, stored_question, packed, answer in candidates:
+                if self.content_words(stored_question) != content:
+                    continue
+                stored = struct.unpack(f"<{self.NUM_PERM}Q", packed)
+                score = sum(1 for x, y in zip(signature, stored) if x == y) / self.NUM_PERM
+                if score >= best_score:
+                    best, best_score = (entry_id, answer), score
+            if best is None:
+                self.misses += 1
+                return None
+            row = best
+            self.near_hits += 1
+        else:
+            self.hits += 1
+        self.backend.record_answer_hit(row[0])
+        return row[1]
+    
+    async def store(self, analysis_session_id: str, generation_mode: str, question: str, answer: str):
+        """写入答案缓存"""
+        await self.state_manager.run(self._store, analysis_session_id, generation_mode, question, answer)
+    
+    def _store(self, analysis_session_id: str, generation_mode: str, question: str, answer: str):
+        normalized = self.normalize(question)
+        if not normalized or not answer:
+            return
+        signature = self.signature(normalized)
+        self.backend.put_cached_answer(
+            analysis_session_id, generation_mode, normalized,
+            struct.pack(f"<{self.NUM_PERM}Q", *signature),
+            self.band_keys(analysis_session_id, generation_mode, signature),
+            answer, self.max_entries, self.max_bytes, self.max_age_seconds
         )
-        conn.commit()
-        conn.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.near_hits + self.misses
+        return {
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.near_hits) / total if total else 0.0
+        }
 
 # GithubBot API 客户端
+# 熔断器
+class CircuitBreaker:
+    """连续失败达到阈值后熔断：冷却期内直接失败，冷却结束后放行一个探测请求"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+    
+    def allow(self) -> bool:
+        """是否允许发出请求"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("GithubBot circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"GithubBot circuit opened after {self.failures} consecutive failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+    
+    def release_probe(self):
+        """探测请求被取消或意外出错、没有记录结果时按失败处理，重新冷却，避免一直停在半开状态拒绝所有请求"""
+        if self.state == self.HALF_OPEN and self._probing:
+            self.record_failure()
+
 class GithubBotClient:
-    def __init__(self, base_url: str = "http://github_bot_api:8000"):
+    # 各接口的 (连接超时, 读取超时)，单位秒
+    ENDPOINT_TIMEOUTS = {
+        "health": (2, 5),
+        "start_analysis": (5, 30),
+        "analysis_status": (3, 10),
+        "cancel_analysis": (5, 15),
+        "submit_query": (5, 30),
+        "query_status": (3, 10),
+        "query_result": (3, 60),
+    }
+    # 视为后端暂时不可用、可以重试的状态码
+    RETRYABLE_STATUSES = (502, 503, 504)
+    
+    def __init__(self, base_url: str = "http://github_bot_api:8000", timeout: float = 30,
+                 retry_attempts: int = 3, retry_delay: float = 1, pool_limit: int = 100,
+                 pool_limit_per_host: int = 50, keepalive_timeout: float = 30, dns_cache_ttl: int = 300,
+                 max_response_bytes: int = 1024 * 1024, breaker: Optional[CircuitBreaker] = None):
         self.base_url = base_url
         self.session = None
+        # 事件流与流式答案是长连接，使用独立连接池，避免占满普通请求的连接数
+        self.stream_session = None
+        # 推送模式下由调度器设置，随任务一起提交给 GithubBot 作为完成回调地址
+        self.callback_url: Optional[str] = None
+        self.timeout = timeout
+        self.retry_attempts = retry_attempts
+        self.retry_delay = retry_delay
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        # 单个响应体最多读取的字节数，超出部分不再接收；查询结果只保留有限数量、有限长度的检索片段
+        self.max_response_bytes = max_response_bytes
+        self.max_context_chunks = 50
+        self.max_chunk_chars = 8000
+        self.breaker = breaker or CircuitBreaker()
+        # 被动健康信号回调：health_listener(ok, latency_seconds)
+        self.health_listener = None
+        # 后端是否提供流式答案接口，首次返回 404 后置为 False
+        self.streaming_supported = True
+    
+    def configure(self, **options):
+        """更新客户端参数，连接池参数变化时下次请求重建会话"""
+        pool_keys = ("pool_limit", "pool_limit_per_host", "keepalive_timeout", "dns_cache_ttl")
+        rebuild = any(key in pool_keys and getattr(self, key) != value for key, value in options.items())
+        if options.get("base_url", self.base_url) != self.base_url:
+            # 换了后端，重新探测流式接口
+            self.streaming_supported = True
+        for key, value in options.items():
+            setattr(self, key, value)
+        if rebuild and self.session is not None:
+            old_session, self.session = self.session, None
+            asyncio.ensure_future(old_session.close())
+        if rebuild and self.stream_session is not None:
+            old_session, self.stream_session = self.stream_session, None
+            asyncio.ensure_future(old_session.close())
+    
+    async def _get_session(self):
+        """获取HTTP会话（带连接池与 DNS 缓存）"""
+        if self.session is None or self.session.closed:
+            aiohttp = await import_off_loop('aiohttp')
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+    
+    async def _get_stream_session(self):
+        """获取长连接专用的HTTP会话（连接数不设上限）"""
+        if self.stream_session is None or self.stream_session.closed:
+            aiohttp = await import_off_loop('aiohttp')
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True
+            )
+            self.stream_session = aiohttp.ClientSession(connector=connector)
+        return self.stream_session
+    
+    def _timeout_for(self, endpoint: str) -> "aiohttp.ClientTimeout":
+        import aiohttp
+        connect, read = self.ENDPOINT_TIMEOUTS.get(endpoint, (5, self.timeout))
+        return aiohttp.ClientTimeout(total=self.timeout, connect=connect, sock_read=min(read, self.timeout))
+    
+    async def _request(self, endpoint: str, method: str, path: str, json_data: Optional[Dict] = None,
+                       idempotent: bool = True, salvage: bool = False,
+                       not_found: Optional[Dict] = None) -> Optional[Dict]:
+        """发送请求并解析 JSON：只有幂等请求会在网络错误或 5xx 时指数退避重试，熔断期间直接失败
+        响应体超过 max_response_bytes 时截断，salvage=True 时从已读部分中取出完整的字段，否则视为失败
+        给出 not_found 时 404 返回它的副本，让调用方区分“资源已不存在”与暂时性失败"""
+        aiohttp = await import_off_loop('aiohttp')
+        attempts = 1 + (self.retry_attempts if idempotent else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                logger.debug(f"{endpoint} skipped: GithubBot circuit is open")
+                metrics.inc('repoinsight_http_requests_total', endpoint=endpoint, status='circuit_open')
+                return None
+            retryable = False
+            started = time.monotonic()
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+            try:
+                session = await self._get_session()
+                async with session.request(method, f"{self.base_url}{path}", json=json_data,
+                                           timeout=self._timeout_for(endpoint)) as response:
+                    if response.status >= 500:
+                        self._record_outcome(False, started, endpoint, response.status)
+                        retryable = response.status in self.RETRYABLE_STATUSES
+                        logger.error(f"{endpoint} failed: {response.status}")
+                    else:
+                        # 4xx 也说明后端在线
+                        self._record_outcome(True, started, endpoint, response.status)
+                        if response.status == 200:
+                            return await self._read_json(response, endpoint, salvage)
+                        if response.status == 404 and not_found is not None:
+                            logger.warning(f"{endpoint} returned 404: {path}")
+                            return dict(not_found)
+                        logger.error(f"{endpoint} failed: {response.status}")
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+                self._record_outcome(False, started, endpoint, status)
+                retryable = True
+                logger.error(f"{endpoint} error: {e!r}")
+            except Exception as e:
+                logger.error(f"{endpoint} error: {e}")
+                return None
+            finally:
+                if probe:
+                    # 调用方超时取消或意外异常时没有记录结果，补记失败
+                    self.breaker.release_probe()
+            
+            if not retryable or attempt == attempts - 1:
+                return None
+            # 指数退避 + 抖动
+            metrics.inc('repoinsight_http_retries_total', endpoint=endpoint)
+            await asyncio.sleep(self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5))
+        return None
+    
+    async def _read_json(self, response, endpoint: str, salvage: bool) -> Optional[Dict]:
+        """分块读取响应体，最多 max_response_bytes 字节；超出时停止接收并断开连接，不把整个响应读进内存"""
+        limit = self.max_response_bytes
+        if not salvage and response.content_length is not None and response.content_length > limit:
+            response.close()
+            metrics.inc('repoinsight_http_truncated_total', endpoint=endpoint)
+            logger.warning(f"{endpoint} response of {response.content_length} bytes exceeds {limit}, discarded")
+            return None
+        body = bytearray()
+        truncated = False
+        async for block in response.content.iter_chunked(64 * 1024):
+            body += block
+            if len(body) > limit:
+                del body[limit:]
+                truncated = True
+                break
+        if not truncated:
+            return json.loads(body)
+        response.close()
+        metrics.inc('repoinsight_http_truncated_total', endpoint=endpoint)
+        logger.warning(f"{endpoint} response exceeds {limit} bytes, truncated")
+        if not salvage:
+            return None
+        text = body.decode('utf-8', 'ignore')
+        # 解析前释放原始字节，峰值内存约为上限的三倍
+        del body
+        data = salvage_json_object(text)
+        data['truncated'] = True
+        return data
+    
+    def _record_outcome(self, ok: bool, started: float, endpoint: str, status: Any):
+        """把请求结果同步给熔断器、健康监控和指标"""
+        metrics.observe('repoinsight_http_request_seconds', time.monotonic() - started, endpoint=endpoint)
+        metrics.inc('repoinsight_http_requests_total', endpoint=endpoint, status=str(status))
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        if self.health_listener is not None:
+            self.health_listener(ok, time.monotonic() - started)
+    
+    async def health_check(self) -> bool:
+        """健康检查"""
+        return await self._request("health", "GET", "/health") is not None
+    
+    async def start_analysis(self, repo_url: str, embedding_config: Optional[Dict] = None) -> Optional[Dict]:
+        """开始仓库分析"""
+        data = {"repo_url": repo_url}
+        if embedding_config:
+            data["embedding_config"] = embedding_config
+        if self.callback_url:
+            data["callback_url"] = self.callback_url
+        # 重复提交会产生重复分析，不做重试
+        result = await self._request("start_analysis", "POST", "/api/v1/repos/analyze", data, idempotent=False)
+        if result is None:
+            return None
+        return {
+            "session_id": result.get("session_id"),
+            "task_id": result.get("task_id")
+        }
+    
+    async def get_analysis_status(self, session_id: str) -> Optional[Dict]:
+        """获取分析状态；GithubBot 已没有该会话（如重启后丢失）时返回 {"status": "not_found"}"""
+        return await self._request("analysis_status", "GET", f"/api/v1/repos/status/{session_id}",
+                                   not_found={"status": "not_found"})
+    
+    async def submit_query(self, analysis_session_id: str, question: str, llm_config: Optional[Dict] = None, generation_mode: str = "service") -> Optional[Dict]:
+        """提交查询请求；GithubBot 已没有该分析会话时返回 {"status": "not_found"}"""
+        data = {
+            "session_id": analysis_session_id,
+            "question": question,
+            "generation_mode": generation_mode
+        }
+        if llm_config:
+            data["llm_config"] = llm_config
+        if self.callback_url:
+            data["callback_url"] = self.callback_url
+        
+        result = await self._request("submit_query", "POST", "/api/v1/repos/query", data, idempotent=False,
+                                     not_found={"status": "not_found"})
+        if result is None or result.get("status") == "not_found":
+            return result
+        return {
+            "session_id": result.get("session_id"),
+            "task_id": result.get("task_id")
+        }
+    
+    async def get_query_status(self, session_id: str) -> Optional[Dict]:
+        """获取查询状态"""
+        return await self._request("query_status", "GET", f"/api/v1/repos/query/status/{session_id}")
+    
+    async def get_query_result(self, session_id: str) -> Optional[Dict]:
+        """获取查询结果：只保留答案与检索片段中用到的字段，超出大小上限时 truncated 为 True"""
+        result = await self._request("query_result", "GET", f"/api/v1/repos/query/result/{session_id}", salvage=True)
+        if result is None:
+            return None
+        return self.slim_query_result(result)
+    
+    def slim_query_result(self, result: Dict) -> Dict:
+        return slim_query_result(result, self.max_context_chunks, self.max_chunk_chars)
+    
+    async def cancel_analysis(self, session_id: str) -> Optional[Dict]:
+        """取消仓库分析任务（重复取消无副作用，可以重试）；会话已不存在时返回 {"status": "not_found"}"""
+        return await self._request("cancel_analysis", "POST", f"/api/v1/repos/analyze/{session_id}/cancel",
+                                   not_found={"status": "not_found"})
+    
+    async def iter_events(self, on_open=None, idle_timeout: float = 90) -> AsyncIterator[Dict]:
+        """订阅 GithubBot 的任务状态事件流（SSE），逐个产出事件；连接建立后调用 on_open"""
+        aiohttp = await import_off_loop('aiohttp')
+        session = await self._get_stream_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=idle_timeout)
+        async with session.get(f"{self.base_url}/api/v1/repos/events",
+                               headers={"Accept": "text/event-stream"}, timeout=timeout) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Subscribe events failed: {response.status}")
+            if on_open is not None:
+                on_open()
+            async for event in self._read_sse(response):
+                yield event
+    
+    async def iter_query_stream(self, query_session_id: str, idle_timeout: float = 60) -> AsyncIterator[Dict]:
+        """流式读取查询答案（SSE：{"delta": "..."}，结束时 {"done": true, "status": ...}）；后端不支持时不产出事件"""
+        if not self.streaming_supported:
+            return
+        aiohttp = await import_off_loop('aiohttp')
+        session = await self._get_stream_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=idle_timeout)
+        async with session.get(f"{self.base_url}/api/v1/repos/query/stream/{query_session_id}",
+                               headers={"Accept": "text/event-stream"}, timeout=timeout) as response:
+            if response.status in (404, 405, 501):
+                # 旧版 GithubBot 没有流式接口，之后直接走轮询
+                self.streaming_supported = False
+                logger.info("GithubBot does not support answer streaming, falling back to polling")
+                return
+            if response.status != 200:
+                raise RuntimeError(f"Open query stream failed: {response.status}")
+            async for event in self._read_sse(response):
+                yield event
+    
+    @staticmethod
+    async def _read_sse(response) -> AsyncIterator[Dict]:
+        """逐行解析 SSE 响应，产出 data 字段中的 JSON 事件"""
+        data_lines = []
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').rstrip('\r\n')
+            if line.startswith('data:'):
+                data_lines.append(line[5:].lstrip())
+            elif not line and data_lines:
+                # 空行表示一个事件结束；以冒号开头的心跳注释行直接忽略
+                try:
+                    yield json.loads("\n".join(data_lines))
+                except ValueError:
+                    logger.warning("Discarding malformed stream event")
+                data_lines = []
+    
+    async def close(self):
+        """关闭HTTP会话"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+        if self.stream_session:
+            await self.stream_session.close()
+            self.stream_session = None
+
+# 健康监控
+class HealthMonitor:
+    """后台按自适应间隔探测 GithubBot /health，缓存健康状态与最近延迟，真实请求的结果也会更新状态"""
+    
+    def __init__(self, github_client: GithubBotClient, healthy_interval: float = 15,
+                 max_healthy_interval: float = 60, unhealthy_interval: float = 5,
+                 stale_after: float = 90, probe_timeout: float = 3):
+        self.github_client = github_client
+        self.healthy_interval = healthy_interval
+        self.max_healthy_interval = max_healthy_interval
+        self.unhealthy_interval = unhealthy_interval
+        self.stale_after = stale_after
+        self.probe_timeout = probe_timeout
+        self.healthy: Optional[bool] = None
+        self.latency: Optional[float] = None
+        self.checked_at = 0.0
+        self._probe_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        github_client.health_listener = self.record
+    
+    def record(self, ok: bool, latency: Optional[float] = None):
+        """记录一次主动探测或被动观察到的结果"""
+        if ok != self.healthy and self.healthy is not None:
+            logger.info(f"GithubBot health changed: {'healthy' if ok else 'unhealthy'}")
+        self.healthy = ok
+        if ok and latency is not None:
+            self.latency = latency
+        self.checked_at = time.monotonic()
+    
+    def is_stale(self) -> bool:
+        return self.healthy is None or time.monotonic() - self.checked_at > self.stale_after
+    
+    async def probe(self) -> bool:
+        """探测一次 /health（并发调用共享同一次探测）"""
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.ensure_future(self.github_client.health_check())
+        try:
+            # health_check 内部会通过 health_listener 记录结果与延迟
+            return await asyncio.wait_for(asyncio.shield(self._probe_task), timeout=self.probe_timeout)
+        except asyncio.TimeoutError:
+            self.record(False)
+            return False
+    
+    async def is_available(self) -> bool:
+        """读取缓存的健康状态，只有状态过期时才等待一次探测"""
+        if self.is_stale():
+            return await self.probe()
+        return bool(self.healthy)
+    
+    async def run(self):
+        """后台探测循环：健康时逐步放慢，异常时加快"""
+        interval = self.healthy_interval
+        while True:
+            try:
+                # 最近已有真实请求的结果时跳过这次探测
+                if time.monotonic() - self.checked_at >= interval:
+                    await self.probe()
+                if self.healthy:
+                    interval = min(interval * 1.5, self.max_healthy_interval)
+                else:
+                    interval = self.unhealthy_interval
+                await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Health monitor error: {e}")
+                await asyncio.sleep(self.unhealthy_interval)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        """停止探测循环，并取消进行中的探测，避免插件关闭客户端后探测仍在使用连接"""
+        tasks = [task for task in (self._task, self._probe_task) if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._probe_task = None
+
+# 答案格式化
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+def estimate_tokens(text: str) -> int:
+    """本地快速估算 token 数：中日韩字符约 1 个/token，其余字符约 4 个/token"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def chunk_score(chunk: Dict) -> float:
+    """检索片段的相关度分数；缺失、不是数字或非有限值时按 0 处理"""
+    try:
+        score = float(chunk.get('score') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return score if math.isfinite(score) else 0.0
+
+def pack_context(chunks: List[Dict], token_budget: int = 1200) -> Optional[str]:
+    """把检索片段压缩进 token 预算：同文件重叠/相邻片段合并、近似重复去重、按分数排序后依次填充"""
+    # 按文件合并重叠或相邻的行区间；没有行号的片段单独保留
+    by_file: Dict[str, List[list]] = {}
+    blocks = []
+    for chunk in chunks:
+        content = (chunk.get('content') or '').strip('\n')
+        if not content.strip():
+            continue
+        lines = content.split('\n')
+        score = chunk_score(chunk)
+        file_path = chunk.get('file_path') or ''
+        start = chunk.get('start_line')
+        if not file_path or not isinstance(start, int):
+            blocks.append([file_path, None, None, lines, score])
+            continue
+        by_file.setdefault(file_path, []).append([file_path, start, start + len(lines) - 1, lines, score])
+    for spans in by_file.values():
+        spans.sort(key=lambda span: span[1])
+        merged = spans[0]
+        for span in spans[1:]:
+            if span[1] <= merged[2] + 1:
+                # 只追加超出已合并区间的行
+                merged[3] = merged[3] + span[3][merged[2] - span[1] + 1:]
+                merged[2] = max(merged[2], span[2])
+                merged[4] = max(merged[4], span[4])
+            else:
+                blocks.append(merged)
+                merged = span
+        blocks.append(merged)
+    
+    # 按分数从高到低，丢弃内容（去空白后的行集合）几乎都已出现在更高分片段中的片段
+    blocks.sort(key=lambda block: block[4], reverse=True)
+    kept, seen = [], []
+    for block in blocks:
+        line_set = {line.strip() for line in block[3] if line.strip()}
+        if any(len(line_set & other) >= 0.9 * len(line_set) for other in seen):
+            continue
+        seen.append(line_set)
+        kept.append(block)
+    
+    parts, remaining = [], token_budget
+    for file_path, start, end, lines, _ in kept:
+        title = f"📄 {file_path}:{start}-{end}" if start is not None else f"📄 {file_path or '片段'}"
+        cost = estimate_tokens(title) + 1
+        body = []
+        for line in lines:
+            line_cost = estimate_tokens(line) + 1
+            if cost + line_cost > remaining:
+                break
+            body.append(line)
+            cost += line_cost
+        if not body:
+            # 放不下时尝试后面更短的片段
+            continue
+        truncated = len(body) < len(lines)
+        parts.append(title + "\n" + "\n".join(body) + ("\n…" if truncated else ""))
+        remaining -= cost
+    return "\n\n".join(parts) or None
+
+# 查询结果中插件用到的检索片段字段
+RESULT_CHUNK_FIELDS = ('content', 'file_path', 'start_line', 'score')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+def slim_query_result(result: Dict, max_chunks: int, max_chunk_chars: int) -> Dict:
+    """只保留 answer 与检索片段的 content/file_path/start_line/score；片段数量或长度超限时截断并标记 truncated"""
+    truncated = bool(result.get('truncated'))
+    slim: Dict[str, Any] = {}
+    if isinstance(result.get('answer'), str):
+        slim['answer'] = result['answer']
+    chunks = result.get('retrieved_context')
+    if isinstance(chunks, list):
+        kept = []
+        for chunk in chunks[:max_chunks]:
+            if not isinstance(chunk, dict):
+                continue
+            item = {key: chunk[key] for key in RESULT_CHUNK_FIELDS if key in chunk}
+            content = item.get('content')
+            if isinstance(content, str) and len(content) > max_chunk_chars:
+                item['content'] = content[:max_chunk_chars]
+                truncated = True
+            kept.append(item)
+        truncated = truncated or len(chunks) > max_chunks
+        slim['retrieved_context'] = kept
+    slim['truncated'] = truncated
+    return slim
+
+def salvage_json_object(text: str) -> Dict:
+    """从被截断的 JSON 对象文本中逐个解析顶层字段：完整的字段原样保留，
+    截断处的字符串保留已读到的部分，数组保留已完整的元素，其余丢弃"""
+    data: Dict[str, Any] = {}
+    pos = text.find('{') + 1
+    if not pos:
+        return data
+    while True:
+        pos = _JSON_SEPARATORS.match(text, pos).end()
+        if pos >= len(text) or text[pos] == '}':
+            return data
+        try:
+            key, pos = _JSON_DECODER.raw_decode(text, pos)
+        except ValueError:
+            return data
+        pos = _JSON_SEPARATORS.match(text, pos).end()
+        if not isinstance(key, str) or not text.startswith(':', pos):
+            return data
+        pos = _JSON_SEPARATORS.match(text, pos + 1).end()
+        try:
+            value, pos = _JSON_DECODER.raw_decode(text, pos)
+        except ValueError:
+            partial = _salvage_json_value(text, pos)
+            if partial is not None:
+                data[key] = partial
+            return data
+        if pos >= len(text) and isinstance(value, (int, float)):
+            # 末尾的数字可能只读到一半
+            return data
+        data[key] = value
+
+def _salvage_json_value(text: str, pos: int) -> Any:
+    """解析到文本末尾仍不完整的字符串或数组"""
+    if text.startswith('"', pos):
+        # 截断可能落在转义序列中间，逐步去掉末尾几个字符再补上引号
+        for cut in range(7):
+            try:
+                return json.loads(text[pos:len(text) - cut] + '"')
+            except ValueError:
+                continue
+        return None
+    if text.startswith('[', pos):
+        items = []
+        pos += 1
+        while True:
+            pos = _JSON_SEPARATORS.match(text, pos).end()
+            try:
+                item, pos = _JSON_DECODER.raw_decode(text, pos)
+            except ValueError:
+                return items
+            items.append(item)
+    return None
+
+def build_answer_payload(result: Dict, generation_mode: str, context_budget: int = 1200) -> Optional[str]:
+    """从查询结果中提取答案主体：服务端模式为生成的答案，插件模式为按预算压缩后的检索上下文"""
+    if generation_mode == "service":
+        # 服务端模式：直接使用返回的答案
+        return result.get('answer')
+    # 插件模式：使用返回的上下文生成答案
+    retrieved_context = result.get('retrieved_context', [])
+    if not retrieved_context:
+        return None
+    return pack_context(retrieved_context, context_budget)
+
+def render_answer(generation_mode: str, payload: Optional[str], question: str) -> str:
+    """将答案主体渲染为发给用户的文本"""
+    if generation_mode == "service":
+        return payload or '无法获取答案'
+    if payload:
+        return f"根据代码库分析，以下是相关信息：\n\n{payload}\n\n针对您的问题：{question}\n\n请注意，这是基于检索到的代码片段提供的信息，可能需要结合具体上下文进行理解。"
+    return "抱歉，没有找到相关的代码信息来回答您的问题。"
+
+# 消息投递
+def split_message(text: str, limit: int) -> List[str]:
+    """按行把长消息切成不超过 limit 个字符的有序分片，单行超长时硬切"""
+    if len(text) <= limit:
+        return [text]
+    chunks, current = [], ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current += line
+    if current:
+        chunks.append(current)
+    return [chunk.strip("\n") for chunk in chunks if chunk.strip()]
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多累积 capacity 个；rate <= 0 表示不限速"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        """预占一个令牌，返回需要等待的秒数（允许透支，多个等待者按先后排队）"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class NotificationDispatcher:
+    """主动消息投递队列：按目标分片的工作协程保证同一目标的消息有序，按适配器限速，长消息分片发送，失败退避重试"""
+    WORKERS = 4
+    # 适配器列表缓存时长（秒）；来源适配器不在缓存中时最多每秒刷新一次
+    ADAPTER_CACHE_TTL = 300
+    RETRY_DELAY = 1.0
     
-    async def _get_session(self):
-        """获取HTTP会话"""
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
-        return self.session
+    def __init__(self, plugin_instance, queue_size: int = 10000):
+        self.plugin_instance = plugin_instance
+        self.queue_size = queue_size
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self._buckets: Dict[str, TokenBucket] = {}
+        # adapter_key -> 适配器，保持 get_platform_adapters 的顺序
+        self._adapters: Dict[str, Any] = {}
+        self._adapters_at = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
     
-    async def health_check(self) -> bool:
-        """健康检查"""
-        try:
-            session = await self._get_session()
-            async with session.get(f"{self.base_url}/health") as response:
-                return response.status == 200
-        except Exception as e:
-            logger.error(f"Health check failed: {e}")
-            return False
+    @staticmethod
+    def adapter_key(adapter) -> str:
+        """适配器的稳定标识：类名，带机器人账号时附加账号以区分同类适配器"""
+        key = type(adapter).__name__
+        account = getattr(adapter, 'bot_account_id', None)
+        return f"{key}:{account}" if account else key
     
-    async def start_analysis(self, repo_url: str, embedding_config: Optional[Dict] = None) -> Optional[Dict]:
-        """开始仓库分析"""
-        try:
-            session = await self._get_session()
-            data = {"repo_url": repo_url}
-            if embedding_config:
-                data["embedding_config"] = embedding_config
-            async with session.post(f"{self.base_url}/api/v1/repos/analyze", json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return {
-                        "session_id": result.get("session_id"),
-                        "task_id": result.get("task_id")
-                    }
-                else:
-                    logger.error(f"Analysis start failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Start analysis error: {e}")
-            return None
+    def start(self):
+        if self._workers:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.WORKERS)]
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
     
-    async def get_analysis_status(self, session_id: str) -> Optional[Dict]:
-        """获取分析状态"""
+    async def stop(self, timeout: float = 5):
+        """在 timeout 秒内尽量投递完队列中的消息，然后停止工作协程"""
+        if not self._workers:
+            return
         try:
-            session = await self._get_session()
-            async with session.get(f"{self.base_url}/api/v1/repos/status/{session_id}") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.error(f"Get analysis status failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Get analysis status error: {e}")
-            return None
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout=timeout)
+        except asyncio.TimeoutError:
+            pending = sum(queue.qsize() for queue in self._queues)
+            logger.warning(f"Notification dispatcher stopped with {pending} undelivered messages")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = []
     
-    async def submit_query(self, analysis_session_id: str, question: str, llm_config: Optional[Dict] = None, generation_mode: str = "service") -> Optional[Dict]:
-        """提交查询请求"""
+    def enqueue(self, user_id: str, message: str, route: Optional[tuple] = None) -> bool:
+        """非阻塞入队，route 为 (adapter_key, target_type, target_id)；队列已满时丢弃并返回 False"""
+        route = route or (None, "person", user_id)
+        self.start()
+        # 同一目标固定由同一个工作协程投递，保证消息顺序
+        queue = self._queues[hash((route[1], route[2])) % len(self._queues)]
         try:
-            session = await self._get_session()
-            data = {
-                "session_id": analysis_session_id,
-                "question": question,
-                "generation_mode": generation_mode
-            }
-            if llm_config:
-                data["llm_config"] = llm_config
-            
-            async with session.post(f"{self.base_url}/api/v1/repos/query", json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return {
-                        "session_id": result.get("session_id"),
-                        "task_id": result.get("task_id")
-                    }
-                else:
-                    logger.error(f"Submit query failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Submit query error: {e}")
-            return None
+            queue.put_nowait((user_id, route, message))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Notification queue full, dropping message to {route[1]} {route[2]}")
+            return False
+        return True
     
-    async def get_query_status(self, session_id: str) -> Optional[Dict]:
-        """获取查询状态"""
-        try:
-            session = await self._get_session()
-            async with session.get(f"{self.base_url}/api/v1/repos/query/status/{session_id}") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.error(f"Get query status failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Get query status error: {e}")
-            return None
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
     
-    async def get_query_result(self, session_id: str) -> Optional[Dict]:
-        """获取查询结果"""
-        try:
-            session = await self._get_session()
-            async with session.get(f"{self.base_url}/api/v1/repos/query/result/{session_id}") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.error(f"Get query result failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Get query result error: {e}")
-            return None
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id, route, message = await queue.get()
+            try:
+                await self._deliver(user_id, route, message)
+            except Exception as e:
+                logger.error(f"Deliver message to user {user_id} failed: {e}")
+            finally:
+                queue.task_done()
     
-    async def cancel_analysis(self, session_id: str) -> Optional[Dict]:
-        """取消仓库分析任务"""
-        try:
-            session = await self._get_session()
-            async with session.post(f"{self.base_url}/api/v1/repos/analyze/{session_id}/cancel") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.error(f"Cancel analysis failed: {response.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Cancel analysis error: {e}")
-            return None
+    def _resolve_adapter(self, adapter_key: Optional[str]) -> Optional[tuple]:
+        """返回 (adapter_key, adapter)；来源适配器不存在（旧会话或已卸载）时退回第一个适配器"""
+        now = time.monotonic()
+        stale = now - self._adapters_at > self.ADAPTER_CACHE_TTL
+        missing = adapter_key is not None and adapter_key not in self._adapters and now - self._adapters_at > 1
+        if not self._adapters or stale or missing:
+            adapters = self.plugin_instance.host.get_platform_adapters() or []
+            self._adapters = {self.adapter_key(adapter): adapter for adapter in adapters}
+            self._adapters_at = now
+        if adapter_key in self._adapters:
+            return adapter_key, self._adapters[adapter_key]
+        return next(iter(self._adapters.items()), None)
     
-    async def close(self):
-        """关闭HTTP会话"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+    def _bucket(self, adapter_key: str) -> TokenBucket:
+        bucket = self._buckets.get(adapter_key)
+        if bucket is None:
+            bucket = TokenBucket(
+                float(self.plugin_instance.get_config('notify_rate_limit', 2)),
+                float(self.plugin_instance.get_config('notify_burst', 5))
+            )
+            self._buckets[adapter_key] = bucket
+        return bucket
+    
+    async def _deliver(self, user_id: str, route: tuple, message: str):
+        """按顺序发送各分片；某个分片重试耗尽后放弃剩余分片，避免乱序"""
+        adapter_key, target_type, target_id = route
+        chunk_size = max(100, int(self.plugin_instance.get_config('message_chunk_size', 1500)))
+        attempts = max(1, int(self.plugin_instance.get_config('notify_retry_attempts', 3)))
+        chunks = split_message(message, chunk_size)
+        for index, chunk in enumerate(chunks):
+            components = [Plain(chunk)]
+            if target_type == "group" and index == 0:
+                # 群聊中 @ 提问的用户
+                components = [At(target=user_id), Plain("\n" + chunk)]
+            for attempt in range(attempts):
+                resolved = self._resolve_adapter(adapter_key)
+                if resolved is None:
+                    self.failed += 1
+                    logger.warning(f"No platform adapters available to send message to user {user_id}")
+                    return
+                await self._bucket(resolved[0]).acquire()
+                try:
+                    await self.plugin_instance.host.send_active_message(
+                        adapter=resolved[1],
+                        target_type=target_type,
+                        target_id=target_id,
+                        message=MessageChain(list(components))
+                    )
+                    self.sent += 1
+                    break
+                except Exception as e:
+                    if attempt + 1 >= attempts:
+                        self.failed += 1
+                        logger.error(f"Send message to {target_type} {target_id} failed after {attempts} attempts: {e}")
+                        return
+                    self.retried += 1
+                    # 适配器可能已重建，下次重试前刷新缓存
+                    self._adapters_at = 0.0
+                    await asyncio.sleep(self.RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': self.pending(),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+# 聊天指令
+class Command:
+    """指令表中的一项：处理函数签名为 handler(session, args, ctx)，read_only 的指令不修改会话、不写回存储"""
+    __slots__ = ('name', 'handler', 'usage', 'summary', 'read_only', 'admin')
+    
+    def __init__(self, name: str, handler, usage: str, summary: str, read_only: bool = False, admin: bool = False):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.summary = summary
+        self.read_only = read_only
+        self.admin = admin
 
 # 消息处理器
 class MessageHandler:
+    IDLE_HINT = "请使用 /repo 命令开始分析GitHub仓库，或使用 /help 查看帮助信息。"
+    
     def __init__(self, state_manager: StateManager, github_client: GithubBotClient, plugin_instance):
         self.state_manager = state_manager
+        self.backend = state_manager.backend
         self.github_client = github_client
         self.plugin_instance = plugin_instance
+        # 指令表：按指令名 O(1) 查找，/help 的指令列表也由它生成
+        self.commands: Dict[str, Command] = {command.name: command for command in (
+            Command("/repo", self.command_repo, "/repo [仓库URL]", "开始分析新的GitHub仓库（可直接附带URL）"),
+            Command("/ask", self.command_ask, "/ask <问题>", "就当前仓库提问"),
+            Command("/status", self.command_status, "/status [会话ID]", "查看当前状态或本人任务的进度", read_only=True),
+            Command("/cancel", self.command_cancel, "/cancel", "取消当前分析任务"),
+            Command("/exit", self.command_exit, "/exit", "退出当前会话"),
+            Command("/help", self.command_help, "/help", "显示帮助信息", read_only=True),
+            Command("/metrics", self.command_metrics, "/metrics", "查看运行指标", read_only=True, admin=True),
+        )}
+    
+    def parse_command(self, message: str) -> tuple:
+        """拆出指令名与参数，返回 (Command 或 None, 参数)；不是指令或指令未知时 Command 为 None"""
+        if not message.startswith('/'):
+            return None, ""
+        parts = message.split(None, 1)
+        if not parts:
+            return None, ""
+        return self.commands.get(parts[0]), parts[1].strip() if len(parts) > 1 else ""
     
     async def handle(self, ctx: EventContext, message: str, user_id: str) -> str:
-        """处理用户消息"""
-        session = self.state_manager.get_session(user_id)
-        session.last_activity = datetime.now()
-        
-        # 处理指令
-        if message.startswith('/'):
-            response = await self.handle_command(session, message)
-        else:
-            # 根据状态处理消息
-            if session.state == UserState.WAITING_FOR_REPO:
-                response = await self.handle_repo_url(session, message)
-            elif session.state == UserState.READY_FOR_QUERY:
-                response = await self.handle_question(session, message, ctx)
-            elif session.state == UserState.WAITING_FOR_ANSWER:
-                response = "正在处理您的问题，请稍候..."
+        """处理用户消息（同一用户的消息与轮询更新在用户锁内串行执行）"""
+        started = time.perf_counter()
+        command, args = self.parse_command(message)
+        if command is not None and command.admin and not self.is_admin(user_id):
+            command = None
+        async with self.state_manager.user_lock(user_id):
+            session = await self.state_manager.get_session_async(user_id)
+            if session.state == UserState.ANALYZING:
+                # 分析完成可能由持有任务租约的其他进程推进，以数据库为准
+                session = await self.state_manager.reload_session_async(user_id)
+            # 指标按指令区分 handle 延迟，未知指令归为一类，避免标签基数失控
+            if command is not None:
+                route = command.name
             else:
-                response = "请使用 /repo 命令开始分析GitHub仓库，或使用 /help 查看帮助信息。"
-        
-        self.state_manager.save_session(session)
+                route = "other_command" if message.startswith('/') else session.state.value
+            
+            if command is not None and command.read_only:
+                # 只读指令不记录来源、不刷新活跃时间，也不写回会话
+                response = await command.handler(session, args, ctx)
+            else:
+                session.last_activity = datetime.now()
+                self.record_origin(session, ctx)
+                analysis_session_id = session.session_id
+                if command is not None:
+                    response = await command.handler(session, args, ctx)
+                elif message.startswith('/'):
+                    response = "未知指令，使用 /help 查看可用指令。"
+                elif session.state == UserState.WAITING_FOR_REPO:
+                    response = await self.handle_repo_url(session, message)
+                elif session.state == UserState.READY_FOR_QUERY:
+                    response = await self.handle_question(session, message, ctx)
+                else:
+                    response = self.IDLE_HINT
+                
+                # 新提交的分析任务是关键状态：丢失会让任务成为孤儿，必须落盘后再回复（问题队列直接写库）
+                durable = session.session_id != analysis_session_id and session.state == UserState.ANALYZING
+                await self.state_manager.save_session_async(session, durable=durable)
+        metrics.observe('repoinsight_handle_seconds', time.perf_counter() - started, route=route)
         return response
     
-    async def handle_command(self, session: UserSession, command: str) -> str:
-        """处理指令"""
-        if command == "/repo":
-            session.state = UserState.WAITING_FOR_REPO
-            return "请发送要分析的GitHub仓库URL（例如：https://github.com/user/repo）"
-        
-        elif command == "/exit":
-            session.state = UserState.IDLE
-            session.repo_url = None
-            session.analysis_task_id = None
-            session.question = None
-            session.query_task_id = None
-            session.session_id = None
-            return "已退出当前会话，使用 /repo 开始新的分析。"
-        
-        elif command == "/status":
-            if session.state == UserState.IDLE:
-                return "当前状态：空闲\n使用 /repo 开始分析GitHub仓库"
-            elif session.state == UserState.WAITING_FOR_REPO:
-                return "当前状态：等待仓库URL\n请发送GitHub仓库URL"
-            elif session.state == UserState.ANALYZING:
-                return f"当前状态：正在分析仓库\n仓库：{session.repo_url}\n请稍候..."
-            elif session.state == UserState.READY_FOR_QUERY:
-                return f"当前状态：准备就绪\n仓库：{session.repo_url}\n可以开始提问了！"
-            elif session.state == UserState.WAITING_FOR_ANSWER:
-                return f"当前状态：等待回答\n问题：{session.question}\n正在处理中..."
-        
-        elif command == "/cancel":
-            if session.state == UserState.ANALYZING and session.session_id:
-                # 取消分析任务
-                result = await self.github_client.cancel_analysis(session.session_id)
-                if result:
-                    # 重置会话状态
-                    session.state = UserState.IDLE
-                    session.repo_url = None
-                    session.analysis_task_id = None
-                    session.session_id = None
-                    return "✅ 已成功取消分析任务。使用 /repo 开始新的分析。"
-                else:
-                    return "❌ 取消分析任务失败，请稍后再试。"
-            else:
-                return "当前没有正在进行的分析任务可以取消。"
-        
-        elif command == "/help":
-            return (
-                "RepoInsight - GitHub仓库智能分析助手\n\n"
-                "可用指令：\n"
-                "/repo - 开始分析新的GitHub仓库\n"
-                "/status - 查看当前状态\n"
-                "/cancel - 取消当前分析任务\n"
-                "/exit - 退出当前会话\n"
-                "/help - 显示帮助信息\n\n"
-                "使用流程：\n"
-                "1. 发送 /repo 命令\n"
-                "2. 提供GitHub仓库URL\n"
-                "3. 等待分析完成\n"
-                "4. 开始提问关于代码的问题"
-            )
-        
+    def prefilter_group(self, ctx: EventContext, message: str, user_id: str, require_mention: bool) -> str:
+        """群聊消息的预过滤，只看消息链与内存状态、不访问存储，返回结果分类：
+        command 已知指令；ignored 未 @ 机器人的闲聊、邮箱或 @ 他人；idle 用户没有进行中的会话，可直接回复提示；pass 交给 handle()"""
+        if self.parse_command(message)[0] is not None:
+            return "command"
+        if require_mention and not self.mentions_bot(ctx):
+            return "ignored"
+        if not message.startswith('/') and user_id in self.state_manager.idle_users:
+            return "idle"
+        return "pass"
+    
+    @staticmethod
+    def mentions_bot(ctx: EventContext) -> bool:
+        """平台消息链中是否有 @ 机器人的组件；适配器未提供机器人账号时，任意 @ 组件都算"""
+        event = ctx.event
+        query = getattr(event, 'query', None)
+        chain = getattr(event, 'message_chain', None) or getattr(query, 'message_chain', None)
+        if not chain:
+            return False
+        bot_id = getattr(getattr(query, 'adapter', None), 'bot_account_id', None)
+        for component in chain:
+            if isinstance(component, At) and (bot_id in (None, "") or str(component.target) == str(bot_id)):
+                return True
+        return False
+    
+    def record_origin(self, session: UserSession, ctx: EventContext):
+        """记录消息来源（适配器、私聊/群聊与目标 ID），主动通知按原路送回"""
+        event = getattr(ctx, 'event', None)
+        if event is None:
+            return
+        launcher_type = getattr(event, 'launcher_type', None)
+        if launcher_type is not None:
+            session.target_type = str(getattr(launcher_type, 'value', launcher_type))
+        launcher_id = getattr(event, 'launcher_id', None)
+        if launcher_id is not None:
+            session.target_id = str(launcher_id)
+        adapter = getattr(getattr(event, 'query', None), 'adapter', None)
+        if adapter is not None:
+            session.adapter_key = NotificationDispatcher.adapter_key(adapter)
+    
+    async def command_repo(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        """/repo <url> 直接开始分析；不带参数时等待下一条消息中的URL"""
+        if args:
+            return await self.handle_repo_url(session, args)
+        session.state = UserState.WAITING_FOR_REPO
+        return ("请发送要分析的GitHub仓库URL（例如：https://github.com/user/repo）\n"
+                "也可以直接发送 /repo https://github.com/user/repo")
+    
+    async def command_ask(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        """/ask <问题>，与准备就绪状态下直接发送问题相同"""
+        if not args:
+            return "用法：/ask <问题>"
+        if session.state != UserState.READY_FOR_QUERY:
+            return "请先使用 /repo 命令分析一个仓库，分析完成后再提问。"
+        return await self.handle_question(session, args, ctx)
+    
+    async def command_exit(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        session.state = UserState.IDLE
+        session.repo_url = None
+        session.analysis_task_id = None
+        session.question = None
+        session.query_task_id = None
+        session.session_id = None
+        await self.state_manager.run(self.backend.clear_questions, session.user_id)
+        return "已退出当前会话，使用 /repo 开始新的分析。"
+    
+    async def command_status(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        """不带参数时显示当前会话状态；带会话ID时显示对应的分析或提问进度"""
+        if args and args != session.session_id:
+            return await self.task_status(session, args)
+        if session.state == UserState.IDLE:
+            return "当前状态：空闲\n使用 /repo 开始分析GitHub仓库"
+        elif session.state == UserState.WAITING_FOR_REPO:
+            return "当前状态：等待仓库URL\n请发送GitHub仓库URL"
+        elif session.state == UserState.ANALYZING:
+            return f"当前状态：正在分析仓库\n仓库：{session.repo_url}\n请稍候..."
+        running, queued = await self.state_manager.run(self.backend.count_questions, session.user_id)
+        if running or queued:
+            return (f"当前状态：准备就绪\n仓库：{session.repo_url}\n"
+                    f"待回答的问题：{running} 个处理中，{queued} 个排队中，可以继续提问。")
+        return f"当前状态：准备就绪\n仓库：{session.repo_url}\n可以开始提问了！"
+    
+    async def task_status(self, session: UserSession, task_id: str) -> str:
+        """查询指定任务：本人的提问以本地队列为准，本人当前的分析询问 GithubBot；
+        其他ID（包括其他用户的会话）一律按未知处理，不转发给 GithubBot"""
+        question = await self.state_manager.run(self.backend.get_question_by_task, task_id)
+        if question is not None and question[1] == session.user_id:
+            return f"问题处理中：\"{question[3]}\"\n答案准备好后会立即通知您。"
+        if not session.session_id or task_id not in (session.session_id, session.analysis_task_id):
+            return f"未找到任务：{task_id}"
+        status = await self.github_client.get_analysis_status(session.session_id)
+        if not status or status.get('status') in (None, 'not_found'):
+            return f"未找到任务：{task_id}"
+        fraction = TaskScheduler.progress_fraction(status)
+        progress = f"（{fraction:.0%}）" if fraction is not None and status['status'] not in ('success', 'failed') else ""
+        repo = status.get('repository_url')
+        return f"任务 {task_id}\n状态：{status['status']}{progress}" + (f"\n仓库：{repo}" if repo else "")
+    
+    async def command_cancel(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        if session.state != UserState.ANALYZING or not session.session_id:
+            return "当前没有正在进行的分析任务可以取消。"
+        attached = await self.state_manager.find_sessions_by_task_async(UserState.ANALYZING, session.session_id)
+        if any(other.user_id != session.user_id for other in attached):
+            # 其他用户也在等待同一分析，只让当前用户退出，不取消后端任务
+            result = {"detached": True}
         else:
-            return "未知指令，使用 /help 查看可用指令。"
+            # 取消分析任务
+            result = await self.github_client.cancel_analysis(session.session_id)
+            if result:
+                await self.plugin_instance.analysis_registry.forget(session.session_id)
+        if not result:
+            return "❌ 取消分析任务失败，请稍后再试。"
+        # 重置会话状态
+        session.state = UserState.IDLE
+        session.repo_url = None
+        session.analysis_task_id = None
+        session.session_id = None
+        return "✅ 已成功取消分析任务。使用 /repo 开始新的分析。"
+    
+    async def command_metrics(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        return metrics.summary()
+    
+    async def command_help(self, session: UserSession, args: str, ctx: EventContext) -> str:
+        lines = [f"{command.usage} - {command.summary}" for command in self.commands.values() if not command.admin]
+        return (
+            "RepoInsight - GitHub仓库智能分析助手\n\n"
+            "可用指令：\n" + "\n".join(lines) + "\n\n"
+            "使用流程：\n"
+            "1. 发送 /repo https://github.com/user/repo\n"
+            "2. 等待分析完成\n"
+            "3. 直接发送问题或使用 /ask 提问关于代码的问题"
+        )
+    
+    def is_admin(self, user_id: str) -> bool:
+        """admin_users 配置为逗号分隔的用户 ID 列表"""
+        admins = self.plugin_instance.get_config('admin_users', '') or ''
+        if isinstance(admins, str):
+            admins = admins.split(',')
+        return user_id in {str(admin).strip() for admin in admins}
     
     def validate_github_url(self, url: str) -> bool:
         """验证GitHub URL"""
@@ -392,20 +3142,38 @@ class MessageHandler:
         if not self.validate_github_url(url):
             return "请提供有效的GitHub仓库URL，格式：https://github.com/user/repo"
         
-        # 检查GithubBot服务是否可用
-        if not await self.github_client.health_check():
-            return "GithubBot服务暂时不可用，请稍后再试。"
-        
         # 获取默认embedding配置
         embedding_config = self.plugin_instance.get_embedding_config()
+        registry = self.plugin_instance.analysis_registry
+        repo_key = canonical_repo_key(url, embedding_config)
+        
+        # 已有分析（完成或进行中）时直接复用，不再请求 GithubBot
+        record = await registry.lookup(repo_key)
+        if record and record["status"] == "ready":
+            session.state = UserState.READY_FOR_QUERY
+            session.repo_url = url
+            session.analysis_task_id = record.get("task_id")
+            session.session_id = record["session_id"]
+            return f"✅ 该仓库已有分析结果，现在可以直接提问了！\n仓库：{url}\n会话ID：{session.session_id}"
+        
+        if record:
+            result = {"session_id": record["session_id"], "task_id": record.get("task_id")}
+        else:
+            # 检查GithubBot服务是否可用（读取后台健康监控的缓存状态）
+            if not await self.plugin_instance.health_monitor.is_available():
+                return "GithubBot服务暂时不可用，请稍后再试。"
+            
+            # 开始分析（同一仓库的并发请求共享一次 start_analysis）
+            result = await registry.start_or_join(
+                repo_key, url, lambda: self.github_client.start_analysis(url, embedding_config)
+            )
         
-        # 开始分析
-        result = await self.github_client.start_analysis(url, embedding_config)
         if result and result.get("session_id"):
             session.state = UserState.ANALYZING
             session.repo_url = url
             session.analysis_task_id = result.get("task_id")
             session.session_id = result.get("session_id")  # 保存分析会话ID
+            await self.plugin_instance.task_scheduler.track_analysis(session.user_id, session.session_id)
             return f"✅ 已收到仓库链接，正在请求分析，请稍候... 这可能需要几分钟时间。\n仓库：{url}\n会话ID：{session.session_id}"
         else:
             return "启动分析失败，请检查仓库URL是否正确或稍后再试。"
@@ -422,232 +3190,793 @@ class MessageHandler:
         
         # 获取生成模式和LLM配置
         generation_mode = self.plugin_instance.get_generation_mode()
-        llm_config = self.plugin_instance.get_llm_config() if generation_mode == "service" else None
         
-        # 提交查询请求
-        result = await self.github_client.submit_query(session.session_id, question, llm_config, generation_mode)
-        if result and result.get("session_id"):
-            session.state = UserState.WAITING_FOR_ANSWER
-            session.question = question
-            session.query_task_id = result.get("task_id")
+        # 相同或相近的问题直接从答案缓存回复，不再提交查询
+        if self.plugin_instance.get_config('answer_cache_enabled', True):
+            payload = await self.plugin_instance.answer_cache.lookup(session.session_id, generation_mode, question)
+            if payload:
+                answer = render_answer(generation_mode, payload, question)
+                return f"💡 **问题**：{question}\n\n📝 **答案**（来自缓存）：\n{answer}"
+        
+        # 问题先进入用户的待回答队列，并发上限内立即提交，其余按提问顺序等待
+        max_pending = max(1, int(self.plugin_instance.get_config('max_pending_questions', 5)))
+        queued = await self.state_manager.run(
+            self.backend.enqueue_question, session.user_id, session.session_id, question, max_pending
+        )
+        if queued is None:
+            return f"您已有 {max_pending} 个问题正在处理或排队，请收到答案后再继续提问。"
+        question_id, ahead = queued
+        outcomes = await self.plugin_instance.task_scheduler.pump_questions(session.user_id, question_id)
+        if question_id not in outcomes:
+            return (f"✅ 已收到您的问题：\"{question}\"\n已加入提问队列（前面还有 {ahead} 个问题），"
+                    f"轮到时会自动提交，答案准备好后会立即通知您。")
+        result = outcomes[question_id]
+        if result and result.get("status") == "not_found":
+            session.state = UserState.IDLE
+            session.repo_url = None
+            session.analysis_task_id = None
+            session.session_id = None
+            return f"❌ {TaskScheduler.LOST_ANALYSIS_HINT}"
+        if result:
             # 注意：这里的session_id是查询会话ID，不同于分析会话ID
             query_session_id = result.get("session_id")
             return f"✅ 已收到您的问题：\"{question}\"\n正在为您查找答案，请稍候... 答案准备好后会立即通知您。\n查询会话ID：{query_session_id}"
         else:
             return "提问失败，请稍后再试。"
 
+# 推送事件接收器
+class WebhookReceiver:
+    """内嵌的 aiohttp 回调服务，接收 GithubBot 推送的任务状态事件"""
+    PATH = "/repoinsight/events"
+    
+    def __init__(self, on_event, host: str = "0.0.0.0", port: int = 8765, secret: str = ""):
+        self.on_event = on_event
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self._runner: Optional["web.AppRunner"] = None
+        self._pending = set()
+    
+    async def start(self):
+        """启动回调服务"""
+        web = await import_off_loop('aiohttp.web')
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_post(self.PATH, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Webhook receiver listening on {self.host}:{self.port}{self.PATH}")
+    
+    async def _handle(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        token = request.headers.get("X-RepoInsight-Token", "")
+        if not self.secret or not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=401)
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(event, dict):
+            return web.Response(status=400)
+        # 立即应答，事件处理（包括发送消息）放到后台，避免拖慢 GithubBot
+        task = asyncio.create_task(self.on_event(event))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return web.Response(status=202)
+    
+    async def stop(self):
+        """关闭回调服务"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+# 轮询退避策略
+class PollPolicy:
+    """单类任务的轮询间隔曲线：首次快速检查，之后指数增长并加随机抖动"""
+    
+    def __init__(self, first_delay: float, factor: float, max_delay: float, jitter: float = 0.2):
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+    
+    def next_delay(self, attempt: int, hint: Optional[float] = None) -> float:
+        """计算第 attempt 次检查之后的等待时间，hint 为根据进度估算的建议间隔"""
+        if hint is not None:
+            delay = hint
+        else:
+            delay = self.first_delay * (self.factor ** attempt)
+        delay = min(max(delay, self.first_delay), self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+class PollEntry:
+    """调度堆中的一个在途任务"""
+    __slots__ = ('kind', 'task_key', 'user_id', 'attempt', 'due', 'progress', 'progress_at', 'pushed')
+    
+    def __init__(self, kind: str, task_key: str, user_id: str, due: float, pushed: bool = True):
+        self.kind = kind  # 'analysis' 或 'query'
+        self.task_key = task_key  # 分析为 session_id，查询为 query_task_id
+        self.user_id = user_id
+        # 推送事件能否送达本进程：从失联进程接管的任务，其 webhook 回调仍指向原进程
+        self.pushed = pushed
+        self.attempt = 0
+        self.due = due
+        self.progress: Optional[float] = None
+        self.progress_at: Optional[float] = None
+
 # 任务调度器
 class TaskScheduler:
+    # 分析任务耗时以分钟计：前几次快速确认，随后放缓
+    ANALYSIS_POLICY = PollPolicy(first_delay=2, factor=1.6, max_delay=60)
+    # 查询任务通常几秒完成：起步更快、上限更低
+    QUERY_POLICY = PollPolicy(first_delay=0.5, factor=1.5, max_delay=10)
+    # 兜底对账间隔：发现未进入调度堆的在途任务（如重启后）
+    RECONCILE_INTERVAL = 60
+    # 推送模式下轮询只做慢速对账
+    PUSH_FALLBACK_INTERVAL = 120
+    # not_found：GithubBot 已没有该分析会话，继续轮询不会再有结果
+    ANALYSIS_FINAL_STATUSES = ('success', 'failed', 'cancelled', 'not_found')
+    LOST_ANALYSIS_HINT = "GithubBot 上已找不到该仓库的分析结果（服务可能已重启），请使用 /repo 重新分析。"
+    # 流式答案：两次发送的最小间隔（秒），以及攒够多少字符且遇到段落结尾才发送
+    STREAM_SEND_INTERVAL = 1.5
+    STREAM_MIN_CHARS = 200
+    # 流式答案超过该长度时不写入答案缓存，避免为超长答案保留完整副本
+    STREAM_CACHE_LIMIT = 32 * 1024
+    
     def __init__(self, state_manager: StateManager, github_client: GithubBotClient, plugin_instance):
         self.state_manager = state_manager
+        self.backend = state_manager.backend
         self.github_client = github_client
         self.plugin_instance = plugin_instance
         self.running = False
         self.tasks = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_size = 0
+        # (due, seq, entry) 小顶堆，以及 (kind, task_key) -> entry 的在途索引
+        self._heap: List[tuple] = []
+        self._tracked: Dict[tuple, PollEntry] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatching = set()
+        # 推送通道（webhook 或 SSE）可用时，轮询退化为慢速对账
+        self.push_active = False
+        self._webhook: Optional[WebhookReceiver] = None
+        # query_task_id -> 正在转发流式答案的任务；流中断且已发出部分内容的查询
+        self._streams: Dict[str, asyncio.Task] = {}
+        self._interrupted_streams = set()
+        # 多个插件进程共享数据库时用于区分租约持有者
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
     
     async def start(self):
         """启动调度器"""
         if not self.running:
             self.running = True
             # 启动后台任务
-            task1 = asyncio.create_task(self.poll_analysis_status())
-            task2 = asyncio.create_task(self.poll_query_results())
+            task1 = asyncio.create_task(self.run_poll_queue())
+            task2 = asyncio.create_task(self.reconcile_in_flight())
             task3 = asyncio.create_task(self.cleanup_inactive_users())
+            task4 = asyncio.create_task(self.maintain_leases())
             
-            self.tasks.update([task1, task2, task3])
-            logger.info("TaskScheduler started")
+            self.tasks.update([task1, task2, task3, task4])
+            
+            notification_mode = self.plugin_instance.get_config('notification_mode', 'poll')
+            if notification_mode == 'webhook':
+                await self._start_webhook()
+            elif notification_mode == 'sse':
+                self.tasks.add(asyncio.create_task(self.consume_event_stream()))
+            logger.info(f"TaskScheduler started (notification mode: {notification_mode})")
     
     async def stop(self):
         """停止调度器"""
         self.running = False
-        for task in self.tasks:
+        for task in list(self.tasks) + list(self._dispatching) + list(self._streams.values()):
             task.cancel()
         self.tasks.clear()
+        self._dispatching.clear()
+        self._streams.clear()
+        self._heap.clear()
+        self._tracked.clear()
+        try:
+            # 主动释放租约，其他进程无需等待过期即可接管
+            await self.state_manager.run(self.backend.release_leases, self.owner_id)
+        except Exception as e:
+            logger.warning(f"Release task leases failed: {e}")
+        if self._webhook is not None:
+            await self._webhook.stop()
+            self._webhook = None
+        self.push_active = False
+        self.github_client.callback_url = None
         logger.info("TaskScheduler stopped")
     
-    async def poll_analysis_status(self):
-        """轮询分析状态"""
+    async def _start_webhook(self):
+        """启动内嵌回调服务，并让后续提交的任务携带回调地址；未配置密钥时不启动，保持轮询"""
+        secret = self.plugin_instance.get_config('webhook_secret', '') or ''
+        if not secret:
+            logger.error("Webhook mode requires webhook_secret, falling back to polling")
+            return
+        port = int(self.plugin_instance.get_config('webhook_port', 8765))
+        receiver = WebhookReceiver(
+            self.on_webhook_event,
+            host=self.plugin_instance.get_config('webhook_host', '0.0.0.0'),
+            port=port,
+            secret=secret
+        )
+        try:
+            await receiver.start()
+        except OSError as e:
+            logger.error(f"Start webhook receiver failed, falling back to polling: {e}")
+            return
+        self._webhook = receiver
+        self.github_client.callback_url = (
+            self.plugin_instance.get_config('webhook_public_url', '')
+            or f"http://127.0.0.1:{port}{WebhookReceiver.PATH}"
+        )
+    
+    async def on_webhook_event(self, event: Dict):
+        """收到第一条通过校验的回调后才放慢轮询：回调地址 GithubBot 不可达时保持正常轮询节奏"""
+        if not self.push_active:
+            self.push_active = True
+            logger.info("First webhook callback received, polling slows down to reconciliation")
+        await self.handle_push_event(event)
+    
+    async def consume_event_stream(self):
+        """订阅 GithubBot 的 SSE 事件流，断线时恢复正常轮询并退避重连"""
+        delay = 1
+        
+        def on_open():
+            nonlocal delay
+            self.push_active = True
+            delay = 1
+            logger.info("Status event stream connected")
+        
         while self.running:
             try:
-                # 获取所有正在分析的会话
-                conn = sqlite3.connect(self.state_manager.db_path)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT user_id FROM user_sessions WHERE state = ?",
-                    (UserState.ANALYZING.value,)
-                )
-                user_ids = [row[0] for row in cursor.fetchall()]
-                conn.close()
-                
-                for user_id in user_ids:
-                    session = self.state_manager.get_session(user_id)
-                    if session.session_id:  # 使用session_id而不是analysis_task_id
-                        status = await self.github_client.get_analysis_status(session.session_id)
-                        if status:
-                            status_value = status.get('status')
-                            
-                            if status_value == 'success':
-                                session.state = UserState.READY_FOR_QUERY
-                                self.state_manager.save_session(session)
-                                
-                                # 发送通知
-                                message = f"✅ 仓库分析完成！\n仓库：{session.repo_url}\n现在可以开始提问了。请直接发送您的问题。"
-                                await self.send_message_to_user(user_id, message)
-                            
-                            elif status_value == 'failed':
-                                session.state = UserState.IDLE
-                                session.repo_url = None
-                                session.analysis_task_id = None
-                                session.question = None
-                                session.query_task_id = None
-                                session.session_id = None
-                                self.state_manager.save_session(session)
-                                
-                                # 发送错误通知
-                                error_msg = status.get('error', '未知错误')
-                                message = f"❌ 仓库分析失败：{error_msg}\n请使用 /repo 重新开始。"
-                                await self.send_message_to_user(user_id, message)
-                            
-                            elif status_value == 'cancelled':
-                                session.state = UserState.IDLE
-                                session.repo_url = None
-                                session.analysis_task_id = None
-                                session.question = None
-                                session.query_task_id = None
-                                session.session_id = None
-                                self.state_manager.save_session(session)
-                                
-                                # 发送取消通知
-                                message = f"🛑 仓库分析已被取消\n请使用 /repo 重新开始分析。"
-                                await self.send_message_to_user(user_id, message)
-                
-                analysis_interval = 10  # 固定轮询间隔
-                await asyncio.sleep(analysis_interval)
-            
+                async for event in self.github_client.iter_events(on_open):
+                    await self.handle_push_event(event)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Poll analysis status error: {e}")
-                await asyncio.sleep(30)  # 出错时等待更长时间
+                logger.warning(f"Status event stream error: {e}")
+            if self.push_active:
+                # 断线期间可能漏掉事件，立即恢复正常轮询节奏
+                self.push_active = False
+                self._expedite_all()
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 60)
+    
+    async def handle_push_event(self, event: Dict):
+        """处理一条推送事件：{"type": "analysis"|"query", "session_id": ...}
+        事件只是“任务有进展”的信号，状态与结果一律向 GithubBot 重新获取，不采信事件携带的内容"""
+        kind = event.get('type')
+        task_key = event.get('session_id') or event.get('task_id')
+        if kind not in ('analysis', 'query') or not isinstance(task_key, str) or not task_key:
+            return
+        # 本进程未登记的任务只有拿到租约（无人持有或持有者已失联）时才处理，避免多个进程重复推进
+        if not await self._claim_and_track(kind, task_key, str(event.get('user_id') or '')):
+            return
+        try:
+            if kind == 'analysis':
+                status = await self.github_client.get_analysis_status(task_key)
+                handled = bool(status) and await self.apply_analysis_status(task_key, status) > 0
+                finished = bool(status) and status.get('status') in self.ANALYSIS_FINAL_STATUSES
+            else:
+                question = await self.state_manager.run(self.backend.get_question_by_task, task_key)
+                status = await self.github_client.get_query_status(task_key) if question is not None else None
+                handled = status is not None
+                finished = handled and await self.apply_query_status(task_key, status)
+        except Exception as e:
+            logger.error(f"Handle {kind} event for {task_key} failed: {e}")
+            return
+        entry = self._tracked.get((kind, task_key))
+        if entry is None:
+            return
+        if not handled:
+            # 任务刚提交、会话可能尚未落盘：尽快补一次轮询
+            self._reschedule(entry, 1.0)
+        elif finished:
+            self._untrack((kind, task_key))
+    
+    def _reschedule(self, entry: PollEntry, delay: float):
+        """调整任务的下一次检查时间（旧的堆元素因 due 不匹配而失效）"""
+        entry.due = time.monotonic() + delay
+        self._push(entry)
+    
+    def _expedite_all(self):
+        """把所有在途任务拉回正常轮询节奏"""
+        for entry in list(self._tracked.values()):
+            self._reschedule(entry, self._policy(entry.kind).next_delay(0))
+    
+    def _policy(self, kind: str) -> PollPolicy:
+        return self.ANALYSIS_POLICY if kind == 'analysis' else self.QUERY_POLICY
+    
+    def _lease_seconds(self) -> float:
+        return max(1.0, float(self.plugin_instance.get_config('task_lease_seconds', 30)))
+    
+    async def track_analysis(self, user_id: str, session_id: str) -> bool:
+        """登记新提交的分析任务：取得租约后立即进入调度堆"""
+        return await self._claim_and_track('analysis', session_id, user_id)
+    
+    async def track_query(self, user_id: str, query_task_id: str) -> bool:
+        """登记新提交的查询任务：取得租约后立即进入调度堆"""
+        return await self._claim_and_track('query', query_task_id, user_id)
+    
+    async def _claim_and_track(self, kind: str, task_key: str, user_id: str) -> bool:
+        """申请任务租约并登记；任务已由其他进程持有时返回 False"""
+        if not task_key:
+            return False
+        if (kind, task_key) in self._tracked:
+            return True
+        claimed = await self.state_manager.run(
+            self.backend.claim_leases, [(kind, task_key, user_id)], self.owner_id, self._lease_seconds()
+        )
+        if claimed:
+            self._track(kind, task_key, user_id)
+        return bool(claimed)
+    
+    def _track(self, kind: str, task_key: str, user_id: str, pushed: bool = True):
+        if not task_key or (kind, task_key) in self._tracked:
+            return
+        delay = self._policy(kind).next_delay(0)
+        if self.push_active and pushed:
+            delay = max(delay, self.PUSH_FALLBACK_INTERVAL)
+        entry = PollEntry(kind, task_key, user_id, time.monotonic() + delay, pushed)
+        self._tracked[(kind, task_key)] = entry
+        self._push(entry)
+    
+    def _untrack(self, key: tuple):
+        """结束跟踪并在后台释放租约"""
+        if self._tracked.pop(key, None) is None:
+            return
+        task = asyncio.ensure_future(self._release_leases([key]))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+    
+    async def _release_leases(self, keys: List[tuple]):
+        try:
+            await self.state_manager.run(self.backend.release_leases, self.owner_id, keys)
+        except Exception as e:
+            logger.warning(f"Release task leases failed: {e}")
     
-    async def poll_query_results(self):
-        """轮询查询结果"""
+    async def maintain_leases(self):
+        """每隔租约时长的三分之一续期本进程的租约，丢弃已被接管的任务，并接管其他进程失联后过期的任务"""
         while self.running:
+            ttl = self._lease_seconds()
             try:
-                # 获取所有等待回答的会话
-                conn = sqlite3.connect(self.state_manager.db_path)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT user_id FROM user_sessions WHERE state = ?",
-                    (UserState.WAITING_FOR_ANSWER.value,)
+                held = await self.state_manager.run(self.backend.renew_leases, self.owner_id, ttl)
+                for key in [key for key in self._tracked if key not in held]:
+                    # 续期不及时（如进程长时间停顿），任务已由其他进程接管
+                    logger.warning(f"Lease for {key[0]} task {key[1]} was taken over by another worker")
+                    del self._tracked[key]
+                expired = await self.state_manager.run(
+                    self.backend.take_over_expired_leases, self.owner_id, ttl
                 )
-                user_ids = [row[0] for row in cursor.fetchall()]
-                conn.close()
-                
-                for user_id in user_ids:
-                    session = self.state_manager.get_session(user_id)
-                    if session.query_task_id:  # 使用query_task_id查询状态
-                        # 先查询状态
-                        status_result = await self.github_client.get_query_status(session.query_task_id)
-                        if status_result:
-                            status = status_result.get('status')
-                            
-                            if status == 'success':
-                                # 获取结果
-                                result = await self.github_client.get_query_result(session.query_task_id)
-                                if result:
-                                    question = session.question  # 保存问题用于显示
-                                    generation_mode = self.plugin_instance.get_generation_mode()
-                                    
-                                    if generation_mode == "service":
-                                        # 服务端模式：直接使用返回的答案
-                                        answer = result.get('answer', '无法获取答案')
-                                    else:
-                                        # 插件模式：使用返回的上下文生成答案
-                                        retrieved_context = result.get('retrieved_context', [])
-                                        if retrieved_context:
-                                            # 构建上下文字符串
-                                            context_str = "\n\n".join([chunk.get('content', '') for chunk in retrieved_context])
-                                            answer = f"根据代码库分析，以下是相关信息：\n\n{context_str}\n\n针对您的问题：{question}\n\n请注意，这是基于检索到的代码片段提供的信息，可能需要结合具体上下文进行理解。"
-                                        else:
-                                            answer = "抱歉，没有找到相关的代码信息来回答您的问题。"
-                                    
-                                    # 更新状态
-                                    session.state = UserState.READY_FOR_QUERY
-                                    session.question = None
-                                    session.query_task_id = None
-                                    # 保持session_id，用于后续查询
-                                    self.state_manager.save_session(session)
-                                    
-                                    # 发送答案
-                                    message = f"💡 **问题**：{question}\n\n📝 **答案**：\n{answer}"
-                                    await self.send_message_to_user(user_id, message)
-                            
-                            elif status == 'failure':
-                                error_msg = status_result.get('error', '处理失败')
-                                question = session.question  # 保存问题用于显示
-                                
-                                # 更新状态
-                                session.state = UserState.READY_FOR_QUERY
-                                session.question = None
-                                session.query_task_id = None
-                                # 保持session_id，用于后续查询
-                                self.state_manager.save_session(session)
-                                
-                                # 发送错误消息
-                                message = f"❌ **问题**：{question}\n\n**错误**：{error_msg}"
-                                await self.send_message_to_user(user_id, message)
-                            
-                            elif status == 'revoked':
-                                question = session.question  # 保存问题用于显示
-                                
-                                # 更新状态
-                                session.state = UserState.READY_FOR_QUERY
-                                session.question = None
-                                session.query_task_id = None
-                                # 保持session_id，用于后续查询
-                                self.state_manager.save_session(session)
-                                
-                                # 发送取消消息
-                                message = f"🚫 **问题**：{question}\n\n查询任务已被取消。"
-                                await self.send_message_to_user(user_id, message)
+                for kind, task_key, user_id in expired:
+                    logger.info(f"Took over {kind} task {task_key} from an expired lease")
+                    metrics.inc('repoinsight_lease_takeovers_total')
+                    # 失联进程可能缓存过这些会话，本进程以数据库为准
+                    self.state_manager.cache.invalidate(user_id)
+                    self._track(kind, task_key, user_id, pushed=False)
+            except Exception as e:
+                logger.error(f"Maintain task leases error: {e}")
+            await asyncio.sleep(ttl / 3)
+    
+    def _push(self, entry: PollEntry):
+        heapq.heappush(self._heap, (entry.due, next(self._seq), entry))
+        # 新任务可能比当前等待的最早任务更早到期
+        self._wakeup.set()
+    
+    async def run_poll_queue(self):
+        """按到期时间从调度堆中取出任务并发检查"""
+        while self.running:
+            try:
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    entry_due, _, entry = heapq.heappop(self._heap)
+                    # 已结束或已被重新排期的任务会在堆里留下过期元素，直接跳过
+                    if self._tracked.get((entry.kind, entry.task_key)) is entry and entry.due == entry_due:
+                        due.append(entry)
+                if due:
+                    task = asyncio.create_task(self._fan_out(self._run_entry, due))
+                    self._dispatching.add(task)
+                    task.add_done_callback(self._dispatching.discard)
                 
-                query_interval = 5  # 固定轮询间隔
-                await asyncio.sleep(query_interval)
+                timeout = self._heap[0][0] - now if self._heap else self.RECONCILE_INTERVAL
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
             
             except Exception as e:
-                logger.error(f"Poll query results error: {e}")
-                await asyncio.sleep(15)  # 出错时等待更长时间
+                logger.error(f"Poll queue error: {e}")
+                await asyncio.sleep(5)
+    
+    async def reconcile_in_flight(self):
+        """定期把数据库中的在途任务补登记到调度堆"""
+        while self.running:
+            try:
+                # 只申请本进程尚未跟踪的任务，其他进程持有未过期租约的任务会申请失败
+                candidates = {}
+                async for session in self.state_manager.iter_sessions_by_state_async(UserState.ANALYZING):
+                    if session.session_id and ('analysis', session.session_id) not in self._tracked:
+                        candidates.setdefault(('analysis', session.session_id), session.user_id)
+                for user_id, query_task_id in await self.state_manager.run(self.backend.running_questions):
+                    if ('query', query_task_id) not in self._tracked:
+                        candidates.setdefault(('query', query_task_id), user_id)
+                if candidates:
+                    claimed = await self.state_manager.run(
+                        self.backend.claim_leases,
+                        [(kind, task_key, user_id) for (kind, task_key), user_id in candidates.items()],
+                        self.owner_id, self._lease_seconds()
+                    )
+                    for kind, task_key, user_id in claimed:
+                        self._track(kind, task_key, user_id)
+                # 提交因重启或名额不足而滞留的排队问题
+                await self.pump_questions()
+                await asyncio.sleep(self.RECONCILE_INTERVAL)
+            except Exception as e:
+                logger.error(f"Reconcile in-flight tasks error: {e}")
+                await asyncio.sleep(self.RECONCILE_INTERVAL)
+    
+    async def _run_entry(self, entry: PollEntry):
+        """检查一个到期任务，未结束则按退避策略重新入堆"""
+        key = (entry.kind, entry.task_key)
+        status = None
+        try:
+            if entry.kind == 'analysis':
+                policy = self.ANALYSIS_POLICY
+                # 分析任务按 session_id 调度，多个用户共享时只请求一次
+                if not await self.state_manager.find_sessions_by_task_async(UserState.ANALYZING, entry.task_key):
+                    still_running = False
+                else:
+                    status = await self.check_analysis(entry.task_key)
+                    still_running = not status or status.get('status') not in self.ANALYSIS_FINAL_STATUSES
+            else:
+                policy = self.QUERY_POLICY
+                if entry.task_key in self._streams:
+                    # 答案正在流式转发，由流任务收尾
+                    still_running = True
+                elif await self.state_manager.run(self.backend.get_question_by_task, entry.task_key) is None:
+                    # 问题已答复，或已被用户撤回
+                    still_running = False
+                else:
+                    status = await self.github_client.get_query_status(entry.task_key)
+                    still_running = not status or not await self.apply_query_status(entry.task_key, status)
+        except Exception as e:
+            logger.error(f"Check {entry.kind} task {entry.task_key} failed: {e}")
+            still_running = True
+        
+        if self._tracked.get(key) is not entry:
+            return
+        if still_running and self.running:
+            entry.attempt += 1
+            hint = self._progress_hint(entry, status) if status else None
+            delay = policy.next_delay(entry.attempt, hint)
+            if self.push_active and entry.pushed:
+                delay = max(delay, self.PUSH_FALLBACK_INTERVAL)
+            self._reschedule(entry, delay)
+        else:
+            self._untrack(key)
+    
+    @staticmethod
+    def progress_fraction(status: Dict) -> Optional[float]:
+        """从后端状态中提取 0~1 的完成度"""
+        fractions = []
+        for done_key, total_key in (('processed_files', 'total_files'), ('indexed_chunks', 'total_chunks')):
+            total = status.get(total_key) or 0
+            if total > 0:
+                fractions.append(min(1.0, (status.get(done_key) or 0) / total))
+        if fractions:
+            return sum(fractions) / len(fractions)
+        progress = status.get('progress')
+        if isinstance(progress, (int, float)) and progress > 0:
+            return min(1.0, progress / 100 if progress > 1 else progress)
+        return None
+    
+    def _progress_hint(self, entry: PollEntry, status: Dict) -> Optional[float]:
+        """根据两次检查之间的进度速率估算剩余时间，取一半作为下一次间隔"""
+        fraction = self.progress_fraction(status)
+        if fraction is None:
+            return None
+        now = time.monotonic()
+        hint = None
+        if entry.progress is not None and fraction > entry.progress:
+            rate = (fraction - entry.progress) / (now - entry.progress_at)
+            hint = (1.0 - fraction) / rate / 2
+        entry.progress, entry.progress_at = fraction, now
+        return hint
+    
+    def _poll_semaphore(self) -> asyncio.Semaphore:
+        """按当前配置获取轮询并发信号量"""
+        concurrency = max(1, int(self.plugin_instance.get_config('poll_concurrency', 32)))
+        if self._semaphore is None or self._semaphore_size != concurrency:
+            self._semaphore = asyncio.Semaphore(concurrency)
+            self._semaphore_size = concurrency
+        return self._semaphore
+    
+    async def _fan_out(self, check, entries: List[PollEntry]):
+        """在信号量限制下并发检查一批到期任务，单个失败不影响其余任务"""
+        semaphore = self._poll_semaphore()
+        
+        async def guarded(entry: PollEntry):
+            async with semaphore:
+                try:
+                    await check(entry)
+                except Exception as e:
+                    logger.error(f"Poll check for user {entry.user_id} failed: {e}")
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(guarded(entry) for entry in entries))
+        metrics.observe('repoinsight_poll_sweep_seconds', time.perf_counter() - started)
+        metrics.inc('repoinsight_poll_checks_total', len(entries))
+    
+    async def check_analysis(self, session_id: str) -> Optional[Dict]:
+        """检查单个分析任务的状态，返回后端状态供调度器估算下次间隔"""
+        status = await self.github_client.get_analysis_status(session_id)
+        if not status:
+            return None
+        await self.apply_analysis_status(session_id, status)
+        return status
+    
+    async def apply_analysis_status(self, session_id: str, status: Dict) -> int:
+        """根据分析状态（轮询结果或推送事件）推进所有共享该分析的会话，返回实际推进的会话数"""
+        status_value = status.get('status')
+        if status_value not in self.ANALYSIS_FINAL_STATUSES:
+            return 0
+        
+        registry = self.plugin_instance.analysis_registry
+        if status_value == 'success':
+            await registry.mark_ready(session_id)
+        else:
+            await registry.forget(session_id)
+        
+        applied = 0
+        candidates = await self.state_manager.find_sessions_by_task_async(UserState.ANALYZING, session_id)
+        for candidate in candidates:
+            user_id = candidate.user_id
+            async with self.state_manager.user_lock(user_id):
+                # 在锁内从数据库重新读取，用户可能已在此期间（或在其他进程中）取消或换了仓库
+                session = await self.state_manager.reload_session_async(user_id)
+                if session.state != UserState.ANALYZING or session.session_id != session_id:
+                    continue
+                route = session.reply_route()
+                if status_value == 'success':
+                    session.state = UserState.READY_FOR_QUERY
+                    message = f"✅ 仓库分析完成！\n仓库：{session.repo_url}\n现在可以开始提问了。请直接发送您的问题。"
+                elif status_value == 'failed':
+                    error_msg = status.get('error', '未知错误')
+                    message = f"❌ 仓库分析失败：{error_msg}\n请使用 /repo 重新开始。"
+                elif status_value == 'not_found':
+                    message = "⚠️ GithubBot 上已找不到该分析任务（服务可能已重启）\n请使用 /repo 重新开始分析。"
+                else:
+                    message = f"🛑 仓库分析已被取消\n请使用 /repo 重新开始分析。"
+                if status_value != 'success':
+                    session.state = UserState.IDLE
+                    session.repo_url = None
+                    session.analysis_task_id = None
+                    session.question = None
+                    session.query_task_id = None
+                    session.session_id = None
+                await self.state_manager.save_session_async(session)
+            
+            # 发送通知（只入队，不占用用户锁）
+            await self.send_message_to_user(user_id, message, route)
+            applied += 1
+        if applied:
+            # 释放租约前落盘，其他进程随后收到同一事件时不会再看到分析中的会话
+            await self.state_manager.flush_async()
+        return applied
+    
+    async def pump_questions(self, user_id: Optional[str] = None,
+                             own_question_id: Optional[int] = None) -> Dict[int, Optional[Dict]]:
+        """在每用户与全局并发上限内提交排队的问题，返回 {问题ID: 提交结果（失败为 None，分析会话已丢失为 not_found）}；
+        给出 user_id 时只提交该用户的问题（消息处理器在用户锁内调用，不替其他用户等待提交），其余问题由后台提交；
+        提交失败的问题会通知提问者，own_question_id 除外（由调用方直接回复）"""
+        per_user_limit = max(1, int(self.plugin_instance.get_config('question_concurrency_per_user', 2)))
+        global_limit = max(1, int(self.plugin_instance.get_config('max_concurrent_queries', 256)))
+        claimed = await self.state_manager.run(self.backend.claim_questions, per_user_limit, global_limit, user_id)
+        if not claimed:
+            return {}
+        results = await asyncio.gather(*(self._submit_question(*row) for row in claimed))
+        for (question_id, asker_id, _, question), result in zip(claimed, results):
+            if question_id == own_question_id or (result and result.get("session_id")):
+                continue
+            if result is None:
+                message = f"❌ **问题**：{question}\n\n提交失败，请稍后重新提问。"
+            else:
+                # 会话在用户下次提问时重置（这里不持有提问者的用户锁）
+                message = f"❌ **问题**：{question}\n\n{self.LOST_ANALYSIS_HINT}"
+            session = await self.state_manager.get_session_async(asker_id)
+            await self.send_message_to_user(asker_id, message, session.reply_route())
+        return {row[0]: result for row, result in zip(claimed, results)}
+    
+    async def _submit_question(self, question_id: int, user_id: str, analysis_session_id: str,
+                               question: str) -> Optional[Dict]:
+        """提交一个已领取的问题并登记查询任务；失败时移出队列"""
+        generation_mode = self.plugin_instance.get_generation_mode()
+        llm_config = self.plugin_instance.get_llm_config() if generation_mode == "service" else None
+        try:
+            result = await self.github_client.submit_query(analysis_session_id, question, llm_config, generation_mode)
+        except Exception as e:
+            logger.error(f"Submit question {question_id} failed: {e}")
+            result = None
+        if not result or not result.get("session_id"):
+            await self.state_manager.run(self.backend.drop_question, question_id)
+            if result and result.get("status") == "not_found":
+                # 分析会话已在 GithubBot 上丢失（如服务重启），移出登记，之后的 /repo 会重新分析
+                await self.plugin_instance.analysis_registry.forget(analysis_session_id)
+                return result
+            return None
+        query_task_id = result.get("task_id")
+        if not await self.state_manager.run(self.backend.mark_question_running, question_id, query_task_id):
+            # 提交期间用户已退出，结果到达后直接丢弃
+            return result
+        if not await self.track_query(user_id, query_task_id):
+            # 其他进程对账时已经接管了这个任务
+            return result
+        if generation_mode == "service":
+            # 服务端生成的答案可以边生成边转发
+            session = await self.state_manager.get_session_async(user_id)
+            self.start_answer_stream(user_id, query_task_id, question, session.reply_route())
+        return result
+    
+    async def apply_query_status(self, query_task_id: str, status_result: Dict) -> bool:
+        """根据查询状态（轮询结果或推送事件）答复对应的问题，成功时获取并发送答案；返回查询是否已结束"""
+        status = status_result.get('status')
+        if status not in ('success', 'failure', 'revoked') or query_task_id in self._streams:
+            return False
+        
+        result = None
+        if status == 'success':
+            # 获取结果（推送事件可能已携带结果），网络请求不占用用户锁
+            if 'answer' in status_result or 'retrieved_context' in status_result:
+                result = self.github_client.slim_query_result(status_result)
+            else:
+                result = await self.github_client.get_query_result(query_task_id)
+            if not result:
+                return False
+        
+        # 先构造答案再取出问题：构造失败时问题仍在队列中，下次检查会重试
+        generation_mode = self.plugin_instance.get_generation_mode()
+        payload = None
+        if status == 'success':
+            payload = build_answer_payload(
+                result, generation_mode, int(self.plugin_instance.get_config('context_token_budget', 1200))
+            )
+        
+        # 取出问题后才答复：轮询、推送与流式收尾并发时只发送一次；问题已被撤回时不再发送
+        taken = await self.state_manager.run(self.backend.take_question, query_task_id)
+        if taken is None:
+            self._interrupted_streams.discard(query_task_id)
+            return True
+        _, user_id, analysis_session_id, question = taken
+        session = await self.state_manager.get_session_async(user_id)
+        if status == 'success':
+            answer = render_answer(generation_mode, payload, question)
+            message = f"💡 **问题**：{question}\n\n📝 **答案**：\n{answer}"
+            if query_task_id in self._interrupted_streams:
+                message = "（流式输出中断，以下为完整答案）\n" + message
+            if result.get('truncated'):
+                message += "\n\n⚠️ 结果过大，以上内容已截断。"
+                # 截断的答案不进入答案缓存
+                payload = None
+        elif status == 'failure':
+            error_msg = status_result.get('error', '处理失败')
+            message = f"❌ **问题**：{question}\n\n**错误**：{error_msg}"
+        else:
+            message = f"🚫 **问题**：{question}\n\n查询任务已被取消。"
+        
+        if payload and analysis_session_id:
+            await self.plugin_instance.answer_cache.store(analysis_session_id, generation_mode, question, payload)
+        self._interrupted_streams.discard(query_task_id)
+        await self.send_message_to_user(user_id, message, session.reply_route())
+        # 空出的名额交给排队的问题
+        await self.pump_questions()
+        return True
+    
+    def start_answer_stream(self, user_id: str, query_task_id: str, question: str, route: tuple):
+        """后端支持流式答案时，在后台边生成边转发；否则保持轮询"""
+        if (not self.plugin_instance.get_config('stream_answers', True)
+                or not self.github_client.streaming_supported or query_task_id in self._streams):
+            return
+        task = asyncio.create_task(self.stream_answer(user_id, query_task_id, question, route))
+        self._streams[query_task_id] = task
+        task.add_done_callback(lambda _: self._streams.pop(query_task_id, None))
+    
+    async def stream_answer(self, user_id: str, query_task_id: str, question: str, route: tuple):
+        """按段落攒批、限频转发流式答案；只保留未发送的尾部和有限长度的完整副本，内存有界"""
+        header = f"💡 **问题**：{question}\n\n📝 **答案**：\n"
+        # 同一用户可能有多个答案同时流式输出，后续分片标注所属问题
+        follow_up = ""
+        if int(self.plugin_instance.get_config('question_concurrency_per_user', 2)) > 1:
+            label = question if len(question) <= 20 else question[:20] + "…"
+            follow_up = f"💬 {label}（续）\n"
+        limit = max(self.STREAM_MIN_CHARS, int(self.plugin_instance.get_config('message_chunk_size', 1500)))
+        buffer = ""
+        captured: Optional[List[str]] = []
+        captured_size = 0
+        sent_any = False
+        last_sent = 0.0
+        final = None
+        try:
+            async for event in self.github_client.iter_query_stream(query_task_id):
+                if event.get('done'):
+                    final = event
+                    break
+                delta = event.get('delta') or ''
+                buffer += delta
+                if captured is not None:
+                    captured_size += len(delta)
+                    if captured_size > self.STREAM_CACHE_LIMIT:
+                        captured = None
+                    else:
+                        captured.append(delta)
+                # 到了发送间隔，或缓冲超过单条消息长度时发出已完整的段落
+                while buffer and (time.monotonic() - last_sent >= self.STREAM_SEND_INTERVAL or len(buffer) >= limit):
+                    ready, buffer = self._take_paragraphs(buffer, limit)
+                    if not ready:
+                        break
+                    await self.send_message_to_user(user_id, (follow_up if sent_any else header) + ready, route)
+                    sent_any = True
+                    last_sent = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Answer stream for {query_task_id} interrupted: {e}")
+        
+        if final is None or final.get('status', 'success') != 'success':
+            # 流不可用、中断或失败：交回轮询处理，已发出部分内容时完整答案会附带说明
+            if sent_any:
+                self._interrupted_streams.add(query_task_id)
+            entry = self._tracked.get(('query', query_task_id))
+            if entry is not None:
+                self._reschedule(entry, 0.5)
+            return
+        
+        taken = await self.state_manager.run(self.backend.take_question, query_task_id)
+        self._untrack(('query', query_task_id))
+        if taken is None:
+            # 问题已被撤回
+            return
+        analysis_session_id = taken[2]
+        rest = buffer.strip()
+        if rest or not sent_any:
+            await self.send_message_to_user(user_id, (follow_up if sent_any else header) + (rest or '无法获取答案'), route)
+        if captured and analysis_session_id:
+            await self.plugin_instance.answer_cache.store(
+                analysis_session_id, self.plugin_instance.get_generation_mode(), question, "".join(captured)
+            )
+        await self.pump_questions()
+    
+    def _take_paragraphs(self, buffer: str, limit: int) -> tuple:
+        """从缓冲中切出已完整的段落；缓冲超过 limit 时在最后一个换行处强制切出"""
+        window = buffer[:limit]
+        cut = window.rfind("\n\n")
+        if cut < self.STREAM_MIN_CHARS:
+            if len(buffer) < limit:
+                return "", buffer
+            cut = window.rfind("\n")
+            if cut <= 0:
+                cut = limit
+        return buffer[:cut].strip(), buffer[cut:].lstrip("\n")
     
     async def cleanup_inactive_users(self):
-        """清理不活跃用户"""
+        """清理不活跃用户，随后回收空闲页并截断 WAL，保持数据库文件大小稳定"""
         while self.running:
             try:
                 cleanup_hours = 24  # 固定清理间隔
-                self.state_manager.cleanup_inactive_sessions(cleanup_hours)
+                removed = await self.state_manager.cleanup_inactive_sessions_async(cleanup_hours)
+                busy, wal_pages, _ = await self.state_manager.reclaim_space_async()
+                if removed or busy:
+                    logger.info(f"Removed {removed} inactive sessions (WAL checkpoint busy={busy}, pages={wal_pages})")
                 cleanup_interval = 3600  # 固定清理间隔
                 await asyncio.sleep(cleanup_interval)
             except Exception as e:
                 logger.error(f"Cleanup inactive users error: {e}")
                 await asyncio.sleep(3600)
     
-    async def send_message_to_user(self, user_id: str, message: str):
-        """发送消息给用户"""
-        try:
-            adapters = self.plugin_instance.host.get_platform_adapters()
-            if adapters and len(adapters) > 0:
-                adapter = adapters[0]  # 使用第一个可用的适配器
-                message_chain = MessageChain([
-                    Plain(message)
-                ])
-                await self.plugin_instance.host.send_active_message(
-                    adapter=adapter,
-                    target_type="person",
-                    target_id=user_id,
-                    message=message_chain
-                )
-            else:
-                logger.warning(f"No platform adapters available to send message to user {user_id}")
-        except Exception as e:
-            logger.error(f"Send message to user {user_id} failed: {e}")
+    async def send_message_to_user(self, user_id: str, message: str, route: Optional[tuple] = None):
+        """发送消息给用户（交给投递队列，轮询不等待实际发送）"""
+        self.plugin_instance.notification_dispatcher.enqueue(user_id, message, route)
 
 # 主插件类
 @register(name="RepoInsight", description="GitHub仓库智能分析插件", version="1.0.0", author="oGYCo")
@@ -664,11 +3993,55 @@ class RepoInsightPlugin(BasePlugin):
         db_path = self.get_config('database_path', 'repo_insight.db')
         github_base_url = self.get_githubbot_base_url()
         
-        self.state_manager = StateManager(db_path)
+        self.state_manager = StateManager(
+            db_path,
+            flush_interval_ms=float(self.get_config('db_flush_interval_ms', 200)),
+            flush_batch_size=int(self.get_config('db_flush_batch_size', 500)),
+            backend=create_state_backend(
+                self.get_config('state_backend', 'sqlite'), db_path, int(self.get_config('state_shards', 4))
+            )
+        )
+        self.analysis_registry = AnalysisRegistry(
+            self.state_manager,
+            ttl_hours=self.get_config('analysis_registry_ttl_hours', 24)
+        )
+        self.answer_cache = AnswerCache(
+            self.state_manager,
+            similarity=self.get_config('answer_cache_similarity', 0.85)
+        )
         self.github_client = GithubBotClient(github_base_url)
+        self.health_monitor = HealthMonitor(self.github_client)
+        self.notification_dispatcher = NotificationDispatcher(self)
+        self.metrics_exporter: Optional[MetricsExporter] = None
+        self.register_metrics()
         self.message_handler = MessageHandler(self.state_manager, self.github_client, self)
         self.task_scheduler = TaskScheduler(self.state_manager, self.github_client, self)
     
+    def register_metrics(self):
+        """注册按需读取的瞬时指标"""
+        metrics.describe('repoinsight_handle_seconds', 'Message handling latency by command or session state')
+        metrics.describe('repoinsight_poll_sweep_seconds', 'Duration of one batch of due task checks')
+        metrics.describe('repoinsight_http_request_seconds', 'GithubBot request latency by endpoint')
+        metrics.describe('repoinsight_http_requests_total', 'GithubBot responses by endpoint and status')
+        metrics.describe('repoinsight_db_op_seconds', 'StateManager operation latency on the database thread')
+        metrics.describe('repoinsight_lease_takeovers_total', 'In-flight tasks taken over from workers whose lease expired')
+        metrics.describe('repoinsight_http_truncated_total', 'GithubBot responses cut off at max_response_bytes')
+        metrics.describe('repoinsight_group_prefilter_total', 'Group messages by pre-filter outcome (ignored and idle never touch storage)')
+        metrics.gauge('repoinsight_tasks_in_flight', lambda: len(self.task_scheduler._tracked),
+                      'Analysis and query tasks awaiting completion')
+        metrics.gauge('repoinsight_notify_queue_depth', self.notification_dispatcher.pending,
+                      'Proactive messages waiting for delivery')
+        metrics.gauge('repoinsight_notify_sent_total', lambda: self.notification_dispatcher.sent,
+                      'Proactive message chunks delivered', kind='counter')
+        metrics.gauge('repoinsight_notify_failed_total', lambda: self.notification_dispatcher.failed,
+                      'Proactive messages abandoned after retries', kind='counter')
+        metrics.gauge('repoinsight_db_pending_writes', lambda: len(self.state_manager._pending),
+                      'Session updates waiting in the write-behind buffer')
+        metrics.gauge('repoinsight_session_cache_hit_rate', lambda: self.state_manager.cache.stats()['hit_rate'],
+                      'Session cache hit rate')
+        metrics.gauge('repoinsight_answer_cache_hit_rate', lambda: self.answer_cache.stats()['hit_rate'],
+                      'Answer cache hit rate')
+    
     def get_config(self, key: str, default=None):
         """从插件配置中获取值"""
         # 优先从 self.config 获取（LangBot 插件管理器设置的）
@@ -713,17 +4086,44 @@ class RepoInsightPlugin(BasePlugin):
         # 同时更新 self.config（与 LangBot 插件管理器保持一致）
         if hasattr(self, 'config'):
             self.config.update(new_config)
-        # 更新 GitHub 客户端的基础 URL
-        new_base_url = self.get_githubbot_base_url()
+        # 更新 GitHub 客户端的基础 URL、超时与重试配置
         if hasattr(self, 'github_client'):
-            self.github_client.base_url = new_base_url
+            self.configure_github_client()
         logger.info(f"Plugin config updated: {list(new_config.keys())}")
     
+    def configure_github_client(self):
+        """按当前配置调整 GithubBot 客户端的超时、重试与连接池"""
+        self.github_client.configure(
+            base_url=self.get_githubbot_base_url(),
+            timeout=float(self.get_config('http_timeout', 30)),
+            retry_attempts=int(self.get_config('http_retry_attempts', 3)),
+            retry_delay=float(self.get_config('http_retry_delay', 1)),
+            pool_limit=int(self.get_config('http_pool_limit', 100)),
+            pool_limit_per_host=int(self.get_config('http_pool_limit_per_host', 50)),
+            keepalive_timeout=float(self.get_config('http_keepalive_timeout', 30)),
+            dns_cache_ttl=int(self.get_config('http_dns_cache_ttl', 300)),
+            max_response_bytes=int(self.get_config('max_response_bytes', 1024 * 1024))
+        )
+    
     async def initialize(self):
         """异步初始化"""
         logger.info("RepoInsight plugin initializing...")
+        started = time.perf_counter()
+        # 建表与迁移推迟到这里并放到数据库线程，LangBot 加载插件时不做磁盘 I/O
+        await self.state_manager.open_async()
+        self.configure_github_client()
+        self.health_monitor.start()
+        self.notification_dispatcher.start()
         await self.task_scheduler.start()
-        logger.info("RepoInsight plugin initialized successfully")
+        metrics_port = int(self.get_config('metrics_port', 0) or 0)
+        if metrics_port:
+            self.metrics_exporter = MetricsExporter(metrics, port=metrics_port)
+            try:
+                await self.metrics_exporter.start()
+            except OSError as e:
+                logger.error(f"Start metrics exporter failed: {e}")
+                self.metrics_exporter = None
+        logger.info(f"RepoInsight plugin initialized successfully in {(time.perf_counter() - started) * 1000:.0f} ms")
     
     @handler(PersonNormalMessageReceived)
     async def person_normal_message_received(self, ctx: EventContext):
@@ -741,6 +4141,7 @@ class RepoInsightPlugin(BasePlugin):
             ctx.prevent_default()
         except Exception as e:
             logger.error(f"Handle person message error: {e}")
+            metrics.inc('repoinsight_handle_errors_total')
             ctx.add_return("reply", ["处理消息时发生错误，请稍后再试。"])
             ctx.prevent_default()
     
@@ -754,26 +4155,26 @@ class RepoInsightPlugin(BasePlugin):
         message = ctx.event.text_message
         user_id = str(ctx.event.sender_id)
         
-        # 检查是否需要@机器人
+        # 先按消息链中的 @ 与已知指令表预过滤，大部分群消息在这里结束，不读写存储
         require_mention = self.get_config('require_mention_in_group', True)
-        should_process = False
-        
-        if message.startswith('/'):
-            should_process = True
-        elif require_mention and '@' in message:
-            should_process = True
-        elif not require_mention:
-            should_process = True
+        outcome = self.message_handler.prefilter_group(ctx, message, user_id, require_mention)
+        metrics.inc('repoinsight_group_prefilter_total', outcome=outcome)
+        if outcome == "ignored":
+            return
+        if outcome == "idle":
+            ctx.add_return("reply", [self.message_handler.IDLE_HINT])
+            ctx.prevent_default()
+            return
         
-        if should_process:
-            try:
-                response = await self.message_handler.handle(ctx, message, user_id)
-                ctx.add_return("reply", [response])
-                ctx.prevent_default()
-            except Exception as e:
-                logger.error(f"Handle group message error: {e}")
-                ctx.add_return("reply", ["处理消息时发生错误，请稍后再试。"])
-                ctx.prevent_default()
+        try:
+            response = await self.message_handler.handle(ctx, message, user_id)
+            ctx.add_return("reply", [response])
+            ctx.prevent_default()
+        except Exception as e:
+            logger.error(f"Handle group message error: {e}")
+            metrics.inc('repoinsight_handle_errors_total')
+            ctx.add_return("reply", ["处理消息时发生错误，请稍后再试。"])
+            ctx.prevent_default()
     
     def __del__(self):
         """插件卸载时的清理工作"""
@@ -785,5 +4186,10 @@ class RepoInsightPlugin(BasePlugin):
     async def cleanup(self):
         """清理资源"""
         await self.task_scheduler.stop()
+        await self.notification_dispatcher.stop()
+        if self.metrics_exporter is not None:
+            await self.metrics_exporter.stop()
+        await self.health_monitor.stop()
         await self.github_client.close()
+        await self.state_manager.close_async()
         logger.info("RepoInsight plugin cleaned up")
\ No newline at end of file
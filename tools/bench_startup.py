@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+插件启动耗时基准
+每轮在新的子进程中测量 import main、构造插件与 initialize() 的耗时，以及 initialize() 期间事件循环的最长停顿，
+并检查导入时没有加载 aiohttp 等重依赖、构造插件时没有打开数据库；超出预算时以非零状态退出，可用于回归检查。
+
+用法: python tools/bench_startup.py --repeat 5 --max-import-ms 150
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+# 插件导入时不应加载的模块（只在首次使用时导入）
+LAZY_MODULES = ('aiohttp', 'yaml')
+
+
+def measure_child():
+    """子进程：冷启动测量一次，结果以 JSON 打印到标准输出"""
+    sys.path.insert(0, str(TOOLS_DIR))
+    import langbot_stub
+
+    # 宿主本身的导入开销不计入插件
+    langbot_stub.install()
+    os.chdir(tempfile.mkdtemp(prefix='repoinsight-startup-'))
+
+    started = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - started) * 1000
+    eager = [name for name in LAZY_MODULES if name in sys.modules]
+
+    class Host:
+        def get_platform_adapters(self):
+            return []
+
+    started = time.perf_counter()
+    plugin = main.RepoInsightPlugin(Host())
+    construct_ms = (time.perf_counter() - started) * 1000
+    db_opened = any(name.endswith('.db') for name in os.listdir('.'))
+    # 指向不可达地址，健康检查在后台失败即可
+    plugin.config = {'githubbot_base_url': 'http://127.0.0.1:9'}
+
+    async def initialize():
+        longest = 0.0
+        done = False
+
+        async def ticker():
+            # 事件循环被同步调用阻塞时，两次唤醒的间隔会明显变长
+            nonlocal longest
+            last = time.perf_counter()
+            while not done:
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                longest = max(longest, now - last)
+                last = now
+
+        probe = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await plugin.initialize()
+        elapsed = (time.perf_counter() - started) * 1000
+        done = True
+        await probe
+        await plugin.cleanup()
+        return elapsed, longest * 1000
+
+    initialize_ms, loop_block_ms = asyncio.run(initialize())
+    print(json.dumps({
+        'import_ms': import_ms,
+        'construct_ms': construct_ms,
+        'initialize_ms': initialize_ms,
+        'loop_block_ms': loop_block_ms,
+        'eager_imports': eager,
+        'db_opened_in_constructor': db_opened,
+    }))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='冷启动测量轮数，报告中位数')
+    parser.add_argument('--max-import-ms', type=float, default=150, help='import main 耗时预算（中位数）')
+    parser.add_argument('--max-construct-ms', type=float, default=20, help='构造插件耗时预算（中位数）')
+    parser.add_argument('--max-initialize-ms', type=float, default=500, help='initialize() 耗时预算（中位数）')
+    parser.add_argument('--max-loop-block-ms', type=float, default=50, help='initialize() 期间事件循环最长停顿预算（中位数）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出报告')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure_child()
+        return
+
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, __file__, '--child'], check=True,
+                                capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {key: round(statistics.median(run[key] for run in runs), 2)
+              for key in ('import_ms', 'construct_ms', 'initialize_ms', 'loop_block_ms')}
+    report['eager_imports'] = sorted({name for run in runs for name in run['eager_imports']})
+    report['db_opened_in_constructor'] = any(run['db_opened_in_constructor'] for run in runs)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<26} {value}")
+
+    failures = []
+    for key, budget in (('import_ms', args.max_import_ms), ('construct_ms', args.max_construct_ms),
+                        ('initialize_ms', args.max_initialize_ms), ('loop_block_ms', args.max_loop_block_ms)):
+        if report[key] > budget:
+            failures.append(f"{key} {report[key]} > {budget}")
+    if report['eager_imports']:
+        failures.append(f"imported at load time: {', '.join(report['eager_imports'])}")
+    if report['db_opened_in_constructor']:
+        failures.append("database opened in the plugin constructor")
+    if failures:
+        print("FAILED: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+StateManager 存储基准测试
+对比旧的“每次调用新建连接”方式与长连接方式的 ops/sec，
+突发流量下逐条提交与写后缓冲（group commit）的事务数，以及多进程并发写入时单文件与分片存储的吞吐
+
+用法: python tools/bench_state_manager.py [--users 500] [--rounds 4]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import langbot_stub  # noqa: E402
+
+langbot_stub.install()
+
+from main import StateManager, UserSession, UserState, create_state_backend  # noqa: E402
+
+
+class CommitPerSaveStateManager(StateManager):
+    """同步读写入口：读优先命中缓存，每次保存立即提交（写后缓冲之前的行为）"""
+
+    def get_session(self, user_id):
+        session = self.cache.get(user_id)
+        return session if session is not None else self._load_session(user_id)
+
+    def save_session(self, session):
+        if self._enqueue(session):
+            self.flush()
+
+
+class ConnectPerCallStateManager(StateManager):
+    """旧实现：每个操作都 connect / commit / close"""
+
+    def get_session(self, user_id):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT * FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+        conn.close()
+        if row:
+            return self._row_to_session(row)
+        return UserSession(user_id)
+
+    def save_session(self, session):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT OR REPLACE INTO user_sessions
+            (user_id, state, repo_url, analysis_task_id, question, query_task_id, session_id, last_activity)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (session.user_id, session.state.value, session.repo_url, session.analysis_task_id,
+              session.question, session.query_task_id, session.session_id,
+              int(session.last_activity.timestamp())))
+        conn.commit()
+        conn.close()
+
+
+def run(manager_cls, db_path, users, rounds):
+    """模拟消息处理：每条消息一次读 + 一次写"""
+    manager = manager_cls(db_path)
+    # 建表在 open() 中完成，旧实现直接用 sqlite3 读写，需要先建好表
+    manager.backend.open()
+    states = list(UserState)
+    ops = 0
+    start = time.perf_counter()
+    for round_index in range(rounds):
+        for i in range(users):
+            session = manager.get_session(f"user-{i}")
+            session.state = states[(i + round_index) % len(states)]
+            session.repo_url = f"https://github.com/org/repo-{i % 50}"
+            manager.save_session(session)
+            ops += 2
+    elapsed = time.perf_counter() - start
+    if hasattr(manager, 'close'):
+        manager.close()
+    return ops, elapsed
+
+
+async def run_burst(db_path, write_behind, users, messages):
+    """模拟突发流量：所有用户同时连续发消息，每条消息一次异步读 + 一次异步写"""
+    manager = CommitPerSaveStateManager(db_path)
+    await manager.open_async()
+    states = list(UserState)
+
+    async def user_burst(i):
+        for n in range(messages):
+            async with manager.user_lock(f"user-{i}"):
+                session = await manager.get_session_async(f"user-{i}")
+                session.state = states[(i + n) % len(states)]
+                if write_behind:
+                    await manager.save_session_async(session)
+                else:
+                    # 写后缓冲之前的行为：每次保存一个事务
+                    await manager.run(manager.save_session, session)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user_burst(i) for i in range(users)))
+    await manager.close_async()
+    return manager.flushes, manager.flushed_rows, time.perf_counter() - start
+
+
+def write_sessions(db_path, backend, shards, writer, writes, barrier, results):
+    """一个写进程：每次提交一个会话"""
+    store = create_state_backend(backend, db_path, shards)
+    store.open()
+    now = int(time.time())
+    barrier.wait()
+    start = time.perf_counter()
+    for i in range(writes):
+        store.write_sessions([(f"writer-{writer}-user-{i % 500}", UserState.IDLE.value, None, None, None, None,
+                               None, now, None, None, None)])
+    results.put(time.perf_counter() - start)
+    store.close()
+
+
+def run_writers(db_path, backend, shards, writers, writes):
+    """多个进程同时写入同一个状态库，返回最慢进程的耗时"""
+    # 先在父进程建好表，写进程计时时不包含建表与迁移
+    store = create_state_backend(backend, db_path, shards)
+    store.open()
+    store.close()
+    barrier = multiprocessing.Barrier(writers)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=write_sessions,
+                                args=(db_path, backend, shards, writer, writes, barrier, results))
+        for writer in range(writers)
+    ]
+    for process in processes:
+        process.start()
+    elapsed = max(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--burst-messages', type=int, default=5)
+    parser.add_argument('--shards', type=int, default=4, help='sharded_sqlite 后端的分片数')
+    parser.add_argument('--writers', type=int, default=4, help='并发写入的进程数')
+    parser.add_argument('--writes', type=int, default=2000, help='每个写进程的提交次数')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cls in (('connect-per-call', ConnectPerCallStateManager), ('persistent', CommitPerSaveStateManager)):
+            db_path = os.path.join(tmp, f"{name}.db")
+            ops, elapsed = run(cls, db_path, args.users, args.rounds)
+            results[name] = ops / elapsed
+            print(f"{name:<18} {ops:>8} ops in {elapsed:7.3f}s  -> {ops / elapsed:10.0f} ops/sec")
+
+    speedup = results['persistent'] / results['connect-per-call']
+    print(f"speedup: {speedup:.1f}x")
+
+    transactions = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, write_behind in (('commit-per-save', False), ('write-behind', True)):
+            flushes, rows, elapsed = asyncio.run(
+                run_burst(os.path.join(tmp, f"{name}.db"), write_behind, args.users, args.burst_messages)
+            )
+            transactions[name] = flushes
+            print(f"{name:<18} {args.users * args.burst_messages:>8} saves -> {flushes:6} transactions, "
+                  f"{rows:6} rows in {elapsed:7.3f}s")
+    reduction = transactions['commit-per-save'] / max(1, transactions['write-behind'])
+    print(f"write transactions reduced: {reduction:.1f}x")
+
+
+    # 多进程并发逐条写入：单文件共用一把写锁，分片后端按 user_id 分散到多个文件
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ('sqlite', 'sharded_sqlite'):
+            elapsed = run_writers(os.path.join(tmp, f"{backend}.db"), backend, args.shards,
+                                  args.writers, args.writes)
+            total = args.writers * args.writes
+            print(f"{backend:<18} {args.writers} writers x {args.writes} commits in {elapsed:7.3f}s  "
+                  f"-> {total / elapsed:10.0f} commits/sec")
+
+if __name__ == '__main__':
+    main()
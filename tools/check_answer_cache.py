@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+答案缓存近似匹配检查
+先缓存一个长问题的答案，再查询只改动一个实词、含义已经不同的变体，检查它们都不命中缓存；
+同时检查只有大小写、标点或虚词不同的问题仍然复用答案。结果与预期不符时以非零状态退出。
+
+用法: python tools/check_answer_cache.py [--backend sqlite]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import langbot_stub  # noqa: E402
+
+langbot_stub.install()
+
+from main import AnswerCache, StateManager, create_state_backend  # noqa: E402
+
+BASE = ("How does the router dispatch incoming HTTP requests to the controllers, including the middleware "
+        "chain, error handling and authentication hooks, and where in the code base is all of that configured?")
+
+# 只改一个词、含义不同：必须不命中
+CHANGED = [
+    BASE.replace("incoming", "outgoing"),
+    BASE.replace("including", "excluding"),
+    BASE.replace("HTTP", "gRPC"),
+    BASE.replace("controllers", "views"),
+    "这个仓库是如何处理用户登录请求的？",
+]
+
+# 大小写、标点、虚词不同：应当命中
+SAME = [
+    BASE.upper().replace(",", ""),
+    "Please, " + BASE,
+    BASE.replace("the router", "router"),
+    "这个仓库是如何处理用户注册请求的",
+]
+
+
+async def run(args, db_path):
+    manager = StateManager(db_path, backend=create_state_backend(args.backend, db_path))
+    await manager.open_async()
+    cache = AnswerCache(manager)
+    failures = []
+    try:
+        await cache.store("session", "service", BASE, "ANSWER-BASE")
+        await cache.store("session", "service", "这个仓库是如何处理用户注册请求的？", "ANSWER-ZH")
+        for question in CHANGED:
+            answer = await cache.lookup("session", "service", question)
+            if answer is not None:
+                failures.append(f"changed question hit {answer}: {question[:60]}")
+        for question in SAME:
+            if await cache.lookup("session", "service", question) is None:
+                failures.append(f"equivalent question missed: {question[:60]}")
+    finally:
+        await manager.close_async()
+    return failures, cache.stats()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'memory', 'sharded_sqlite'],
+                        help='状态存储后端')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        failures, stats = asyncio.run(run(args, os.path.join(tmp, 'cache.db')))
+    print(f"hits={stats['hits']} near_hits={stats['near_hits']} misses={stats['misses']}")
+    if failures:
+        print("FAILED: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+    print("one-word changes miss the answer cache, equivalent phrasings still hit")
+
+
+if __name__ == '__main__':
+    main_cli()
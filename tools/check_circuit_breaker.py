@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+熔断器恢复检查
+用本地 GithubBot 替身让熔断器打开，再让半开状态下的探测请求被调用方超时取消、或在发出前意外出错，
+之后恢复后端，检查 GithubBotClient 能在冷却后重新探测并恢复正常；熔断器卡住时以非零状态退出。
+
+用法: python tools/check_circuit_breaker.py --reset-timeout 0.5
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import langbot_stub  # noqa: E402
+
+langbot_stub.install()
+
+import main  # noqa: E402
+from fake_githubbot import FakeGithubBot  # noqa: E402
+
+
+async def recovers(client, session_id, deadline):
+    """后端恢复后反复查询，直到拿到结果或超过期限"""
+    while time.monotonic() < deadline:
+        if await client.get_analysis_status(session_id) is not None:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def run(args):
+    fake = FakeGithubBot(analysis_seconds=60)
+    fake.hang_seconds = 1
+    base_url = await fake.start()
+    breaker = main.CircuitBreaker(failure_threshold=2, reset_timeout=args.reset_timeout)
+    client = main.GithubBotClient(base_url, retry_attempts=0, breaker=breaker)
+    failures = []
+    try:
+        session_id = (await client.start_analysis("https://github.com/check/breaker"))["session_id"]
+
+        async def open_breaker():
+            fake.fault = 'error'
+            for _ in range(breaker.failure_threshold + 1):
+                await client.get_analysis_status(session_id)
+            await asyncio.sleep(args.reset_timeout * 1.2)
+
+        # 场景一：探测请求挂起，被调用方的 wait_for 超时取消
+        await open_breaker()
+        fake.fault = 'hang'
+        try:
+            await asyncio.wait_for(client.get_analysis_status(session_id), timeout=0.2)
+        except asyncio.TimeoutError:
+            pass
+        fake.fault = None
+        if not await recovers(client, session_id, time.monotonic() + args.reset_timeout * 5):
+            failures.append(f"cancelled probe: breaker stuck in {breaker.state}")
+
+        # 场景二：探测请求在发出前抛出意外异常
+        await open_breaker()
+        fake.fault = None
+        get_session = client._get_session
+
+        async def broken_session():
+            client._get_session = get_session
+            raise RuntimeError("injected error")
+
+        client._get_session = broken_session
+        await client.get_analysis_status(session_id)
+        if not await recovers(client, session_id, time.monotonic() + args.reset_timeout * 5):
+            failures.append(f"failed probe: breaker stuck in {breaker.state}")
+    finally:
+        await client.close()
+        await fake.stop()
+    return failures
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--reset-timeout', type=float, default=0.5, help='熔断冷却时间（秒）')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    failures = asyncio.run(run(args))
+    if failures:
+        print("FAILED: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+    print("circuit breaker recovers after cancelled and failed probes")
+
+
+if __name__ == '__main__':
+    main_cli()
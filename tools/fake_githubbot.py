@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GithubBot 本地替身服务
+实现插件用到的 /health 与 /api/v1/repos/* 接口，支持轮询、webhook 回调、SSE 事件流
+和流式答案，用于离线调试推送模式和压测。
+
+用法: python tools/fake_githubbot.py --port 8000 --analysis-seconds 20 --query-seconds 3 --answer-paragraphs 8
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+
+class FakeGithubBot:
+    """内存中的 GithubBot：任务按设定时长“完成”，完成时推送事件"""
+
+    def __init__(self, latency_ms: float = 0, analysis_seconds: float = 10,
+                 query_seconds: float = 2, jitter: float = 0.2, webhook_token: str = "",
+                 answer_paragraphs: int = 1, streaming: bool = True):
+        self.latency_ms = latency_ms
+        self.analysis_seconds = analysis_seconds
+        self.query_seconds = query_seconds
+        self.jitter = jitter
+        self.webhook_token = webhook_token
+        self.answer_paragraphs = answer_paragraphs
+        # 为 False 时流式接口返回 404，模拟旧版 GithubBot
+        self.streaming = streaming
+        # 故障注入：'error' 时所有接口返回 503，'hang' 时请求挂起 hang_seconds 秒后再处理
+        self.fault = None
+        self.hang_seconds = 30
+        self.analyses = {}
+        self.queries = {}
+        # 各接口请求计数，压测时用于计算后端请求放大倍数
+        self.requests = Counter()
+        self._subscribers = set()
+        self._background = set()
+        self._runner = None
+        self.port = None
+
+    @web.middleware
+    async def inject_fault(self, request, handler):
+        if self.fault == 'error' and request.path != '/_stats':
+            return web.json_response({'detail': 'injected failure'}, status=503)
+        if self.fault == 'hang' and request.path != '/_stats':
+            await asyncio.sleep(self.hang_seconds)
+        return await handler(request)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.inject_fault])
+        app.router.add_get('/health', self.health)
+        app.router.add_post('/api/v1/repos/analyze', self.analyze)
+        app.router.add_get('/api/v1/repos/status/{session_id}', self.analysis_status)
+        app.router.add_post('/api/v1/repos/analyze/{session_id}/cancel', self.cancel_analysis)
+        app.router.add_post('/api/v1/repos/query', self.query)
+        app.router.add_get('/api/v1/repos/query/status/{session_id}', self.query_status)
+        app.router.add_get('/api/v1/repos/query/result/{session_id}', self.query_result)
+        app.router.add_get('/api/v1/repos/query/stream/{session_id}', self.query_stream)
+        app.router.add_get('/api/v1/repos/events', self.events)
+        app.router.add_get('/_stats', self.stats)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """在后台启动服务，返回 base_url（port=0 时自动分配端口）"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        for task in list(self._background):
+            task.cancel()
+        for queue in list(self._subscribers):
+            queue.put_nowait(None)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---- 内部工具 ----
+
+    async def _delay(self, endpoint: str):
+        self.requests[endpoint] += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000 * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _duration(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _complete_later(self, kind: str, record: dict):
+        await asyncio.sleep(record['finish_at'] - time.monotonic())
+        if record['status'] != 'processing':
+            return
+        record['status'] = 'success'
+        event = {'type': kind, 'session_id': record['session_id'], 'status': 'success'}
+        await self._publish(event, record.get('callback_url'))
+
+    async def _publish(self, event: dict, callback_url: str = None):
+        for queue in list(self._subscribers):
+            queue.put_nowait(event)
+        if callback_url:
+            headers = {'X-RepoInsight-Token': self.webhook_token} if self.webhook_token else {}
+            try:
+                async with ClientSession(timeout=ClientTimeout(total=5)) as session:
+                    async with session.post(callback_url, json=event, headers=headers) as response:
+                        self.requests['webhook_delivery'] += 1
+                        if response.status >= 300:
+                            self.requests['webhook_failure'] += 1
+            except Exception:
+                self.requests['webhook_failure'] += 1
+
+    def _answer_text(self, record: dict) -> str:
+        paragraphs = [f"这是关于“{record['question']}”的模拟答案。"]
+        paragraphs += [f"第 {i} 段：" + "这里是逐步生成的示例说明文字。" * 12 for i in range(1, self.answer_paragraphs)]
+        return "\n\n".join(paragraphs)
+
+    def _progress(self, record: dict) -> float:
+        total = record['finish_at'] - record['started_at']
+        return 1.0 if total <= 0 else min(1.0, (time.monotonic() - record['started_at']) / total)
+
+    # ---- 接口实现 ----
+
+    async def health(self, request):
+        await self._delay('health')
+        return web.json_response({'status': 'healthy', 'service': 'github-bot', 'version': 'fake'})
+
+    async def analyze(self, request):
+        await self._delay('analyze')
+        body = await request.json()
+        session_id = str(uuid.uuid4())
+        now = time.monotonic()
+        record = {
+            'session_id': session_id,
+            'repo_url': body.get('repo_url'),
+            'status': 'processing',
+            'started_at': now,
+            'finish_at': now + self._duration(self.analysis_seconds),
+            'callback_url': body.get('callback_url'),
+        }
+        self.analyses[session_id] = record
+        self._spawn(self._complete_later('analysis', record))
+        return web.json_response({'session_id': session_id, 'task_id': str(uuid.uuid4()), 'status': 'queued'})
+
+    async def analysis_status(self, request):
+        await self._delay('analysis_status')
+        record = self.analyses.get(request.match_info['session_id'])
+        if record is None:
+            return web.json_response({'detail': 'not found'}, status=404)
+        total_files = 100
+        processed = int(total_files * self._progress(record))
+        return web.json_response({
+            'session_id': record['session_id'],
+            'status': record['status'],
+            'repository_url': record['repo_url'],
+            'total_files': total_files,
+            'processed_files': processed if record['status'] == 'processing' else total_files,
+            'error_message': None,
+        })
+
+    async def cancel_analysis(self, request):
+        await self._delay('cancel')
+        record = self.analyses.get(request.match_info['session_id'])
+        if record is None:
+            return web.json_response({'detail': 'not found'}, status=404)
+        record['status'] = 'cancelled'
+        await self._publish({'type': 'analysis', 'session_id': record['session_id'], 'status': 'cancelled'},
+                            record.get('callback_url'))
+        return web.json_response({'session_id': record['session_id'], 'status': 'cancelled'})
+
+    async def query(self, request):
+        await self._delay('query')
+        body = await request.json()
+        if body.get('session_id') not in self.analyses:
+            return web.json_response({'detail': 'analysis session not found'}, status=404)
+        session_id = str(uuid.uuid4())
+        now = time.monotonic()
+        record = {
+            'session_id': session_id,
+            'question': body.get('question', ''),
+            'status': 'processing',
+            'started_at': now,
+            'finish_at': now + self._duration(self.query_seconds),
+            'callback_url': body.get('callback_url'),
+        }
+        self.queries[session_id] = record
+        self._spawn(self._complete_later('query', record))
+        return web.json_response({'session_id': session_id, 'task_id': session_id, 'status': 'queued'})
+
+    async def query_status(self, request):
+        await self._delay('query_status')
+        record = self.queries.get(request.match_info['session_id'])
+        if record is None:
+            return web.json_response({'detail': 'not found'}, status=404)
+        done = record['status'] == 'success'
+        return web.json_response({
+            'session_id': record['session_id'],
+            'status': record['status'],
+            'ready': done,
+            'successful': done,
+        })
+
+    async def query_result(self, request):
+        await self._delay('query_result')
+        record = self.queries.get(request.match_info['session_id'])
+        if record is None or record['status'] != 'success':
+            return web.json_response({'detail': 'not ready'}, status=404)
+        return web.json_response({
+            'answer': self._answer_text(record),
+            'retrieved_context': [
+                {'content': 'def main():\n    pass', 'file_path': 'main.py', 'start_line': 1, 'score': 0.9},
+            ],
+            'generation_mode': 'service',
+        })
+
+    async def query_stream(self, request):
+        """按生成进度分片推送答案（SSE），生成结束时发送 done 事件"""
+        await self._delay('query_stream')
+        if not self.streaming:
+            return web.json_response({'detail': 'Not Found'}, status=404)
+        record = self.queries.get(request.match_info['session_id'])
+        if record is None:
+            return web.json_response({'detail': 'query session not found'}, status=410)
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        text = self._answer_text(record)
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)]
+        interval = max(0.0, record['finish_at'] - time.monotonic()) / max(1, len(pieces))
+        try:
+            for piece in pieces:
+                await response.write(f"data: {json.dumps({'delta': piece}, ensure_ascii=False)}\n\n".encode('utf-8'))
+                if interval:
+                    await asyncio.sleep(interval)
+            await response.write(b'data: {"done": true, "status": "success"}\n\n')
+        except ConnectionResetError:
+            # 客户端提前断开
+            pass
+        return response
+
+    async def events(self, request):
+        self.requests['events'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                if event is None:
+                    break
+                await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+        except ConnectionResetError:
+            pass
+        finally:
+            self._subscribers.discard(queue)
+        return response
+
+    async def stats(self, request):
+        return web.json_response({'requests': dict(self.requests)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--analysis-seconds', type=float, default=10)
+    parser.add_argument('--query-seconds', type=float, default=2)
+    parser.add_argument('--webhook-token', default='')
+    parser.add_argument('--answer-paragraphs', type=int, default=1)
+    parser.add_argument('--no-stream', action='store_true', help='流式接口返回 404，模拟旧版 GithubBot')
+    args = parser.parse_args()
+
+    fake = FakeGithubBot(args.latency_ms, args.analysis_seconds, args.query_seconds,
+                         webhook_token=args.webhook_token, answer_paragraphs=args.answer_paragraphs,
+                         streaming=not args.no_stream)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LangBot 运行时替身
+在没有安装 LangBot 的环境中导入 main.py（基准测试、离线压测等工具使用）
+"""
+
+import sys
+import types
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+
+def install():
+    """若当前环境没有 LangBot，则注册最小化的 pkg.* 模块"""
+    if str(PLUGIN_DIR) not in sys.path:
+        sys.path.insert(0, str(PLUGIN_DIR))
+    try:
+        import pkg.plugin.context  # noqa: F401
+        return False
+    except ImportError:
+        pass
+
+    context = types.ModuleType('pkg.plugin.context')
+
+    def register(**kwargs):
+        return lambda cls: cls
+
+    def handler(event_type):
+        def decorator(func):
+            func.__event_type__ = event_type
+            return func
+        return decorator
+
+    class BasePlugin:
+        def __init__(self, host):
+            self.host = host
+
+    class APIHost:
+        pass
+
+    class EventContext:
+        pass
+
+    context.register = register
+    context.handler = handler
+    context.BasePlugin = BasePlugin
+    context.APIHost = APIHost
+    context.EventContext = EventContext
+
+    events = types.ModuleType('pkg.plugin.events')
+
+    class PersonNormalMessageReceived:
+        pass
+
+    class GroupNormalMessageReceived:
+        pass
+
+    events.PersonNormalMessageReceived = PersonNormalMessageReceived
+    events.GroupNormalMessageReceived = GroupNormalMessageReceived
+    events.__all__ = ['PersonNormalMessageReceived', 'GroupNormalMessageReceived']
+
+    platform_types = types.ModuleType('pkg.platform.types')
+
+    class MessageChain(list):
+        pass
+
+    class Plain:
+        def __init__(self, text):
+            self.text = text
+
+        def __str__(self):
+            return self.text
+
+    class At:
+        def __init__(self, target):
+            self.target = target
+
+    platform_types.MessageChain = MessageChain
+    platform_types.Plain = Plain
+    platform_types.At = At
+    platform_types.__all__ = ['MessageChain', 'Plain', 'At']
+
+    modules = {
+        'pkg': types.ModuleType('pkg'),
+        'pkg.plugin': types.ModuleType('pkg.plugin'),
+        'pkg.platform': types.ModuleType('pkg.platform'),
+        'pkg.plugin.context': context,
+        'pkg.plugin.events': events,
+        'pkg.platform.types': platform_types,
+    }
+    for name, module in modules.items():
+        sys.modules.setdefault(name, module)
+    return True
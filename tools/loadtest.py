@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RepoInsight 端到端离线压测
+用本地 GithubBot 替身和模拟的 LangBot 宿主驱动真实的 RepoInsightPlugin 事件处理器，
+统计消息吞吐、答案端到端延迟分位数、后端请求放大倍数与数据库操作数。
+
+用法: python tools/loadtest.py --scenario medium
+      python tools/loadtest.py --users 500 --repos 20 --questions 3 --max-p95 10 --json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import langbot_stub  # noqa: E402
+
+langbot_stub.install()
+
+import main  # noqa: E402
+from fake_githubbot import FakeGithubBot  # noqa: E402
+
+# 替身后端回调插件时携带的令牌（webhook 模式必须配置）
+WEBHOOK_SECRET = 'loadtest-secret'
+
+# 预设场景：并发用户数、仓库数、每个用户的提问数
+SCENARIOS = {
+    'small': {'users': 200, 'repos': 10, 'questions': 2},
+    'medium': {'users': 2000, 'repos': 50, 'questions': 2},
+    'large': {'users': 20000, 'repos': 200, 'questions': 1},
+}
+
+
+class FakeAdapter:
+    bot_account_id = 'loadtest-bot'
+
+
+class FakeHost:
+    """模拟 APIHost：记录主动消息，并按 @ 对象或目标 ID 投递到对应用户的收件箱"""
+
+    def __init__(self):
+        self.adapter = FakeAdapter()
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.sent = 0
+
+    def get_platform_adapters(self):
+        return [self.adapter]
+
+    async def send_active_message(self, adapter, target_type, target_id, message):
+        self.sent += 1
+        recipient = target_id
+        if message and isinstance(message[0], main.At):
+            recipient = str(message[0].target)
+        text = "".join(getattr(component, 'text', '') for component in message)
+        self.inboxes[recipient].put_nowait((time.monotonic(), text))
+
+
+class FakeQuery:
+    def __init__(self, adapter, message_chain):
+        self.adapter = adapter
+        self.message_chain = message_chain
+
+
+class FakeEvent:
+    def __init__(self, text, sender_id, launcher_type, launcher_id, adapter, mention=None):
+        self.text_message = text
+        self.sender_id = sender_id
+        self.launcher_type = launcher_type
+        self.launcher_id = launcher_id
+        # 群聊中 @ 某人时消息链以 At 组件开头
+        chain = main.MessageChain([main.At(target=mention)] if mention else [])
+        chain.append(main.Plain(text))
+        self.query = FakeQuery(adapter, chain)
+
+
+class FakeContext:
+    """模拟 EventContext：收集插件的直接回复"""
+
+    def __init__(self, event):
+        self.event = event
+        self.replies = []
+        self.prevented = False
+
+    def add_return(self, key, value):
+        if key == 'reply':
+            self.replies.extend(value)
+
+    def prevent_default(self):
+        self.prevented = True
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.host = FakeHost()
+        self.handle_latencies = []
+        self.answer_latencies = []
+        self.analysis_latencies = []
+        self.messages = 0
+        self.answers = 0
+        self.cache_answers = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.chatter = 0
+
+    async def send(self, plugin, user_id, group_id, text, mention=FakeAdapter.bot_account_id):
+        """通过插件事件处理器发送一条消息，返回直接回复文本；群消息默认 @ 机器人"""
+        if group_id:
+            event = FakeEvent(text, user_id, 'group', group_id, self.host.adapter, mention)
+            handler = plugin.group_normal_message_received
+        else:
+            event = FakeEvent(text, user_id, 'person', user_id, self.host.adapter)
+            handler = plugin.person_normal_message_received
+        ctx = FakeContext(event)
+        started = time.monotonic()
+        await handler(ctx)
+        self.handle_latencies.append(time.monotonic() - started)
+        self.messages += 1
+        return ctx.replies[0] if ctx.replies else ""
+
+    async def wait_for(self, user_id, prefix, started):
+        """等待以 prefix 开头的主动消息，返回端到端延迟；超时返回 None"""
+        inbox = self.host.inboxes[user_id]
+        deadline = started + self.args.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                return None
+            try:
+                arrived, text = await asyncio.wait_for(inbox.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return None
+            if text.lstrip().startswith(prefix):
+                return arrived - started
+
+    async def user(self, plugin, index):
+        args = self.args
+        user_id = f"user-{index}"
+        group_id = f"group-{index % 50}" if random.random() < args.group_ratio else None
+        await asyncio.sleep(random.uniform(0, args.ramp_seconds))
+        try:
+            if group_id:
+                await self.group_chatter(plugin, user_id, group_id)
+            repo = f"https://github.com/loadtest/repo-{random.randrange(args.repos)}"
+            if args.inline_repo:
+                started = time.monotonic()
+                reply = await self.send(plugin, user_id, group_id, f"/repo {repo}")
+            else:
+                await self.send(plugin, user_id, group_id, '/repo')
+                started = time.monotonic()
+                reply = await self.send(plugin, user_id, group_id, repo)
+            if '可以直接提问' not in reply:
+                if not reply.startswith('✅'):
+                    self.errors += 1
+                    return
+                latency = await self.wait_for(user_id, '✅ 仓库分析完成', started)
+                if latency is None:
+                    return
+                self.analysis_latencies.append(latency)
+            for n in range(args.questions):
+                # repeat_ratio 比例的问题使用各仓库共享的问题文本，可命中答案缓存
+                if random.random() < args.repeat_ratio:
+                    question = f"这个仓库的入口在哪里？#{n}"
+                else:
+                    question = f"{user_id} 的第 {n} 个问题：模块之间如何交互？"
+                started = time.monotonic()
+                reply = await self.send(plugin, user_id, group_id, question)
+                if '来自缓存' in reply:
+                    self.cache_answers += 1
+                    self.answer_latencies.append(time.monotonic() - started)
+                    continue
+                if not reply.startswith('✅'):
+                    self.errors += 1
+                    continue
+                latency = await self.wait_for(user_id, '💡', started)
+                if latency is not None:
+                    self.answers += 1
+                    self.answer_latencies.append(latency)
+                await asyncio.sleep(random.uniform(0, args.think_seconds))
+        except Exception as e:
+            self.errors += 1
+            logging.getLogger('loadtest').error(f"User {user_id} failed: {e!r}")
+
+    async def group_chatter(self, plugin, user_id, group_id):
+        """群里未 @ 机器人的闲聊（含邮箱和 @ 他人），插件应在预过滤阶段忽略"""
+        texts = ("周末有人一起打球吗？", "简历发到 hr@example.com 就行", "看看这个 PR")
+        for n in range(self.args.group_chatter):
+            mention = f"user-{random.randrange(self.args.users)}" if n % 3 == 2 else None
+            if await self.send(plugin, user_id, group_id, texts[n % 3], mention=mention):
+                self.errors += 1
+            self.chatter += 1
+
+    async def run(self):
+        args = self.args
+        fake = FakeGithubBot(latency_ms=args.latency_ms, analysis_seconds=args.analysis_seconds,
+                             query_seconds=args.query_seconds, answer_paragraphs=args.answer_paragraphs,
+                             webhook_token=WEBHOOK_SECRET)
+        base_url = await fake.start()
+        workdir = tempfile.mkdtemp(prefix='repoinsight-loadtest-')
+        os.chdir(workdir)
+
+        plugin = main.RepoInsightPlugin(self.host)
+        plugin.config = {
+            'githubbot_base_url': base_url,
+            'notification_mode': args.mode,
+            'webhook_port': args.webhook_port,
+            'webhook_public_url': f"http://127.0.0.1:{args.webhook_port}/repoinsight/events",
+            'webhook_secret': WEBHOOK_SECRET,
+            'notify_rate_limit': args.notify_rate,
+            'poll_concurrency': args.poll_concurrency,
+            'max_concurrent_queries': args.max_concurrent_queries,
+            'state_backend': args.backend,
+            'state_shards': args.shards,
+        }
+        await plugin.initialize()
+
+        started = time.monotonic()
+        await asyncio.gather(*(self.user(plugin, index) for index in range(args.users)))
+        elapsed = time.monotonic() - started
+
+        report = self.report(plugin, fake, elapsed)
+        await plugin.cleanup()
+        await fake.stop()
+        return report
+
+    @staticmethod
+    def percentile(values, q):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def report(self, plugin, fake, elapsed):
+        backend_requests = sum(count for endpoint, count in fake.requests.items()
+                               if endpoint not in ('webhook_delivery', 'webhook_failure', 'events'))
+        user_operations = self.args.users + self.answers + self.cache_answers
+        return {
+            'users': self.args.users,
+            'mode': self.args.mode,
+            'backend': self.args.backend,
+            'elapsed_seconds': round(elapsed, 2),
+            'messages': self.messages,
+            'messages_per_second': round(self.messages / elapsed, 1) if elapsed else 0,
+            'group_chatter': self.chatter,
+            'handle_p50_ms': round((self.percentile(self.handle_latencies, 0.5) or 0) * 1000, 2),
+            'handle_p99_ms': round((self.percentile(self.handle_latencies, 0.99) or 0) * 1000, 2),
+            'analysis_p50_s': self.percentile(self.analysis_latencies, 0.5),
+            'answers': self.answers,
+            'cache_answers': self.cache_answers,
+            'answer_p50_s': self.percentile(self.answer_latencies, 0.5),
+            'answer_p95_s': self.percentile(self.answer_latencies, 0.95),
+            'answer_p99_s': self.percentile(self.answer_latencies, 0.99),
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'backend_requests': dict(fake.requests),
+            'backend_amplification': round(backend_requests / user_operations, 2) if user_operations else None,
+            'db_ops': int(main.metrics.total('repoinsight_db_op_seconds')),
+            'db_transactions': plugin.state_manager.flushes,
+            'group_prefiltered': int(main.metrics.total('repoinsight_group_prefilter_total')),
+            'notifications_sent': self.host.sent,
+        }
+
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key:<24} {value}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), help='预设场景，会覆盖 users/repos/questions')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=2)
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help='使用共享问题文本的比例')
+    parser.add_argument('--group-ratio', type=float, default=0.2, help='来自群聊的用户比例')
+    parser.add_argument('--group-chatter', type=int, default=3, help='每个群聊用户发送的未 @ 机器人的闲聊条数')
+    parser.add_argument('--inline-repo', action='store_true', help='用一条 /repo <url> 开始分析，而不是 /repo 后再发URL')
+    parser.add_argument('--ramp-seconds', type=float, default=5)
+    parser.add_argument('--think-seconds', type=float, default=1)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--analysis-seconds', type=float, default=5)
+    parser.add_argument('--query-seconds', type=float, default=2)
+    parser.add_argument('--answer-paragraphs', type=int, default=3)
+    parser.add_argument('--mode', choices=('poll', 'sse', 'webhook'), default='poll')
+    parser.add_argument('--webhook-port', type=int, default=18765)
+    parser.add_argument('--notify-rate', type=float, default=0, help='每个适配器每秒主动消息数，0 表示不限速')
+    parser.add_argument('--poll-concurrency', type=int, default=32)
+    parser.add_argument('--max-concurrent-queries', type=int, default=256)
+    parser.add_argument('--backend', choices=('sqlite', 'memory', 'sharded_sqlite'), default='sqlite',
+                        help='状态存储后端')
+    parser.add_argument('--shards', type=int, default=4, help='sharded_sqlite 后端的分片数')
+    parser.add_argument('--timeout', type=float, default=120, help='等待单个通知的超时（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出报告')
+    parser.add_argument('--max-p95', type=float, help='答案 p95 延迟上限（秒），超出时以非零状态退出')
+    parser.add_argument('--min-throughput', type=float, help='消息吞吐下限（条/秒），低于时以非零状态退出')
+    args = parser.parse_args()
+    if args.scenario:
+        for key, value in SCENARIOS[args.scenario].items():
+            setattr(args, key, value)
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(LoadTest(args).run())
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    failures = []
+    if report['errors'] or report['timeouts']:
+        failures.append(f"{report['errors']} errors, {report['timeouts']} timeouts")
+    if args.max_p95 is not None and (report['answer_p95_s'] is None or report['answer_p95_s'] > args.max_p95):
+        failures.append(f"answer p95 {report['answer_p95_s']} > {args.max_p95}s")
+    if args.min_throughput is not None and report['messages_per_second'] < args.min_throughput:
+        failures.append(f"throughput {report['messages_per_second']} < {args.min_throughput} msg/s")
+    if failures:
+        print("FAILED: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
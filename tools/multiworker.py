@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程共享状态库测试
+启动一个 GithubBot 替身和多个共享同一 SQLite 文件的插件工作进程，其中一个进程运行一段时间后被强制退出，
+检查其余进程能否通过过期租约接管在途任务，并且每条分析完成通知、每个答案都只发送一次，每个查询结果只获取一次。
+
+用法: python tools/multiworker.py --workers 3 --users 60 --kill-after 6
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import langbot_stub  # noqa: E402
+
+langbot_stub.install()
+
+import main  # noqa: E402
+from fake_githubbot import FakeGithubBot  # noqa: E402
+from loadtest import FakeContext, FakeEvent, FakeHost  # noqa: E402
+
+
+class LoggingHost(FakeHost):
+    """把每条主动消息追加到共享日志，被强制退出的进程已发出的消息也不会丢失"""
+
+    def __init__(self, log_path, worker):
+        super().__init__()
+        self.log_path = log_path
+        self.worker = worker
+
+    async def send_active_message(self, adapter, target_type, target_id, message):
+        await super().send_active_message(adapter, target_type, target_id, message)
+        text = "".join(getattr(component, 'text', '') for component in message)
+        write_log(self.log_path, {'event': 'sent', 'worker': self.worker, 'target': target_id,
+                                  'text': text.splitlines()[0] if text else ''})
+
+
+def write_log(path, record):
+    # 追加模式下的单行写入是原子的，多个进程可以共用一个日志文件
+    with open(path, 'a', encoding='utf-8') as log:
+        log.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+async def send(plugin, host, user_id, text):
+    ctx = FakeContext(FakeEvent(text, user_id, 'person', user_id, host.adapter))
+    await plugin.person_normal_message_received(ctx)
+    return ctx.replies[0] if ctx.replies else ""
+
+
+async def in_flight(plugin, db_path):
+    """共享数据库中仍在进行的分析与问题数"""
+    await plugin.state_manager.flush_async()
+    conn = sqlite3.connect(db_path)
+    try:
+        analyzing = conn.execute(
+            "SELECT COUNT(*) FROM user_sessions WHERE state = ?", (main.UserState.ANALYZING.value,)
+        ).fetchone()[0]
+        questions = conn.execute("SELECT COUNT(*) FROM pending_questions").fetchone()[0]
+    finally:
+        conn.close()
+    return analyzing + questions
+
+
+async def run_worker(args):
+    random.seed(args.seed + args.worker)
+    # 插件在构造时按默认文件名在当前目录打开数据库
+    os.chdir(os.path.dirname(args.db))
+    host = LoggingHost(args.log, args.worker)
+    plugin = main.RepoInsightPlugin(host)
+    plugin.config = {
+        'githubbot_base_url': args.base_url,
+        'task_lease_seconds': args.lease_seconds,
+        'notify_rate_limit': 0,
+    }
+    await plugin.initialize()
+
+    async def user(index):
+        user_id = f"user-{index}"
+        await asyncio.sleep(random.uniform(0, 1))
+        await send(plugin, host, user_id, '/repo')
+        await send(plugin, host, user_id, f"https://github.com/multi/repo-{index % args.repos}")
+        # 分析完成通知可能由其他进程发出，这里只看共享数据库中的会话状态
+        while '准备就绪' not in await send(plugin, host, user_id, '/status'):
+            await asyncio.sleep(0.5)
+        for n in range(args.questions):
+            question = f"{user_id} 的第 {n} 个问题"
+            write_log(args.log, {'event': 'ask', 'worker': args.worker, 'target': user_id, 'text': question})
+            await send(plugin, host, user_id, question)
+
+    users = [index for index in range(args.users) if index % args.workers == args.worker]
+    flows = asyncio.gather(*(user(index) for index in users))
+    if args.worker == 0 and args.kill_after:
+        await asyncio.sleep(args.kill_after)
+        # 模拟进程崩溃：不清理、不释放租约
+        os._exit(1)
+    await flows
+    deadline = time.monotonic() + args.timeout
+    while await in_flight(plugin, args.db) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    await plugin.cleanup()
+
+
+async def run_parent(args):
+    fake = FakeGithubBot(latency_ms=5, analysis_seconds=args.analysis_seconds,
+                         query_seconds=args.query_seconds, streaming=False)
+    base_url = await fake.start()
+    workdir = tempfile.mkdtemp(prefix='repoinsight-multiworker-')
+    db_path = os.path.join(workdir, 'repo_insight.db')
+    log_path = os.path.join(workdir, 'messages.log')
+    # 先建好数据库，避免多个进程同时做一次性迁移
+    main.StateManager(db_path).close()
+
+    started = time.monotonic()
+    processes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, __file__, '--worker', str(worker), '--base-url', base_url, '--db', db_path,
+            '--log', log_path, '--workers', str(args.workers), '--users', str(args.users),
+            '--repos', str(args.repos), '--questions', str(args.questions),
+            '--lease-seconds', str(args.lease_seconds), '--kill-after', str(args.kill_after),
+            '--timeout', str(args.timeout), '--seed', str(args.seed),
+        )
+        for worker in range(args.workers)
+    ]
+    codes = [await process.wait() for process in processes]
+    elapsed = time.monotonic() - started
+    await fake.stop()
+
+    records = [json.loads(line) for line in open(log_path, encoding='utf-8')] if os.path.exists(log_path) else []
+    asked = Counter((r['target'], r['text']) for r in records if r['event'] == 'ask')
+    answered = Counter()
+    analysis_done = Counter()
+    for record in records:
+        if record['event'] != 'sent':
+            continue
+        if record['text'].startswith('💡 **问题**：'):
+            answered[(record['target'], record['text'][len('💡 **问题**：'):])] += 1
+        elif record['text'].startswith('✅ 仓库分析完成'):
+            analysis_done[record['target']] += 1
+    conn = sqlite3.connect(db_path)
+    left = conn.execute("SELECT COUNT(*) FROM pending_questions").fetchone()[0]
+    conn.close()
+
+    report = {
+        'workers': args.workers,
+        'exit_codes': codes,
+        'elapsed_seconds': round(elapsed, 2),
+        'questions_asked': sum(asked.values()),
+        'answers_delivered': sum(answered.values()),
+        'missing_answers': sum(1 for key in asked if answered[key] == 0),
+        'duplicate_answers': sum(count - 1 for count in answered.values() if count > 1),
+        'duplicate_analysis_notices': sum(count - 1 for count in analysis_done.values() if count > 1),
+        'query_submissions': fake.requests['query'],
+        'query_result_fetches': fake.requests['query_result'],
+        'pending_questions_left': left,
+    }
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--repos', type=int, default=5)
+    parser.add_argument('--questions', type=int, default=2)
+    parser.add_argument('--analysis-seconds', type=float, default=3)
+    parser.add_argument('--query-seconds', type=float, default=2)
+    parser.add_argument('--lease-seconds', type=float, default=3)
+    parser.add_argument('--kill-after', type=float, default=5, help='0 号进程运行多少秒后被强制退出，0 表示不退出')
+    parser.add_argument('--timeout', type=float, default=240,
+                        help='存活进程等待在途任务全部结束的上限（秒），需长于提交中问题的回收时间')
+    parser.add_argument('--seed', type=int, default=1)
+    # 以下参数由父进程传给工作进程
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--log', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        asyncio.run(run_worker(args))
+        return
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run_parent(args))
+    for key, value in report.items():
+        print(f"{key:<28} {value}")
+    failed = (report['missing_answers'] or report['duplicate_answers'] or report['duplicate_analysis_notices']
+              or report['query_result_fetches'] != report['answers_delivered'] or report['pending_questions_left'])
+    if failed:
+        print("FAILED", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()